@@ -0,0 +1,135 @@
+"""
+Benchmark of the Llama model decoding with a HeterogeneousMemory against a DynamicCache.
+
+Both runs feed the same random `--context_length` token prompt to the faiss_attn Llama model and greedy decode
+`--steps` tokens, timing the prefill and every decode step of the whole forward: the dense run with a DynamicCache and
+attn_mode="flash", the heterogeneous run with a HeterogeneousMemory and attn_mode="heterogeneous". The top
+`--full_topk` retrieval heads of head_score/<model_name> keep their full cache, the next `--int8_topk` ones an int8
+cache of every position, the others `--sink_size` sinks and a `--window_size` recent window:
+    python benchmark_heterogeneous_memory.py --model_path /path/to/llama-2-7b-80k --model_name llama-2-7b-80k --context_length 16000 --full_topk 100 --int8_topk 200
+"""
+import argparse
+import sys
+import time
+
+import numpy as np
+import torch
+from transformers.cache_utils import DynamicCache
+
+sys.path.append("faiss_attn")
+from source.modeling_llama import LlamaForCausalLM
+from source.cache_utils import HeterogeneousMemory
+from head_score_store import load_head_ranking
+
+
+def dense_memory_bytes(cache):
+    return sum(states.numel() * states.element_size() for states in cache.key_cache + cache.value_cache)
+
+
+def synchronize(device):
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+
+
+def decode(model, input_ids, past_key_values, steps, attn_mode):
+    """
+    Prefills `input_ids` and greedy decodes `steps` tokens through the model.
+    :return: Tuple of the prefill time, the per step decode latencies (seconds), the generated token ids and the cache.
+    """
+    device = input_ids.device
+    synchronize(device)
+    start_time = time.perf_counter()
+    outputs = model(input_ids=input_ids, past_key_values=past_key_values, use_cache=True, attn_mode=attn_mode)
+    synchronize(device)
+    prefill_time = time.perf_counter() - start_time
+
+    tokens, latencies = [], []
+    next_token = outputs.logits[:, -1].argmax(dim=-1, keepdim=True)
+    for _ in range(steps):
+        tokens.append(next_token)
+        synchronize(device)
+        start_time = time.perf_counter()
+        outputs = model(input_ids=next_token, past_key_values=outputs.past_key_values, use_cache=True, attn_mode=attn_mode)
+        synchronize(device)
+        latencies.append(time.perf_counter() - start_time)
+        next_token = outputs.logits[:, -1].argmax(dim=-1, keepdim=True)
+    return prefill_time, latencies, torch.cat(tokens, dim=-1), outputs.past_key_values
+
+
+def benchmark(model, full_heads, int8_heads, context_length=8192, steps=64, sink_size=4, window_size=256, batch_size=1, seed=0):
+    """
+    Decodes the same random prompt with a DynamicCache and with a HeterogeneousMemory keeping `full_heads` in full,
+    `int8_heads` in int8 and the other heads in a window.
+    :return: Dict of the prefill times, per step decode latencies (seconds), cache bytes and peak CUDA memory of both
+        runs, and the share of greedy tokens the heterogeneous run agrees on with the dense one.
+    """
+    device = model.device
+    generator = torch.Generator(device="cpu").manual_seed(seed)
+    input_ids = torch.randint(0, model.config.vocab_size, (batch_size, context_length), generator=generator).to(device)
+    num_key_value_groups = model.config.num_attention_heads // model.config.num_key_value_heads
+
+    result = {}
+    for name in ["dense", "heterogeneous"]:
+        if name == "dense":
+            cache, attn_mode = DynamicCache(), "flash"
+        else:
+            cache = HeterogeneousMemory.from_head_ranking(
+                full_heads, int8_heads, num_key_value_groups=num_key_value_groups, sink_size=sink_size,
+                window_size=window_size, max_new_tokens=steps + 1,
+            )
+            attn_mode = "heterogeneous"
+        if device.type == "cuda":
+            torch.cuda.empty_cache()
+            torch.cuda.reset_peak_memory_stats(device)
+        with torch.no_grad():
+            prefill_time, latencies, tokens, cache = decode(model, input_ids, cache, steps, attn_mode)
+        result[f"{name}_prefill_time"] = prefill_time
+        result[f"{name}_latencies"] = latencies
+        result[f"{name}_tokens"] = tokens
+        result[f"{name}_peak_bytes"] = torch.cuda.max_memory_allocated(device) if device.type == "cuda" else None
+        if name == "dense":
+            result["dense_bytes"] = dense_memory_bytes(cache)
+        else:
+            result["heterogeneous_bytes"] = cache.memory_bytes()
+            result["tier_bytes"] = cache.tier_memory_bytes()
+        del cache
+
+    result["token_agreement"] = (result["dense_tokens"] == result["heterogeneous_tokens"]).float().mean().item()
+    return result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model_path', type=str, required=True, help='Llama model directory')
+    parser.add_argument('--model_name', type=str, default="llama-2-7b-80k", help='head_score/<model_name> ranking the heads')
+    parser.add_argument('--context_length', type=int, default=8192, help='random prompt length prefilled before decoding')
+    parser.add_argument('--steps', type=int, default=64, help='decode steps timed')
+    parser.add_argument('--full_topk', type=int, default=100, help='top retrieval heads keeping their full cache')
+    parser.add_argument('--int8_topk', type=int, default=200, help='next retrieval heads keeping an int8 cache of every position')
+    parser.add_argument('--sink_size', type=int, default=4, help='leading positions kept for the window heads')
+    parser.add_argument('--window_size', type=int, default=256, help='recent positions kept for the window heads')
+    parser.add_argument('--batch_size', type=int, default=1)
+    parser.add_argument('--dtype', type=str, default="bfloat16", help='dtype of the model')
+    args = parser.parse_args()
+
+    model = LlamaForCausalLM.from_pretrained(args.model_path, torch_dtype=getattr(torch, args.dtype), device_map='auto',
+                                             attn_implementation="flash_attention_2").eval()
+    ranking = load_head_ranking(args.model_name, args.full_topk + args.int8_topk)
+    full_heads, int8_heads = ranking[:args.full_topk], ranking[args.full_topk:]
+    print(f"context {args.context_length}, {args.steps} steps: {len(full_heads)} full, {len(int8_heads)} int8 heads, "
+          f"others {args.sink_size} sink + {args.window_size} recent positions")
+
+    result = benchmark(model, full_heads, int8_heads, context_length=args.context_length, steps=args.steps,
+                       sink_size=args.sink_size, window_size=args.window_size, batch_size=args.batch_size)
+
+    print(f"kv cache: DynamicCache {result['dense_bytes'] / 2 ** 20:.1f} MiB, HeterogeneousMemory "
+          f"{result['heterogeneous_bytes'] / 2 ** 20:.1f} MiB ({result['dense_bytes'] / result['heterogeneous_bytes']:.2f}x smaller), "
+          + ", ".join(f"{tier} {size / 2 ** 20:.1f} MiB" for tier, size in result['tier_bytes'].items()))
+    for name in ["dense", "heterogeneous"]:
+        # the first step warms up the kernels
+        latencies = np.array(result[f"{name}_latencies"][1:]) * 1000
+        peak = result[f"{name}_peak_bytes"]
+        print(f"{name}: prefill {result[f'{name}_prefill_time'] * 1000:.1f} ms, step latency mean {latencies.mean():.2f} ms, "
+              f"p50 {np.median(latencies):.2f} ms, p90 {np.percentile(latencies, 90):.2f} ms"
+              + (f", peak memory {peak / 2 ** 30:.2f} GiB" if peak is not None else ""))
+    print(f"greedy tokens agreeing with the dense run: {result['token_agreement']:.1%}")
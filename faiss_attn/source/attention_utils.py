@@ -0,0 +1,220 @@
+import copy
+from collections import defaultdict
+
+import torch
+import torch.nn.functional as F
+from torch import nn
+
+
+def attention_topk_probe(query_states, key_states, topk=1, attention_mask=None, chunk_size=16384):
+    """
+    Top-k key positions attended by the last query row of every head, without materializing attention weights.
+
+    The query heads sharing a kv head are folded into one (group, head_dim) block, so grouped keys are never
+    expanded with `repeat_kv`, and the kv cache is scanned in chunks keeping a running top-k. Softmax and the
+    1/sqrt(head_dim) scale are monotonic, so the raw dot products rank positions exactly like the attention weights.
+
+    Args:
+        query_states (`torch.Tensor`): `(batch, num_heads, q_len, head_dim)`, only the last query row is used.
+        key_states (`torch.Tensor`): `(batch, num_key_value_heads, kv_len, head_dim)`.
+        topk (`int`): number of positions to keep per head.
+        attention_mask (`torch.Tensor`, *optional*): 2d padding mask aligned to the end of the keys, 0 marks padding.
+        chunk_size (`int`): number of key positions scored at once.
+
+    Returns:
+        `torch.LongTensor` of shape `(batch, num_heads, topk)`.
+    """
+    bsz, num_heads, _, head_dim = query_states.shape
+    num_key_value_heads, kv_len = key_states.shape[1], key_states.shape[2]
+    query = query_states[:, :, -1, :].reshape(bsz, num_key_value_heads, num_heads // num_key_value_heads, head_dim)
+
+    if attention_mask is not None and attention_mask.shape[-1] < kv_len:
+        # sliding window models trim the padding mask to the window while the cache keeps every position
+        attention_mask = F.pad(attention_mask, (kv_len - attention_mask.shape[-1], 0), value=1)
+
+    best_scores, best_idx = None, None
+    for start in range(0, kv_len, chunk_size):
+        key_chunk = key_states[:, :, start:start + chunk_size]
+        scores = torch.matmul(query, key_chunk.transpose(2, 3))
+        if attention_mask is not None:
+            padding = attention_mask[:, None, None, start:start + key_chunk.shape[2]] == 0
+            scores = scores.masked_fill(padding, float("-inf"))
+        scores, idx = scores.topk(min(topk, scores.shape[-1]), dim=-1)
+        idx = idx + start
+        if best_scores is not None:
+            scores, idx = torch.cat([best_scores, scores], dim=-1), torch.cat([best_idx, idx], dim=-1)
+            scores, order = scores.topk(min(topk, scores.shape[-1]), dim=-1)
+            idx = idx.gather(-1, order)
+        best_scores, best_idx = scores, idx
+
+    return best_idx.reshape(bsz, num_heads, -1)
+
+
+def grouped_attention_scores(query_states, key_states):
+    """
+    `query_states @ key_states^T` for grouped query attention without expanding the keys with `repeat_kv`.
+
+    Query heads are ordered so that consecutive groups share one kv head, the group is folded into the query rows
+    and multiplied against the shared kv head directly.
+
+    Args:
+        query_states (`torch.Tensor`): `(batch, num_heads, q_len, head_dim)`.
+        key_states (`torch.Tensor`): `(batch, num_key_value_heads, kv_len, head_dim)`.
+
+    Returns:
+        `torch.Tensor` of shape `(batch, num_heads, q_len, kv_len)`.
+    """
+    bsz, num_heads, q_len, head_dim = query_states.shape
+    num_key_value_heads, kv_len = key_states.shape[1], key_states.shape[2]
+    query = query_states.reshape(bsz, num_key_value_heads, num_heads // num_key_value_heads * q_len, head_dim)
+    scores = torch.matmul(query, key_states.transpose(2, 3))
+    return scores.view(bsz, num_heads, q_len, kv_len)
+
+
+def grouped_attention_output(attn_weights, value_states):
+    """
+    `attn_weights @ value_states` for grouped query attention without expanding the values with `repeat_kv`.
+
+    Args:
+        attn_weights (`torch.Tensor`): `(batch, num_heads, q_len, kv_len)`.
+        value_states (`torch.Tensor`): `(batch, num_key_value_heads, kv_len, head_dim)`.
+
+    Returns:
+        `torch.Tensor` of shape `(batch, num_heads, q_len, head_dim)`.
+    """
+    bsz, num_heads, q_len, kv_len = attn_weights.shape
+    num_key_value_heads, head_dim = value_states.shape[1], value_states.shape[-1]
+    weights = attn_weights.reshape(bsz, num_key_value_heads, num_heads // num_key_value_heads * q_len, kv_len)
+    output = torch.matmul(weights, value_states)
+    return output.view(bsz, num_heads, q_len, head_dim)
+
+
+def set_block_list(model, block_list):
+    """
+    Compiles `block_list` into the `head_mask` buffer of every attention layer of `model` (a `*Model` with `layers`).
+
+    The list is only compiled when it differs from the one of the previous call, so passing the same heads at every
+    generation step costs one list comparison. Layers without a masked head get `head_mask = None` and skip masking.
+
+    Args:
+        block_list (`list`): `[layer, head]` pairs masked for the whole batch, or one such list per batch row.
+    """
+    block_list = block_list or []
+    if block_list == getattr(model, "block_list", []):
+        return
+    # the per batch form nests one list of [layer, head] pairs per batch row
+    per_batch = bool(block_list) and isinstance(block_list[0][0], (list, tuple))
+    rows = block_list if per_batch else [block_list]
+    for row in rows:
+        for h in row:
+            if not (isinstance(h, (list, tuple)) and len(h) == 2 and all(isinstance(x, int) for x in h)):
+                raise ValueError(f"block_list entries must be [layer, head] pairs, or lists of them per batch row, got {h!r}")
+    model.block_list = copy.deepcopy(block_list)
+    for layer in model.layers:
+        attn = layer.self_attn
+        heads = [(batch_idx, h[1]) for batch_idx, row in enumerate(rows) for h in row if h[0] == attn.layer_idx]
+        if not heads:
+            attn.head_mask = None
+            continue
+        device = next(attn.parameters()).device
+        head_mask = torch.zeros(len(rows), attn.num_heads, 1, 1, dtype=torch.bool, device=device)
+        batch_idx, head_idx = zip(*heads)
+        head_mask[list(batch_idx), list(head_idx)] = True
+        attn.head_mask = head_mask
+
+
+def mask_heads(states, head_mask):
+    """
+    Zeroes the masked heads of `states` in one op, `states` is returned as is when the layer has no masked head.
+
+    Args:
+        states (`torch.Tensor`): `(batch, num_heads, ...)` queries or attention weights.
+        head_mask (`torch.BoolTensor`, *optional*): `(1 or batch, num_heads, 1, 1)`, see `set_block_list`.
+    """
+    if head_mask is None:
+        return states
+    return states.masked_fill(head_mask, 0)
+
+
+def _head_rows(heads, head_dim, device):
+    return torch.cat([torch.arange(h * head_dim, (h + 1) * head_dim) for h in heads]).to(device)
+
+
+def _prune_linear(linear, index, dim):
+    """
+    Copy of `linear` keeping only the output rows (dim=0) or input columns (dim=1) in `index`, with the dtype and
+    device of `linear`.
+    """
+    weight = linear.weight.index_select(dim, index)
+    bias = linear.bias if linear.bias is None or dim == 1 else linear.bias[index]
+    pruned = nn.Linear(weight.shape[1], weight.shape[0], bias=bias is not None, device="meta")
+    pruned.weight = nn.Parameter(weight.clone(), requires_grad=linear.weight.requires_grad)
+    if bias is not None:
+        pruned.bias = nn.Parameter(bias.clone(), requires_grad=linear.bias.requires_grad)
+    return pruned
+
+
+def prune_attention_heads(model, block_list):
+    """
+    Removes the heads of `block_list` from the attention layers of `model` (a `*Model` with `layers`), instead of
+    masking them at every forward.
+
+    The q rows and o_proj columns of the pruned heads are sliced out, and so are the k/v rows of a kv head whose query
+    heads are all pruned. Grouped query attention needs the same number of query heads per kv head, so every kept kv
+    head keeps as many query heads as the one with the most survivors, padded with its own pruned heads whose o_proj
+    columns are zeroed. A layer with every head pruned keeps one such zeroed head. Unlike masking, which makes
+    a head attend uniformly, a pruned head contributes nothing to the output.
+
+    Args:
+        block_list (`list`): `[layer, head]` pairs to prune, the per batch form of `set_block_list` is not supported.
+
+    Returns:
+        `int`, the number of query heads removed from the compute.
+    """
+    if getattr(model.config, "pretraining_tp", 1) > 1:
+        raise ValueError("Pruning heads is not supported with pretraining_tp > 1.")
+    pruned_heads = defaultdict(set)
+    for layer_idx, head_idx in block_list:
+        pruned_heads[int(layer_idx)].add(int(head_idx))
+
+    removed = 0
+    for layer in model.layers:
+        attn = layer.self_attn
+        pruned = pruned_heads.get(attn.layer_idx)
+        if not pruned:
+            continue
+        groups, head_dim = attn.num_key_value_groups, attn.head_dim
+        group_heads = [list(range(kv * groups, (kv + 1) * groups)) for kv in range(attn.num_key_value_heads)]
+        kept = [[h for h in heads if h not in pruned] for heads in group_heads]
+        group_size = max(1, max(len(heads) for heads in kept))
+        kv_heads = [kv for kv, heads in enumerate(kept) if heads] or [0]
+        q_heads, zeroed = [], []
+        for kv in kv_heads:
+            padding = [h for h in group_heads[kv] if h not in kept[kv]][:group_size - len(kept[kv])]
+            q_heads += kept[kv] + padding
+            zeroed += [len(q_heads) - len(padding) + i for i in range(len(padding))]
+
+        device = attn.o_proj.weight.device
+        q_index = _head_rows(q_heads, head_dim, device)
+        kv_index = _head_rows(kv_heads, head_dim, device)
+        if hasattr(attn, "qkv_proj"):
+            # fused [q; k; v] rows
+            q_size, kv_size = attn.num_heads * head_dim, attn.num_key_value_heads * head_dim
+            index = torch.cat([q_index, q_size + kv_index, q_size + kv_size + kv_index])
+            attn.qkv_proj = _prune_linear(attn.qkv_proj, index, dim=0)
+        else:
+            attn.q_proj = _prune_linear(attn.q_proj, q_index, dim=0)
+            attn.k_proj = _prune_linear(attn.k_proj, kv_index, dim=0)
+            attn.v_proj = _prune_linear(attn.v_proj, kv_index, dim=0)
+        attn.o_proj = _prune_linear(attn.o_proj, q_index, dim=1)
+        if zeroed:
+            with torch.no_grad():
+                attn.o_proj.weight[:, _head_rows(zeroed, head_dim, device)] = 0
+
+        removed += attn.num_heads - len(q_heads)
+        attn.num_heads = len(q_heads)
+        attn.num_key_value_heads = len(kv_heads)
+        attn.num_key_value_groups = group_size
+        attn.pruned_heads = pruned
+        attn.head_mask = None
+    return removed
@@ -0,0 +1,728 @@
+import math
+from collections import defaultdict
+from typing import Any, Dict, List, Optional, Tuple
+
+import torch
+from transformers.cache_utils import Cache, DynamicCache
+
+from .attention_utils import grouped_attention_output, grouped_attention_scores
+from .kv_index import build_index
+
+
+class StaticSlabCache(DynamicCache):
+    """
+    A cache that preallocates one `[batch_size, num_heads, max_length, head_dim]` slab per layer and writes new key
+    and value states into it in place, instead of growing by concatenation like `DynamicCache`.
+
+    `key_cache` / `value_cache` hold views on the filled part of each slab, so everything reading a `DynamicCache`
+    (indexing, `get_seq_length`, `to_legacy_cache`) keeps working, while a decode step only copies the new token.
+    The slab of a layer is allocated on its first update, on the device and with the dtype of the states it receives.
+
+    Parameters:
+        max_length (`int`):
+            Number of positions to reserve, usually the prompt length plus the number of tokens to decode.
+    """
+
+    def __init__(self, max_length: int) -> None:
+        super().__init__()
+        self.max_length = max_length
+        self.key_slab: List[torch.Tensor] = []
+        self.value_slab: List[torch.Tensor] = []
+        self.lengths: List[int] = []
+
+    def _allocate(self, key_states: torch.Tensor, value_states: torch.Tensor) -> None:
+        bsz, num_heads, _, head_dim = key_states.shape
+        self.key_slab.append(key_states.new_empty(bsz, num_heads, self.max_length, head_dim))
+        self.value_slab.append(value_states.new_empty(bsz, num_heads, self.max_length, value_states.shape[-1]))
+        self.lengths.append(0)
+        self.key_cache.append(self.key_slab[-1][:, :, :0])
+        self.value_cache.append(self.value_slab[-1][:, :, :0])
+
+    def _write(self, key_states: torch.Tensor, value_states: torch.Tensor, layer_idx: int) -> int:
+        if len(self.key_slab) <= layer_idx:
+            self._allocate(key_states, value_states)
+        start = self.lengths[layer_idx]
+        end = start + key_states.shape[-2]
+        if end > self.max_length:
+            raise ValueError(
+                f"StaticSlabCache was allocated for {self.max_length} positions, layer {layer_idx} needs {end}"
+            )
+        self.key_slab[layer_idx][:, :, start:end] = key_states
+        self.value_slab[layer_idx][:, :, start:end] = value_states
+        return end
+
+    def update(
+        self,
+        key_states: torch.Tensor,
+        value_states: torch.Tensor,
+        layer_idx: int,
+        cache_kwargs: Optional[Dict[str, Any]] = None,
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        Writes the new `key_states` and `value_states` of layer `layer_idx` after the cached ones and returns views on
+        all cached states of that layer.
+        """
+        if layer_idx == 0:
+            self.seen_tokens += key_states.shape[-2]
+
+        end = self._write(key_states, value_states, layer_idx)
+        self.lengths[layer_idx] = end
+        self.key_cache[layer_idx] = self.key_slab[layer_idx][:, :, :end]
+        self.value_cache[layer_idx] = self.value_slab[layer_idx][:, :, :end]
+        return self.key_cache[layer_idx], self.value_cache[layer_idx]
+
+    def lookahead(
+        self, key_states: torch.Tensor, value_states: torch.Tensor, layer_idx: int
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        Same as `update` but without committing the new states: they are written into the free part of the slab and
+        the next `update` of the layer overwrites them. Replaces `torch.cat([cache, states])` for read-only passes.
+        """
+        end = self._write(key_states, value_states, layer_idx)
+        return self.key_slab[layer_idx][:, :, :end], self.value_slab[layer_idx][:, :, :end]
+
+    def truncate(self, length: int) -> None:
+        """
+        Drops every cached position from `length` on. The slabs are kept, the next updates overwrite them in place.
+        """
+        self.seen_tokens = length
+        for layer_idx in range(len(self.key_slab)):
+            self.lengths[layer_idx] = length
+            self.key_cache[layer_idx] = self.key_slab[layer_idx][:, :, :length]
+            self.value_cache[layer_idx] = self.value_slab[layer_idx][:, :, :length]
+
+    def reorder_cache(self, beam_idx: torch.LongTensor):
+        raise NotImplementedError("StaticSlabCache does not support beam search.")
+
+
+class SparseKVCache(StaticSlabCache):
+    """
+    A `StaticSlabCache` that also indexes the prompt keys of selected heads for `attn_mode="sparse"`: once the prompt is
+    cached, these heads attend only to the `topk` prompt keys their index retrieves for the query, plus the last
+    `window_size` positions and every position cached after the index was built.
+
+    The index of a layer is built at its first decode step, over the kv heads serving a selected query head, from the
+    keys cached by the prefill. It stays on the device of the cache and searches all the sparse heads of a layer in
+    one batched call; it holds key ids only and reads the keys from the cache. The attention forward runs the dense
+    kernel only on the kv heads with a query head left dense, see `dense_kv_runs`. Batch size 1 only.
+
+    Parameters:
+        max_length (`int`):
+            Number of positions to reserve, see `StaticSlabCache`.
+        sparse_heads (`List[List[int]]`, *optional*):
+            `[layer, head]` query heads attending sparsely, every head when None.
+        topk (`int`):
+            Number of prompt keys retrieved per head and query.
+        window_size (`int`):
+            Number of most recent positions the sparse heads attend to besides the retrieved ones.
+        index_kind (`str`):
+            "ivf" or "flat", see `kv_index.build_index`.
+        index_kwargs (`dict`, *optional*):
+            Arguments of the `IVFIndex`, e.g. `nlist` or `nprobe`.
+        track_recall (`bool`):
+            Compare every retrieval with the dense attention of the same heads, see `recall_summary`.
+    """
+
+    def __init__(
+        self,
+        max_length: int,
+        sparse_heads: Optional[List[List[int]]] = None,
+        topk: int = 64,
+        window_size: int = 128,
+        index_kind: str = "ivf",
+        index_kwargs: Optional[Dict[str, Any]] = None,
+        track_recall: bool = False,
+    ) -> None:
+        super().__init__(max_length)
+        self.sparse_heads: Optional[Dict[int, set]] = None
+        if sparse_heads is not None:
+            self.sparse_heads = defaultdict(set)
+            for layer_idx, head_idx in sparse_heads:
+                self.sparse_heads[int(layer_idx)].add(int(head_idx))
+        self.topk = topk
+        self.window_size = window_size
+        self.index_kind = index_kind
+        self.index_kwargs = index_kwargs or {}
+        self.track_recall = track_recall
+        self.indexes: Dict[int, Any] = {}
+        self.indexed_lengths: Dict[int, int] = {}
+        # per layer: (row of the kv head in the index, rank among the sparse query heads of that kv head) of every
+        # sparse query head, the layout of the queries searched in one call
+        self.query_slots: Dict[int, Tuple[torch.LongTensor, torch.LongTensor]] = {}
+        self.kv_runs: Dict[int, List[Tuple[int, int]]] = {}
+        self.recall_stats: Dict[str, float] = defaultdict(float)
+
+    def layer_heads(self, layer_idx: int, num_heads: int) -> List[int]:
+        if self.sparse_heads is None:
+            return list(range(num_heads))
+        return sorted(self.sparse_heads.get(layer_idx, ()))
+
+    def dense_kv_runs(self, layer_idx: int, num_heads: int, num_key_value_heads: int) -> List[Tuple[int, int]]:
+        """
+        `[start, end)` runs of consecutive kv heads of layer `layer_idx` serving at least one query head that is not
+        sparse. Each run is a view on the cache, so the dense kernel skips the sparse kv heads without copying the
+        others.
+        """
+        if layer_idx not in self.kv_runs:
+            sparse = set(self.layer_heads(layer_idx, num_heads))
+            num_key_value_groups = num_heads // num_key_value_heads
+            runs = []
+            for kv_head in range(num_key_value_heads):
+                group = range(kv_head * num_key_value_groups, (kv_head + 1) * num_key_value_groups)
+                if all(h in sparse for h in group):
+                    continue
+                if runs and runs[-1][1] == kv_head:
+                    runs[-1] = (runs[-1][0], kv_head + 1)
+                else:
+                    runs.append((kv_head, kv_head + 1))
+            self.kv_runs[layer_idx] = runs
+        return self.kv_runs[layer_idx]
+
+    def build_index(self, layer_idx: int, heads: List[int], num_key_value_groups: int, indexed_length: int) -> None:
+        """
+        Indexes the first `indexed_length` cached keys of the kv heads serving the query heads `heads` of layer
+        `layer_idx`.
+        """
+        keys = self.key_cache[layer_idx][0, :, :indexed_length]
+        kv_heads = sorted({h // num_key_value_groups for h in heads})
+        self.indexes[layer_idx] = build_index(keys, self.index_kind, heads=kv_heads, **self.index_kwargs)
+        rows, ranks, seen = [], [], defaultdict(int)
+        for h in heads:
+            rows.append(kv_heads.index(h // num_key_value_groups))
+            ranks.append(seen[rows[-1]])
+            seen[rows[-1]] += 1
+        self.query_slots[layer_idx] = (torch.tensor(rows, device=keys.device), torch.tensor(ranks, device=keys.device))
+        self.indexed_lengths[layer_idx] = indexed_length
+
+    def search(self, query: torch.Tensor, layer_idx: int) -> torch.LongTensor:
+        """
+        Top-k prompt key ids `(len(heads), q_len, topk)` of the `(len(heads), q_len, head_dim)` queries of the sparse
+        heads of layer `layer_idx`. Query heads sharing a kv head are stacked on its row of the index, rows with
+        fewer sparse query heads are padded with zero queries.
+        """
+        rows, ranks = self.query_slots[layer_idx]
+        num_rows, num_slots = len(self.indexes[layer_idx].heads), int(ranks.max()) + 1
+        q_len, head_dim = query.shape[1], query.shape[2]
+        stacked = query.new_zeros(num_rows, num_slots, q_len, head_dim)
+        stacked[rows, ranks] = query
+        ids = self.indexes[layer_idx].search(stacked.view(num_rows, num_slots * q_len, head_dim), self.topk)
+        return ids.view(num_rows, num_slots, q_len, -1)[rows, ranks]
+
+    def sparse_attention(
+        self, query_states: torch.Tensor, layer_idx: int
+    ) -> Optional[Tuple[torch.LongTensor, torch.Tensor]]:
+        """
+        Attention output of the sparse heads of layer `layer_idx`, once the states of the step have been cached with
+        `update`. Builds the index of the layer at its first call.
+
+        Parameters:
+            query_states (`torch.Tensor`):
+                `(1, num_heads, q_len, head_dim)` queries of the step, after the rotary embedding.
+
+        Returns:
+            The query heads attending sparsely and their `(1, len(heads), q_len, head_dim)` attention output, or None
+            when no head of the layer attends sparsely.
+        """
+        bsz, num_heads, q_len, head_dim = query_states.shape
+        if bsz != 1:
+            raise ValueError(f"SparseKVCache supports batch size 1 only, got {bsz}")
+        heads = self.layer_heads(layer_idx, num_heads)
+        if not heads:
+            return None
+        keys, values = self.key_cache[layer_idx][0], self.value_cache[layer_idx][0]
+        num_key_value_groups = num_heads // keys.shape[0]
+        if layer_idx not in self.indexes:
+            self.build_index(layer_idx, heads, num_key_value_groups, keys.shape[1] - q_len)
+
+        device = query_states.device
+        head_index = torch.tensor(heads, dtype=torch.long, device=device)
+        kv_index = head_index // num_key_value_groups
+        total_length = keys.shape[1]
+        local_start = min(self.indexed_lengths[layer_idx], max(0, total_length - self.window_size))
+
+        query = query_states[0, head_index]
+        ids = self.search(query, layer_idx)
+        # padding (-1) and positions the local window covers anyway are not attended as retrieved keys
+        retrieved = (ids >= 0) & (ids < local_start)
+        safe_ids = ids.clamp(min=0)
+        scale = 1 / math.sqrt(head_dim)
+
+        retrieved_scores = torch.einsum("nqd,nqkd->nqk", query, keys[kv_index[:, None, None], safe_ids]) * scale
+        retrieved_scores = retrieved_scores.masked_fill(~retrieved, float("-inf"))
+        local_scores = torch.einsum("nqd,nld->nql", query, keys[kv_index, local_start:]) * scale
+        # causal among the new positions
+        positions = torch.arange(local_start, total_length, device=device)
+        last_position = total_length - q_len + torch.arange(q_len, device=device)
+        local_scores = local_scores.masked_fill(positions[None, :] > last_position[:, None], float("-inf"))
+
+        weights = torch.softmax(torch.cat([retrieved_scores, local_scores], dim=-1), dim=-1, dtype=torch.float32)
+        weights = weights.to(query.dtype)
+        num_retrieved = ids.shape[-1]
+        attn_output = (
+            torch.einsum("nqk,nqkd->nqd", weights[..., :num_retrieved], values[kv_index[:, None, None], safe_ids])
+            + torch.einsum("nql,nld->nqd", weights[..., num_retrieved:], values[kv_index, local_start:])
+        )
+        if self.track_recall:
+            self._track_recall(query, keys[kv_index], ids, retrieved, local_start, layer_idx, scale)
+        return head_index, attn_output[None]
+
+    def _track_recall(self, query, keys, ids, retrieved, local_start, layer_idx, scale):
+        """
+        Recall of the retrieved ids among the exact top-k prompt keys, and share of the dense attention weights on
+        the positions the sparse heads attend.
+        """
+        q_len, total_length = query.shape[1], keys.shape[1]
+        scores = torch.einsum("nqd,ntd->nqt", query, keys).float() * scale
+        last_position = total_length - q_len + torch.arange(q_len, device=query.device)
+        causal = torch.arange(total_length, device=query.device)[None, :] > last_position[:, None]
+        probs = torch.softmax(scores.masked_fill(causal, float("-inf")), dim=-1)
+
+        indexed_length = self.indexed_lengths[layer_idx]
+        exact = scores[..., :indexed_length].topk(min(self.topk, indexed_length), dim=-1).indices
+        hits = (ids[..., :, None] == exact[..., None, :]).any(dim=-1).sum(dim=-1)
+        attended_mass = probs[..., local_start:].sum(dim=-1)
+        attended_mass += probs.gather(-1, ids.clamp(min=0)).masked_fill(~retrieved, 0).sum(dim=-1)
+
+        self.recall_stats["recall"] += (hits.float() / max(exact.shape[-1], 1)).sum().item()
+        self.recall_stats["attention_mass"] += attended_mass.sum().item()
+        self.recall_stats["count"] += hits.numel()
+
+    def recall_summary(self) -> Dict[str, float]:
+        """
+        Mean recall@topk of the index against exact search and mean dense attention mass covered by the attended
+        positions, over every sparse head and decode step (`track_recall` only).
+        """
+        count = self.recall_stats["count"]
+        if not count:
+            return {"recall": None, "attention_mass": None, "count": 0}
+        return {"recall": self.recall_stats["recall"] / count,
+                "attention_mass": self.recall_stats["attention_mass"] / count, "count": int(count)}
+
+
+class PrefixKVCache:
+    """
+    Keeps the `StaticSlabCache` of the previous prompt and lets the next prompt resume prefill after the prefix the two
+    share, e.g. the haystack before the needle when sweeping depths.
+
+    The prefixes held by the slab are indexed every `interval` tokens by a chained hash of their token ids. A new prompt
+    walks its own checkpoints, truncates the slab after the longest one it finds and only the suffix is prefilled,
+    overwriting the rest of the slab in place. Keys and values of a prefix only depend on the prefix (causal attention,
+    absolute positions), so the resumed cache is the one a full prefill would produce.
+
+    Parameters:
+        interval (`int`):
+            Distance in tokens between two checkpoints, the reusable prefix is rounded down to a multiple of it.
+    """
+
+    def __init__(self, interval: int = 256) -> None:
+        self.interval = interval
+        self.cache: Optional[StaticSlabCache] = None
+        self.checkpoints: Dict[int, int] = {}
+
+    def checkpoint_hashes(self, token_ids: List[int]) -> List[int]:
+        """
+        Chained hashes of `token_ids[:interval]`, `token_ids[:2 * interval]`, ... leaving at least one token after the
+        last checkpoint, so a resumed prefill is never empty.
+        """
+        hashes, prefix_hash = [], 0
+        for end in range(self.interval, len(token_ids), self.interval):
+            prefix_hash = hash((prefix_hash, tuple(token_ids[end - self.interval:end])))
+            hashes.append(prefix_hash)
+        return hashes
+
+    def resume(self, token_ids: List[int], max_length: int) -> Tuple[StaticSlabCache, int]:
+        """
+        Prepares the cache for prefilling `token_ids` and returns it with the number of leading tokens already cached.
+        The checkpoints of `token_ids` replace the previous ones, so the caller must prefill `token_ids[reused:]` into
+        the returned cache before the next call.
+
+        Parameters:
+            token_ids (`List[int]`):
+                Token ids of the prompt part that is prefilled.
+            max_length (`int`):
+                Number of positions the cache needs, prompt plus decoded tokens.
+        """
+        hashes = self.checkpoint_hashes(token_ids)
+        reused = 0
+        if self.cache is not None and self.cache.max_length >= max_length:
+            for k in range(len(hashes) - 1, -1, -1):
+                if self.checkpoints.get(hashes[k]) == (k + 1) * self.interval:
+                    reused = (k + 1) * self.interval
+                    break
+            self.cache.truncate(reused)
+        else:
+            self.cache = StaticSlabCache(max_length)
+        self.checkpoints = {prefix_hash: (k + 1) * self.interval for k, prefix_hash in enumerate(hashes)}
+        return self.cache, reused
+
+
+# storage tiers of `HeterogeneousMemory`, from the most to the least precise
+MEMORY_TIERS = ("full", "int8", "window")
+
+
+def quantize_states(states: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    Symmetric int8 quantization of `(batch, heads, seq_len, head_dim)` states, one scale per head and position.
+
+    Returns:
+        `(int8 states, scales)`, the scales of shape `(batch, heads, seq_len, 1)` in the dtype of `states`.
+    """
+    scales = states.abs().amax(dim=-1, keepdim=True).clamp(min=1e-6) / 127
+    return torch.round(states / scales).clamp(-127, 127).to(torch.int8), scales
+
+
+def _scale_positions(weights: torch.Tensor, scales: torch.Tensor) -> torch.Tensor:
+    """
+    Multiplies `(batch, num_heads, q_len, kv_len)` scores or weights by the `(batch, num_key_value_heads, kv_len, 1)`
+    per position scales of the kv head of each query head.
+    """
+    bsz, num_heads, q_len, kv_len = weights.shape
+    grouped = weights.reshape(bsz, scales.shape[1], num_heads // scales.shape[1] * q_len, kv_len)
+    return (grouped * scales.transpose(2, 3)).view(bsz, num_heads, q_len, kv_len)
+
+
+class HeterogeneousMemory(Cache):
+    """
+    A cache that keeps each kv head of each layer in one of three storage tiers:
+        full    every position, in the model dtype
+        int8    every position, in int8 with one scale per head and position
+        window  the first `sink_size` and the last `window_size` positions, in the model dtype
+    so the far context is only paid for by the heads that read it, e.g. the retrieval heads.
+
+    The prompt is prefilled with dense attention: `update` caches the states in the tier of their kv head and returns
+    them as they are. Once a layer is cached its attention forward calls `update_and_attend` instead, which attends the
+    query heads of each tier over the positions their kv head keeps. Keys are cached after the rotary embedding, so
+    the kept positions keep their original positions, and `full_memory_length` (the number of positions seen) gives
+    the positions of the next tokens with `attn_mode="heterogeneous"`.
+
+    Like `StaticSlabCache`, nothing is reallocated while decoding: the full and int8 heads of a layer get slabs of
+    prompt + `max_new_tokens` positions, the window heads a ring buffer of `sink_size + window_size` slots whose
+    recent slots are overwritten in turn. Attention does not depend on the order of the cached positions, so the ring
+    is attended as it is. Pad positions of the flash `attention_mask` are masked out; the sinks are the first
+    positions of the padded batch, so those of a left padded row are pads and it attends its recent window only.
+
+    Parameters:
+        head_tiers (`Dict[Tuple[int, int], str]`):
+            Tier ("full", "int8" or "window") of `(layer, head)` query heads. A kv head gets the most precise tier of
+            its query heads, heads not in the map count as `default_tier`.
+        num_key_value_groups (`int`):
+            Number of query heads sharing a kv head in the model.
+        sink_size (`int`):
+            Number of leading positions kept for the window heads.
+        window_size (`int`):
+            Number of most recent positions kept for the window heads.
+        max_new_tokens (`int`):
+            Number of positions reserved after the prompt in the slabs of the full and int8 heads.
+        default_tier (`str`):
+            Tier of the query heads missing from `head_tiers`.
+    """
+
+    def __init__(
+        self,
+        head_tiers: Dict[Tuple[int, int], str],
+        num_key_value_groups: int = 1,
+        sink_size: int = 4,
+        window_size: int = 256,
+        max_new_tokens: int = 256,
+        default_tier: str = "window",
+    ) -> None:
+        for tier in set(head_tiers.values()) | {default_tier}:
+            if tier not in MEMORY_TIERS:
+                raise ValueError(f"Unknown memory tier {tier}, must be one of {MEMORY_TIERS}.")
+        self.head_tiers = {(int(layer_idx), int(head_idx)): tier for (layer_idx, head_idx), tier in head_tiers.items()}
+        self.num_key_value_groups = num_key_value_groups
+        self.sink_size = sink_size
+        self.window_size = window_size
+        self.max_new_tokens = max_new_tokens
+        self.default_tier = default_tier
+        # per layer: kv head indices of each tier and the query heads attending them
+        self.head_groups: List[List[Tuple[torch.LongTensor, torch.LongTensor]]] = []
+        # per layer, one entry per tier: full slab, int8 slab (scales kept apart) and ring buffer
+        self.key_cache: List[List[torch.Tensor]] = []
+        self.value_cache: List[List[torch.Tensor]] = []
+        self.key_scales: List[torch.Tensor] = []
+        self.value_scales: List[torch.Tensor] = []
+        # per layer: position held by every ring slot
+        self.ring_positions: List[torch.LongTensor] = []
+        self.lengths: List[int] = []
+        self.seen_tokens = 0
+
+    @classmethod
+    def from_head_ranking(cls, full_heads: List[List[int]], int8_heads: Optional[List[List[int]]] = None, **kwargs):
+        """
+        Full cache for the `[layer, head]` heads `full_heads`, int8 for `int8_heads` and a window for all others,
+        e.g. from the top heads of head_score/<model>.json.
+        """
+        head_tiers = {(layer_idx, head_idx): "int8" for layer_idx, head_idx in int8_heads or []}
+        head_tiers.update({(layer_idx, head_idx): "full" for layer_idx, head_idx in full_heads})
+        return cls(head_tiers, **kwargs)
+
+    @property
+    def full_memory_length(self) -> int:
+        """Number of positions seen, the position of the next token."""
+        return self.seen_tokens
+
+    def kv_head_tier(self, layer_idx: int, kv_head: int) -> str:
+        tiers = [self.head_tiers.get((layer_idx, kv_head * self.num_key_value_groups + g), self.default_tier)
+                 for g in range(self.num_key_value_groups)]
+        return min(tiers, key=MEMORY_TIERS.index)
+
+    def _ring_slots(self, start: int, end: int, device) -> Tuple[torch.LongTensor, torch.LongTensor]:
+        """
+        Positions of `[start, end)` still kept once `end` positions are cached, and their ring slots: the sinks keep
+        the first slots, recent position `p` goes to slot `sink_size + (p - sink_size) % window_size`.
+        """
+        sinks = torch.arange(start, max(start, min(end, self.sink_size)), device=device)
+        recent = torch.arange(max(start, end - self.window_size, self.sink_size), end, device=device)
+        positions = torch.cat([sinks, recent])
+        slots = torch.where(positions < self.sink_size, positions,
+                            self.sink_size + (positions - self.sink_size) % max(self.window_size, 1))
+        return positions, slots
+
+    def _write(self, layer_idx: int, key_states: torch.Tensor, value_states: torch.Tensor) -> None:
+        """
+        Writes the states of the new positions `[lengths[layer_idx], ...)` into the slabs and the ring of the layer.
+        """
+        start = self.lengths[layer_idx]
+        end = start + key_states.shape[-2]
+        for group, (kv_index, _) in enumerate(self.head_groups[layer_idx]):
+            if kv_index.numel() == 0:
+                continue
+            keys, values = self.key_cache[layer_idx][group], self.value_cache[layer_idx][group]
+            new_keys, new_values = key_states[:, kv_index], value_states[:, kv_index]
+            if MEMORY_TIERS[group] == "window":
+                positions, slots = self._ring_slots(start, end, key_states.device)
+                keys.index_copy_(2, slots, new_keys.index_select(2, positions - start))
+                values.index_copy_(2, slots, new_values.index_select(2, positions - start))
+                self.ring_positions[layer_idx].index_copy_(0, slots, positions)
+                continue
+            if end > keys.shape[-2]:
+                raise ValueError(
+                    f"{type(self).__name__} reserved {self.max_new_tokens} positions after the prompt, layer "
+                    f"{layer_idx} needs more, raise max_new_tokens"
+                )
+            if MEMORY_TIERS[group] == "int8":
+                (new_keys, key_scales), (new_values, value_scales) = quantize_states(new_keys), quantize_states(new_values)
+                self.key_scales[layer_idx][:, :, start:end] = key_scales
+                self.value_scales[layer_idx][:, :, start:end] = value_scales
+            keys[:, :, start:end] = new_keys
+            values[:, :, start:end] = new_values
+        self.lengths[layer_idx] = end
+
+    def update(
+        self,
+        key_states: torch.Tensor,
+        value_states: torch.Tensor,
+        layer_idx: int,
+        cache_kwargs: Optional[Dict[str, Any]] = None,
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        Caches the prompt states of layer `layer_idx` in the tier of each kv head and returns them as they are for the
+        dense prefill attention.
+        """
+        if len(self.lengths) != layer_idx:
+            raise ValueError(
+                f"{type(self).__name__}.update prefills layer {layer_idx} once, in layer order; the next steps go "
+                "through update_and_attend"
+            )
+        if layer_idx == 0:
+            self.seen_tokens += key_states.shape[-2]
+
+        bsz, num_key_value_heads, prompt_len, head_dim = key_states.shape
+        device = key_states.device
+        tiers = [self.kv_head_tier(layer_idx, h) for h in range(num_key_value_heads)]
+        groups = []
+        for tier in MEMORY_TIERS:
+            kv_index = torch.tensor([h for h in range(num_key_value_heads) if tiers[h] == tier], dtype=torch.long, device=device)
+            q_index = (kv_index[:, None] * self.num_key_value_groups
+                       + torch.arange(self.num_key_value_groups, device=device)).flatten()
+            groups.append((kv_index, q_index))
+        self.head_groups.append(groups)
+
+        capacity = prompt_len + self.max_new_tokens
+        sizes = {"full": capacity, "int8": capacity, "window": self.sink_size + self.window_size}
+        keys, values = [], []
+        for tier, (kv_index, _) in zip(MEMORY_TIERS, groups):
+            dtype = torch.int8 if tier == "int8" else key_states.dtype
+            keys.append(key_states.new_empty(bsz, len(kv_index), sizes[tier], head_dim, dtype=dtype))
+            values.append(value_states.new_empty(bsz, len(kv_index), sizes[tier], value_states.shape[-1], dtype=dtype))
+        self.key_cache.append(keys)
+        self.value_cache.append(values)
+        num_int8 = len(groups[MEMORY_TIERS.index("int8")][0])
+        self.key_scales.append(key_states.new_empty(bsz, num_int8, capacity, 1))
+        self.value_scales.append(value_states.new_empty(bsz, num_int8, capacity, 1))
+        self.ring_positions.append(torch.zeros(sizes["window"], dtype=torch.long, device=device))
+        self.lengths.append(0)
+        self._write(layer_idx, key_states, value_states)
+        return key_states, value_states
+
+    def _cached_states(self, layer_idx: int, group: int):
+        """
+        Filled part of the slab or ring of `group` in layer `layer_idx`, the positions it holds and, for the int8
+        tier, the key and value scales.
+        """
+        length = self.lengths[layer_idx]
+        keys, values = self.key_cache[layer_idx][group], self.value_cache[layer_idx][group]
+        if MEMORY_TIERS[group] == "window":
+            filled = min(length, keys.shape[-2])
+            return keys[:, :, :filled], values[:, :, :filled], self.ring_positions[layer_idx][:filled], None, None
+        positions = torch.arange(length, device=keys.device)
+        if MEMORY_TIERS[group] == "int8":
+            return (keys[:, :, :length], values[:, :, :length], positions,
+                    self.key_scales[layer_idx][:, :, :length], self.value_scales[layer_idx][:, :, :length])
+        return keys[:, :, :length], values[:, :, :length], positions, None, None
+
+    def _attend(
+        self,
+        query: torch.Tensor,
+        keys: torch.Tensor,
+        values: torch.Tensor,
+        new_keys: torch.Tensor,
+        new_values: torch.Tensor,
+        padding: Optional[torch.BoolTensor],
+        key_scales: Optional[torch.Tensor] = None,
+        value_scales: Optional[torch.Tensor] = None,
+    ) -> torch.Tensor:
+        """
+        Attention of `query` over the cached `keys` / `values` followed by the new positions, causal among the new
+        positions. The two parts are scored and summed separately, so the cache is never concatenated with the new
+        states. `padding` is the `(batch, cached + new)` mask of the pad positions, or None. Int8 keys and values are
+        cast as they are, their per position scales are applied to the scores and the weights instead of the states.
+        """
+        q_len, num_cached = query.shape[2], keys.shape[2]
+        scale = 1 / math.sqrt(query.shape[-1])
+        if key_scales is None:
+            cached_scores = grouped_attention_scores(query, keys)
+        else:
+            # int8 dot products overflow half precision before their scales apply
+            cached_scores = grouped_attention_scores(query.float(), keys.float())
+            cached_scores = _scale_positions(cached_scores, key_scales.float()).to(query.dtype)
+        scores = torch.cat([cached_scores, grouped_attention_scores(query, new_keys)], dim=-1) * scale
+        if padding is not None:
+            scores = scores.masked_fill(padding[:, None, None, :], float("-inf"))
+        if q_len > 1:
+            # causal among the new positions, every cached position is in their past
+            causal = torch.ones(q_len, q_len, dtype=torch.bool, device=scores.device).triu(1)
+            scores[..., num_cached:] = scores[..., num_cached:].masked_fill(causal, float("-inf"))
+        weights = torch.softmax(scores, dim=-1, dtype=torch.float32).to(query.dtype)
+        cached_weights = weights[..., :num_cached]
+        if value_scales is not None:
+            cached_weights = _scale_positions(cached_weights, value_scales)
+        return (grouped_attention_output(cached_weights, values.to(query.dtype))
+                + grouped_attention_output(weights[..., num_cached:], new_values))
+
+    def update_and_attend(
+        self,
+        query_states: torch.Tensor,
+        key_states: torch.Tensor,
+        value_states: torch.Tensor,
+        layer_idx: int,
+        attention_mask: Optional[torch.Tensor] = None,
+    ) -> torch.Tensor:
+        """
+        Appends the new states of layer `layer_idx` and returns the attention output of `query_states`, each query head
+        attending the positions its kv head keeps. The new positions are attended in full precision and quantized
+        for the int8 heads once written.
+
+        Parameters:
+            query_states (`torch.Tensor`):
+                `(batch, num_heads, q_len, head_dim)`, after the rotary embedding.
+            key_states, value_states (`torch.Tensor`):
+                `(batch, num_key_value_heads, q_len, head_dim)` states of the new positions.
+            attention_mask (`torch.Tensor`, *optional*):
+                `(batch, cached + q_len)` padding mask of the flash attention path, 0 at the pad positions.
+
+        Returns:
+            `torch.Tensor` of shape `(batch, num_heads, q_len, head_dim)`.
+        """
+        if query_states.shape[1] != key_states.shape[1] * self.num_key_value_groups:
+            raise ValueError(
+                f"{type(self).__name__} was built for {self.num_key_value_groups} query heads per kv head, got "
+                f"{query_states.shape[1]} query heads for {key_states.shape[1]} kv heads"
+            )
+        length, q_len = self.lengths[layer_idx], query_states.shape[2]
+        padding = None
+        if attention_mask is not None:
+            if attention_mask.shape[-1] != length + q_len:
+                raise ValueError(
+                    f"attention_mask covers {attention_mask.shape[-1]} positions, layer {layer_idx} has {length} cached "
+                    f"and {q_len} new ones"
+                )
+            padding = attention_mask == 0
+        if layer_idx == 0:
+            self.seen_tokens += q_len
+
+        attn_output = torch.empty_like(query_states)
+        for group, (kv_index, q_index) in enumerate(self.head_groups[layer_idx]):
+            if kv_index.numel() == 0:
+                continue
+            keys, values, positions, key_scales, value_scales = self._cached_states(layer_idx, group)
+            group_padding = None
+            if padding is not None:
+                group_padding = torch.cat([padding[:, positions], padding[:, length:]], dim=-1)
+            attn_output[:, q_index] = self._attend(query_states[:, q_index], keys, values, key_states[:, kv_index],
+                                                   value_states[:, kv_index], group_padding, key_scales, value_scales)
+        self._write(layer_idx, key_states, value_states)
+        return attn_output
+
+    def get_seq_length(self, layer_idx: Optional[int] = 0) -> int:
+        """Number of positions seen by layer `layer_idx`, including the ones dropped for the window heads."""
+        if len(self.lengths) <= layer_idx:
+            return 0
+        return self.lengths[layer_idx]
+
+    def get_max_length(self) -> Optional[int]:
+        return None
+
+    def tier_memory_bytes(self) -> Dict[str, int]:
+        """Bytes allocated for the cached keys and values of each tier, the int8 scales included."""
+        tiers = dict.fromkeys(MEMORY_TIERS, 0)
+        for layer_idx in range(len(self.lengths)):
+            for group, tier in enumerate(MEMORY_TIERS):
+                for states in (self.key_cache[layer_idx][group], self.value_cache[layer_idx][group]):
+                    tiers[tier] += states.numel() * states.element_size()
+            for scales in (self.key_scales[layer_idx], self.value_scales[layer_idx]):
+                tiers["int8"] += scales.numel() * scales.element_size()
+        return tiers
+
+    def memory_bytes(self) -> int:
+        """Bytes allocated for the cached keys and values."""
+        return sum(self.tier_memory_bytes().values())
+
+    def dense_memory_bytes(self) -> int:
+        """Bytes a `DynamicCache` would hold for the same positions."""
+        total = 0
+        for layer_idx, (full, _, _) in enumerate(self.key_cache):
+            num_key_value_heads = sum(kv_index.numel() for kv_index, _ in self.head_groups[layer_idx])
+            bsz, head_dim, element_size = full.shape[0], full.shape[-1], full.element_size()
+            total += 2 * bsz * num_key_value_heads * self.lengths[layer_idx] * head_dim * element_size
+        return total
+
+    def reorder_cache(self, beam_idx: torch.LongTensor):
+        raise NotImplementedError(f"{type(self).__name__} does not support beam search.")
+
+
+class RetrievalHeadKVCache(HeterogeneousMemory):
+    """
+    The two tier `HeterogeneousMemory` of the retrieval heads: every position only for the kv heads of the retrieval
+    heads, and the first `sink_size` plus the last `window_size` positions for all other kv heads, so the cache of a
+    long prompt shrinks to roughly the share of kv heads serving a retrieval head.
+
+    Parameters:
+        retrieval_heads (`List[List[int]]`):
+            `[layer, head]` query heads whose kv head keeps the full cache, e.g. the top heads of
+            head_score/<model>.json.
+        num_key_value_groups, sink_size, window_size, max_new_tokens:
+            See `HeterogeneousMemory`.
+    """
+
+    def __init__(
+        self,
+        retrieval_heads: List[List[int]],
+        num_key_value_groups: int = 1,
+        sink_size: int = 4,
+        window_size: int = 256,
+        max_new_tokens: int = 256,
+    ) -> None:
+        super().__init__({(layer_idx, head_idx): "full" for layer_idx, head_idx in retrieval_heads},
+                         num_key_value_groups, sink_size, window_size, max_new_tokens)
@@ -0,0 +1,126 @@
+import math
+
+import torch
+
+
+class FlatIndex:
+    """
+    Exact maximum inner product search over the keys of several kv heads, on the device of the keys.
+
+    Args:
+        keys (`torch.Tensor`): `(num_key_value_heads, num_keys, head_dim)` keys, e.g. a view on the cache of a layer.
+        heads (`List[int]`, *optional*): kv heads searched, all when None.
+    """
+
+    def __init__(self, keys, heads=None):
+        self.keys = keys
+        self.heads = None if heads is None else torch.as_tensor(heads, dtype=torch.long, device=keys.device)
+
+    def __len__(self):
+        return self.keys.shape[1]
+
+    def search(self, queries, k):
+        """
+        Ids of the `k` keys with the largest inner product with every query, best first, as a `(len(heads),
+        num_queries, k)` tensor for `(len(heads), num_queries, head_dim)` queries, padded with -1 when there are fewer
+        keys. Searching a subset of the heads gathers their keys.
+        """
+        keys = self.keys if self.heads is None else self.keys[self.heads]
+        return top_k_ids(torch.matmul(queries.to(keys.dtype), keys.transpose(1, 2)), k)
+
+
+class IVFIndex:
+    """
+    Inverted file index for maximum inner product search, batched over kv heads: the keys of every head are clustered
+    with k-means into `nlist` lists and a query only scores the keys of the `nprobe` lists whose centroids have the
+    largest inner product with it. The lists hold key ids only, candidates are gathered from `keys` at search time.
+
+    Args:
+        keys (`torch.Tensor`): `(num_key_value_heads, num_keys, head_dim)` keys, e.g. a view on the cache of a layer.
+        heads (`List[int]`, *optional*): kv heads indexed, all when None.
+        nlist (`int`, *optional*): number of lists per head, `sqrt(num_keys)` when None.
+        nprobe (`int`): number of lists scanned per query.
+        niter (`int`): k-means iterations.
+        max_train_points (`int`): keys per list sampled to train the centroids, like faiss.
+        seed (`int`): seed of the training sample, whose first keys initialize the centroids.
+    """
+
+    def __init__(self, keys, heads=None, nlist=None, nprobe=8, niter=10, max_train_points=256, seed=0):
+        device = keys.device
+        num_keys = keys.shape[1]
+        self.keys = keys
+        self.heads = torch.arange(keys.shape[0], device=device) if heads is None else torch.as_tensor(heads, dtype=torch.long, device=device)
+        self.nlist = min(nlist or max(1, int(math.sqrt(num_keys))), num_keys)
+        self.nprobe = min(nprobe, self.nlist)
+        num_heads = len(self.heads)
+
+        generator = torch.Generator(device=device).manual_seed(seed)
+        sample = torch.randperm(num_keys, generator=generator, device=device)[:self.nlist * max_train_points]
+        train = keys[self.heads[:, None], sample[None, :]].float()
+        self.centroids = train[:, :self.nlist].clone()
+        for _ in range(niter):
+            assign = self.assign(train)
+            sums = torch.zeros_like(self.centroids).scatter_add_(1, assign[..., None].expand_as(train), train)
+            counts = torch.zeros(num_heads, self.nlist, device=device).scatter_add_(1, assign, torch.ones_like(assign, dtype=torch.float))
+            # empty lists keep their centroid
+            self.centroids = torch.where(counts[..., None] > 0, sums / counts.clamp(min=1)[..., None], self.centroids)
+
+        # list_ids[h, l, i] is the i-th key id of list l of head h, -1 past the end of the list
+        assign = torch.cat([self.assign(keys[self.heads, start:start + 65536])
+                            for start in range(0, num_keys, 65536)], dim=-1)
+        order = assign.argsort(dim=-1, stable=True)
+        sorted_assign = assign.gather(-1, order)
+        counts = torch.zeros(num_heads, self.nlist, dtype=torch.long, device=device).scatter_add_(1, assign, torch.ones_like(assign))
+        starts = counts.cumsum(dim=-1) - counts
+        rank = torch.arange(num_keys, device=device) - starts.gather(-1, sorted_assign)
+        self.list_ids = torch.full((num_heads, self.nlist, int(counts.max())), -1, dtype=torch.long, device=device)
+        self.list_ids[torch.arange(num_heads, device=device)[:, None], sorted_assign, rank] = order
+
+    def __len__(self):
+        return self.keys.shape[1]
+
+    def assign(self, keys):
+        """
+        Nearest centroid (L2) of every key of `(len(heads), n, head_dim)` keys, scored as `x.c - |c|^2 / 2`.
+        """
+        half_norms = 0.5 * (self.centroids ** 2).sum(dim=-1)
+        return (torch.matmul(keys.float(), self.centroids.transpose(1, 2)) - half_norms[:, None, :]).argmax(dim=-1)
+
+    def search(self, queries, k):
+        """
+        Ids of the approximate top `k` keys by inner product for every query, best first, as a `(len(heads),
+        num_queries, k)` tensor for `(len(heads), num_queries, head_dim)` queries. Rows with fewer than `k`
+        candidates are padded with -1.
+        """
+        num_heads = len(self.heads)
+        probes = torch.matmul(queries.float(), self.centroids.transpose(1, 2)).topk(self.nprobe, dim=-1).indices
+        head_index = torch.arange(num_heads, device=queries.device)[:, None, None]
+        candidates = self.list_ids[head_index, probes].flatten(2)
+        candidate_keys = self.keys[self.heads[:, None, None], candidates.clamp(min=0)]
+        scores = torch.einsum("hqd,hqcd->hqc", queries.to(candidate_keys.dtype), candidate_keys)
+        best = top_k_ids(scores, k, valid=candidates >= 0)
+        return torch.where(best >= 0, candidates.gather(-1, best.clamp(min=0)), -1)
+
+
+def top_k_ids(scores, k, valid=None):
+    """
+    Ids of the `k` largest entries of the last dim of `scores`, best first, padded with -1 to `k` columns. Entries
+    where `valid` is False are never returned.
+    """
+    if valid is not None:
+        scores = scores.masked_fill(~valid, float("-inf"))
+    top = scores.topk(min(k, scores.shape[-1]), dim=-1)
+    ids = top.indices.masked_fill(top.values == float("-inf"), -1)
+    return torch.nn.functional.pad(ids, (0, k - ids.shape[-1]), value=-1)
+
+
+def build_index(keys, kind="ivf", heads=None, **kwargs):
+    """
+    `FlatIndex` or `IVFIndex` (`kind` "flat" / "ivf") over the kv heads `heads` of `keys`, `kwargs` go to the
+    `IVFIndex` constructor.
+    """
+    if kind == "flat":
+        return FlatIndex(keys, heads)
+    elif kind == "ivf":
+        return IVFIndex(keys, heads, **kwargs)
+    raise ValueError(f"Unknown index kind {kind}, must be 'flat' or 'ivf'.")
@@ -22,8 +22,6 @@ import math
 import warnings
 from typing import List, Optional, Tuple, Union, Any
 
-#from heterogeneous_memory import HeterogeneousMemory
-
 import numpy as np 
 import torch
 import torch.nn.functional as F
@@ -72,6 +70,15 @@ from transformers.utils import (
 from transformers.utils.import_utils import is_torch_fx_available
 from transformers import LlamaConfig
 
+from .attention_utils import (
+    attention_topk_probe,
+    grouped_attention_output,
+    grouped_attention_scores,
+    mask_heads,
+    set_block_list,
+)
+from .cache_utils import HeterogeneousMemory, SparseKVCache, StaticSlabCache
+
 
 if is_flash_attn_2_available():
     from flash_attn import flash_attn_func, flash_attn_varlen_func
@@ -368,6 +375,8 @@ class LlamaAttention(nn.Module):
         self.k_proj = nn.Linear(self.hidden_size, self.num_key_value_heads * self.head_dim, bias=config.attention_bias)
         self.v_proj = nn.Linear(self.hidden_size, self.num_key_value_heads * self.head_dim, bias=config.attention_bias)
         self.o_proj = nn.Linear(self.num_heads * self.head_dim, self.hidden_size, bias=config.attention_bias)
+        # [batch or 1, num_heads, 1, 1] heads zeroed by the block list, None when no head of the layer is masked
+        self.register_buffer("head_mask", None, persistent=False)
         self._init_rope()
 
     def _init_rope(self):
@@ -500,7 +509,7 @@ class LlamaAttention(nn.Module):
 
         attn_output = attn_output.transpose(1, 2).contiguous()
 
-        attn_output = attn_output.reshape(bsz, q_len, self.hidden_size)
+        attn_output = attn_output.reshape(bsz, q_len, self.num_heads * self.head_dim)
 
         if self.config.pretraining_tp > 1:
             attn_output = attn_output.split(self.hidden_size // self.config.pretraining_tp, dim=2)
@@ -548,7 +557,9 @@ class LlamaFlashAttention2(LlamaAttention):
 
             # overwrite attention_mask with padding_mask
             attention_mask = kwargs.pop("padding_mask")
-        if(output_attentions):
+        # the top-k probe is computed from the flash path itself, no eager fallback needed
+        attention_topk = kwargs.get("attention_topk") if output_attentions else None
+        if output_attentions and not attention_topk:
             _, inspect, attn_weights, _ = self.forward_torch(
                 hidden_states,
                 attention_mask,
@@ -583,6 +594,14 @@ class LlamaFlashAttention2(LlamaAttention):
 
         query_states, key_states = apply_rotary_pos_emb(query_states, key_states, cos, sin, position_ids)
 
+        if isinstance(past_key_value, HeterogeneousMemory) and past_key_value.get_seq_length(self.layer_idx) > 0:
+            # each kv head attends the positions kept by its cache tier: full, int8, or sinks and a recent window
+            attn_output = past_key_value.update_and_attend(
+                mask_heads(query_states, self.head_mask), key_states, value_states, self.layer_idx, attention_mask
+            )
+            attn_output = attn_output.transpose(1, 2).reshape(bsz, q_len, self.num_heads * self.head_dim)
+            return self.o_proj(attn_output), inspect, attn_weights, past_key_value
+
         if past_key_value is not None:
             cache_kwargs = {"sin": sin, "cos": cos}  # Specific to RoPE models
             key_states, value_states = past_key_value.update(key_states, value_states, self.layer_idx, cache_kwargs)
@@ -590,11 +609,13 @@ class LlamaFlashAttention2(LlamaAttention):
         # TODO: These transpose are quite inefficient but Flash Attention requires the layout [batch_size, sequence_length, num_heads, head_dim]. We would need to refactor the KV cache
         # to be able to avoid many of these transpose/reshape/view.
         #### mask head in flash attention 
-        if 'block_list' in kwargs:
-            for h in kwargs['block_list']:
-                if self.layer_idx==h[0]:
-                    query_states[:,h[1], :, :] = 0
-                    #attn_weights[:, h[1], :, :] = 0 
+        query_states = mask_heads(query_states, self.head_mask)
+        if attention_topk:
+            attn_weights = attention_topk_probe(query_states, key_states, attention_topk, attention_mask=attention_mask)
+        sparse = None
+        if kwargs.get("sparse_attention") and isinstance(past_key_value, SparseKVCache) and kv_seq_len > q_len:
+            # the sparse heads attend to their retrieved prompt keys and the local window only
+            sparse = past_key_value.sparse_attention(query_states, self.layer_idx)
         query_states = query_states.transpose(1, 2)
         key_states = key_states.transpose(1, 2)
         value_states = value_states.transpose(1, 2)
@@ -625,11 +646,23 @@ class LlamaFlashAttention2(LlamaAttention):
             key_states = key_states.to(target_dtype)
             value_states = value_states.to(target_dtype)
 
-        attn_output = self._flash_attention_forward(
-            query_states, key_states, value_states, attention_mask, q_len, dropout=dropout_rate
-        )
+        if sparse is None:
+            attn_output = self._flash_attention_forward(
+                query_states, key_states, value_states, attention_mask, q_len, dropout=dropout_rate
+            )
+        else:
+            # dense kernel only over the runs of kv heads with a dense query head, head slices are views on the cache
+            heads, sparse_output = sparse
+            groups = self.num_key_value_groups
+            attn_output = query_states.new_empty(bsz, q_len, self.num_heads, self.head_dim)
+            for start, end in past_key_value.dense_kv_runs(self.layer_idx, self.num_heads, self.num_key_value_heads):
+                attn_output[:, :, start * groups:end * groups] = self._flash_attention_forward(
+                    query_states[:, :, start * groups:end * groups], key_states[:, :, start:end],
+                    value_states[:, :, start:end], attention_mask, q_len, dropout=dropout_rate
+                )
+            attn_output[:, :, heads] = sparse_output.transpose(1, 2).to(attn_output.dtype)
 
-        attn_output = attn_output.reshape(bsz, q_len, self.hidden_size).contiguous()
+        attn_output = attn_output.reshape(bsz, q_len, self.num_heads * self.head_dim).contiguous()
         attn_output = self.o_proj(attn_output)
 
         return attn_output, inspect, attn_weights, past_key_value
@@ -695,17 +728,18 @@ class LlamaFlashAttention2(LlamaAttention):
             if(use_cache):
                 cache_kwargs = {"sin": sin, "cos": cos}  # Specific to RoPE models
                 key_states, value_states = past_key_value.update(key_states, value_states, self.layer_idx, cache_kwargs)
-            else: 
+            elif isinstance(past_key_value, StaticSlabCache):
+                key_states, value_states = past_key_value.lookahead(key_states, value_states, self.layer_idx)
+            else:
                 key_states = torch.cat([past_key_value.key_cache[self.layer_idx], key_states], dim=-2)
                 value_states = torch.cat([past_key_value.value_cache[self.layer_idx], value_states], dim=-2)
 
-        key_states = repeat_kv(key_states, self.num_key_value_groups)
-        value_states = repeat_kv(value_states, self.num_key_value_groups)
+        # keys and values stay grouped, the query heads sharing a kv head are folded together in the matmuls
 
       
         inspect["query"] = query_states
         inspect["key"] = key_states
-        attn_weights = torch.matmul(query_states, key_states.transpose(2, 3)) / math.sqrt(self.head_dim)
+        attn_weights = grouped_attention_scores(query_states, key_states) / math.sqrt(self.head_dim)
         ###write our mask here
         
         
@@ -722,14 +756,11 @@ class LlamaFlashAttention2(LlamaAttention):
                 )
             attn_weights = attn_weights + attention_mask
         ## masking head in normal attention
-        if 'block_list' in kwargs:
-            for h in kwargs['block_list']:
-                if self.layer_idx==h[0]:                   
-                    attn_weights[:, h[1], :, :] = 0 
+        attn_weights = mask_heads(attn_weights, self.head_mask)
         # upcast attention to fp32
         attn_weights = nn.functional.softmax(attn_weights, dim=-1, dtype=torch.float32).to(query_states.dtype)
         attn_weights = nn.functional.dropout(attn_weights, p=self.attention_dropout, training=self.training)
-        attn_output = torch.matmul(attn_weights, value_states)
+        attn_output = grouped_attention_output(attn_weights, value_states)
         inspect["attn_output_before_o_proj"] = attn_output
 
         if attn_output.size() != (bsz, self.num_heads, q_len, self.head_dim):
@@ -740,7 +771,7 @@ class LlamaFlashAttention2(LlamaAttention):
 
         attn_output = attn_output.transpose(1, 2).contiguous()
 
-        attn_output = attn_output.reshape(bsz, q_len, self.hidden_size)
+        attn_output = attn_output.reshape(bsz, q_len, self.num_heads * self.head_dim)
 
         if self.config.pretraining_tp > 1:
             attn_output = attn_output.split(self.hidden_size // self.config.pretraining_tp, dim=2)
@@ -751,6 +782,11 @@ class LlamaFlashAttention2(LlamaAttention):
 
         if not output_attentions:
             attn_weights = None
+        elif kwargs.get("attention_topk"):
+            # capture mode: only keep the top-k key positions of the last query row per head,
+            # so the model never holds (heads, q_len, kv_len) weights for every layer
+            attn_weights = attn_weights[:, :, -1, :].topk(kwargs["attention_topk"], dim=-1).indices
+            inspect = {}
 
         return attn_output, inspect, attn_weights, past_key_value
 
@@ -924,7 +960,7 @@ class LlamaSdpaAttention(LlamaAttention):
         )
 
         attn_output = attn_output.transpose(1, 2).contiguous()
-        attn_output = attn_output.reshape(bsz, q_len, self.hidden_size)
+        attn_output = attn_output.reshape(bsz, q_len, self.num_heads * self.head_dim)
 
         attn_output = self.o_proj(attn_output)
 
@@ -986,7 +1022,8 @@ class LlamaDecoderLayer(nn.Module):
         # Self Attention
         #print("#2", kwargs)
         
-        if(attn_mode == "flash"): 
+        # "heterogeneous" is the flash forward, whose layers attend through the HeterogeneousMemory once it is prefilled
+        if(attn_mode == "flash" or attn_mode == "heterogeneous"): 
             hidden_states, inspect, self_attn_weights, present_key_value = self.self_attn(
                     hidden_states=hidden_states,
                     attention_mask=attention_mask,
@@ -1007,6 +1044,18 @@ class LlamaDecoderLayer(nn.Module):
                     use_cache=use_cache,
                     **kwargs,
                 )
+        elif(attn_mode == "sparse"):
+            # flash attention, except for the sparse heads of a SparseKVCache once it has indexed the prompt
+            hidden_states, inspect, self_attn_weights, present_key_value = self.self_attn(
+                    hidden_states=hidden_states,
+                    attention_mask=attention_mask,
+                    position_ids=position_ids,
+                    past_key_value=past_key_value,
+                    output_attentions=output_attentions,
+                    use_cache=use_cache,
+                    sparse_attention=True,
+                    **kwargs,
+                )
         else: raise ValueError("attention mode %s invalid" % attn_mode)
         hidden_states = residual + hidden_states
 
@@ -1189,7 +1238,8 @@ class LlamaModel(LlamaPreTrainedModel):
         output_attentions: Optional[bool] = None,
         output_hidden_states: Optional[bool] = None,
         return_dict: Optional[bool] = None,
-        block_list: list = None
+        block_list: list = None,
+        attention_topk: Optional[int] = None,
     ) -> Union[Tuple, HeterogeneousMemoryOutput]:
         output_attentions = output_attentions if output_attentions is not None else self.config.output_attentions
         output_hidden_states = (
@@ -1212,6 +1262,8 @@ class LlamaModel(LlamaPreTrainedModel):
         past_key_values_length = 0
         if use_cache:
             if(attn_mode == "heterogeneous"):
+                if not isinstance(past_key_values, HeterogeneousMemory):
+                    raise ValueError("attn_mode heterogeneous needs past_key_values=HeterogeneousMemory(...)")
                 past_key_values_length = past_key_values.full_memory_length
             else:
                 use_legacy_cache = not isinstance(past_key_values, Cache)
@@ -1262,10 +1314,10 @@ class LlamaModel(LlamaPreTrainedModel):
         all_self_attns = () if output_attentions else None
         all_inspect = () if output_attentions else None
         next_decoder_cache = None
-        if block_list:
-            kwargs={"block_list":block_list}
-        else:
-            kwargs={}
+        kwargs = {}
+        set_block_list(self, block_list)
+        if attention_topk:
+            kwargs["attention_topk"] = attention_topk
         
         for decoder_layer in self.layers:
             if output_hidden_states:
@@ -1368,7 +1420,8 @@ class LlamaForCausalLM(LlamaPreTrainedModel):
         output_attentions: Optional[bool] = None,
         output_hidden_states: Optional[bool] = None,
         return_dict: Optional[bool] = None,
-        block_list:list = None
+        block_list: list = None,
+        attention_topk: Optional[int] = None,
     ) -> Union[Tuple, CausalLMOutputWithPast]:
         r"""
         Args:
@@ -1414,7 +1467,8 @@ class LlamaForCausalLM(LlamaPreTrainedModel):
             output_attentions=output_attentions,
             output_hidden_states=output_hidden_states,
             return_dict=return_dict,
-            block_list=block_list
+            block_list=block_list,
+            attention_topk=attention_topk,
         )
 
         hidden_states = outputs[0]
@@ -63,6 +63,15 @@ from transformers.utils import (
 from transformers.utils.import_utils import is_torch_fx_available
 from transformers import LlamaConfig
 
+from .attention_utils import (
+    attention_topk_probe,
+    grouped_attention_output,
+    grouped_attention_scores,
+    mask_heads,
+    set_block_list,
+)
+from .cache_utils import HeterogeneousMemory, StaticSlabCache
+
 
 if is_flash_attn_2_available():
     from flash_attn import flash_attn_func, flash_attn_varlen_func
@@ -251,6 +260,8 @@ class Qwen2Attention(nn.Module):
         self.k_proj = nn.Linear(self.hidden_size, self.num_key_value_heads * self.head_dim, bias=True)
         self.v_proj = nn.Linear(self.hidden_size, self.num_key_value_heads * self.head_dim, bias=True)
         self.o_proj = nn.Linear(self.num_heads * self.head_dim, self.hidden_size, bias=False)
+        # [batch or 1, num_heads, 1, 1] heads zeroed by the block list, None when no head of the layer is masked
+        self.register_buffer("head_mask", None, persistent=False)
 
         self.rotary_emb = Qwen2RotaryEmbedding(
             self.head_dim,
@@ -330,7 +341,7 @@ class Qwen2Attention(nn.Module):
             )
 
         attn_output = attn_output.transpose(1, 2).contiguous()
-        attn_output = attn_output.reshape(bsz, q_len, self.hidden_size)
+        attn_output = attn_output.reshape(bsz, q_len, self.num_heads * self.head_dim)
 
         attn_output = self.o_proj(attn_output)
 
@@ -375,7 +386,9 @@ class Qwen2FlashAttention2(Qwen2Attention):
 
             # overwrite attention_mask with padding_mask
             attention_mask = kwargs.pop("padding_mask")
-        if(output_attentions):
+        # the top-k probe is computed from the flash path itself, no eager fallback needed
+        attention_topk = kwargs.get("attention_topk") if output_attentions else None
+        if output_attentions and not attention_topk:
             _, inspect, attn_weights, _ = self.forward_torch(
                 hidden_states,
                 attention_mask,
@@ -427,6 +440,21 @@ class Qwen2FlashAttention2(Qwen2Attention):
                 " make sure to upgrade flash-attn library."
             )
 
+        if isinstance(past_key_value, HeterogeneousMemory) and use_sliding_windows and self.layer_idx < self.config.max_window_layers:
+            # its full and int8 heads would attend every position, not the sliding window of the dense model
+            raise ValueError(
+                f"{type(past_key_value).__name__} does not implement the sliding window attention of this model, "
+                f"sequences are limited to sliding_window={self.config.sliding_window} positions"
+            )
+
+        if isinstance(past_key_value, HeterogeneousMemory) and past_key_value.get_seq_length(self.layer_idx) > 0:
+            # each kv head attends the positions kept by its cache tier: full, int8, or sinks and a recent window
+            attn_output = past_key_value.update_and_attend(
+                mask_heads(query_states, self.head_mask), key_states, value_states, self.layer_idx, attention_mask
+            )
+            attn_output = attn_output.transpose(1, 2).reshape(bsz, q_len, self.num_heads * self.head_dim)
+            return self.o_proj(attn_output), None, past_key_value
+
         if past_key_value is not None:
             # Activate slicing cache only if the config has a value `sliding_windows` attribute
             cache_has_contents = past_key_value.get_seq_length(self.layer_idx) > 0
@@ -456,6 +484,10 @@ class Qwen2FlashAttention2(Qwen2Attention):
             cache_kwargs = {"sin": sin, "cos": cos}  # Specific to RoPE models
             key_states, value_states = past_key_value.update(key_states, value_states, self.layer_idx, cache_kwargs)
 
+        query_states = mask_heads(query_states, self.head_mask)
+        if attention_topk:
+            attn_weights = attention_topk_probe(query_states, key_states, attention_topk, attention_mask=attention_mask)
+
         # repeat k/v heads if n_kv_heads < n_heads
         key_states = repeat_kv(key_states, self.num_key_value_groups)
         value_states = repeat_kv(value_states, self.num_key_value_groups)
@@ -499,7 +531,7 @@ class Qwen2FlashAttention2(Qwen2Attention):
             use_sliding_windows=use_sliding_windows,
         )
 
-        attn_output = attn_output.reshape(bsz, q_len, self.hidden_size).contiguous()
+        attn_output = attn_output.reshape(bsz, q_len, self.num_heads * self.head_dim).contiguous()
         attn_output = self.o_proj(attn_output)
 
         if not output_attentions:
@@ -551,18 +583,19 @@ class Qwen2FlashAttention2(Qwen2Attention):
             if(use_cache):
                 cache_kwargs = {"sin": sin, "cos": cos}  # Specific to RoPE models
                 key_states, value_states = past_key_value.update(key_states, value_states, self.layer_idx, cache_kwargs)
-            else: 
+            elif isinstance(past_key_value, StaticSlabCache):
+                key_states, value_states = past_key_value.lookahead(key_states, value_states, self.layer_idx)
+            else:
                 key_states = torch.cat([past_key_value.key_cache[self.layer_idx], key_states], dim=-2)
                 value_states = torch.cat([past_key_value.value_cache[self.layer_idx], value_states], dim=-2)
 
-        key_states = repeat_kv(key_states, self.num_key_value_groups)
-        value_states = repeat_kv(value_states, self.num_key_value_groups)
+        # keys and values stay grouped, the query heads sharing a kv head are folded together in the matmuls
 
         # print(query_states.size())
         # print(key_states.size())
         inspect["query"] = query_states
         inspect["key"] = key_states
-        attn_weights = torch.matmul(query_states, key_states.transpose(2, 3)) / math.sqrt(self.head_dim)
+        attn_weights = grouped_attention_scores(query_states, key_states) / math.sqrt(self.head_dim)
         ###write our mask here
         #print(attn_weights.size())#[batch_size, head, q, c]
         
@@ -578,24 +611,11 @@ class Qwen2FlashAttention2(Qwen2Attention):
                     f"Attention mask should be of size {(bsz, 1, q_len, kv_seq_len)}, but is {attention_mask.size()}"
                 )
             attn_weights = attn_weights + attention_mask
-        if 'block_list' in kwargs:
-            for h in kwargs['block_list']:
-                if self.layer_idx==h[0]:
-                    '''
-                    if h[1]==0:
-                        target_head = 1
-                    elif h[1]==31:
-                        target_head = 30
-                    else:
-                        target_head = h[1] - 1
-                        
-                    attn_weights[:, h[1], :, :] = attn_weights[:, target_head, :, :]
-                    '''
-                    attn_weights[:, h[1], :, :] = 0 
+        attn_weights = mask_heads(attn_weights, self.head_mask)
         # upcast attention to fp32
         attn_weights = nn.functional.softmax(attn_weights, dim=-1, dtype=torch.float32).to(query_states.dtype)
         attn_weights = nn.functional.dropout(attn_weights, p=self.attention_dropout, training=self.training)
-        attn_output = torch.matmul(attn_weights, value_states)
+        attn_output = grouped_attention_output(attn_weights, value_states)
         inspect["attn_output_before_o_proj"] = attn_output
 
         if attn_output.size() != (bsz, self.num_heads, q_len, self.head_dim):
@@ -606,12 +626,17 @@ class Qwen2FlashAttention2(Qwen2Attention):
 
         attn_output = attn_output.transpose(1, 2).contiguous()
 
-        attn_output = attn_output.reshape(bsz, q_len, self.hidden_size)
+        attn_output = attn_output.reshape(bsz, q_len, self.num_heads * self.head_dim)
 
         attn_output = self.o_proj(attn_output)
 
         if not output_attentions:
             attn_weights = None
+        elif kwargs.get("attention_topk"):
+            # capture mode: only keep the top-k key positions of the last query row per head,
+            # so the model never holds (heads, q_len, kv_len) weights for every layer
+            attn_weights = attn_weights[:, :, -1, :].topk(kwargs["attention_topk"], dim=-1).indices
+            inspect = {}
 
         return attn_output, inspect, attn_weights, past_key_value
 
@@ -844,7 +869,7 @@ class Qwen2SdpaAttention(Qwen2Attention):
         )
 
         attn_output = attn_output.transpose(1, 2).contiguous()
-        attn_output = attn_output.view(bsz, q_len, self.hidden_size)
+        attn_output = attn_output.view(bsz, q_len, self.num_heads * self.head_dim)
 
         attn_output = self.o_proj(attn_output)
 
@@ -917,6 +942,7 @@ class Qwen2DecoderLayer(nn.Module):
                 past_key_value=past_key_value,
                 output_attentions=output_attentions,
                 use_cache=use_cache,
+                **kwargs,
             )
         else:
             hidden_states, inspect, self_attn_weights, present_key_value = self.self_attn.forward_torch(
@@ -926,6 +952,7 @@ class Qwen2DecoderLayer(nn.Module):
                 past_key_value=past_key_value,
                 output_attentions=output_attentions,
                 use_cache=use_cache,
+                **kwargs,
             )
 
         hidden_states = residual + hidden_states
@@ -1108,6 +1135,7 @@ class Qwen2Model(Qwen2PreTrainedModel):
         output_hidden_states: Optional[bool] = None,
         return_dict: Optional[bool] = None,
         block_list: list = None,
+        attention_topk: Optional[int] = None,
     ) -> Union[Tuple, BaseModelOutputWithPast]:
         output_attentions = output_attentions if output_attentions is not None else self.config.output_attentions
         output_hidden_states = (
@@ -1191,10 +1219,10 @@ class Qwen2Model(Qwen2PreTrainedModel):
         all_hidden_states = () if output_hidden_states else None
         all_self_attns = () if output_attentions else None
         next_decoder_cache = None
-        if block_list:
-            kwargs={"block_list":block_list}
-        else:
-            kwargs={}
+        kwargs = {}
+        set_block_list(self, block_list)
+        if attention_topk:
+            kwargs["attention_topk"] = attention_topk
         #print(block_list)
         for decoder_layer in self.layers:
             if output_hidden_states:
@@ -1295,7 +1323,8 @@ class Qwen2ForCausalLM(Qwen2PreTrainedModel):
         output_hidden_states: Optional[bool] = None,
         return_dict: Optional[bool] = None,
         attn_mode: str = "flash",
-        block_list:list = None, 
+        block_list: list = None,
+        attention_topk: Optional[int] = None,
     ) -> Union[Tuple, CausalLMOutputWithPast]:
         r"""
         Args:
@@ -1342,6 +1371,7 @@ class Qwen2ForCausalLM(Qwen2PreTrainedModel):
             return_dict=return_dict,
             attn_mode=attn_mode,
             block_list=block_list,
+            attention_topk=attention_topk,
         )
 
         hidden_states = outputs[0]
@@ -0,0 +1,165 @@
+import bisect
+import glob
+import hashlib
+import json
+import os
+
+import numpy as np
+
+
+TOKEN_CACHE_DIR = ".token_cache"
+# ids ending a sentence, per tokenizer family: llama-2, llama-3, mistral, glm
+PERIOD_TOKEN_FAMILIES = [[29889, 869], [88946, 13], [842, 28723], [918, 30930]]
+_fingerprints = {}
+
+
+def period_token_family(period_token):
+    """
+    The sentence-end ids of the tokenizer whose '.' is `period_token`.
+    """
+    for family in PERIOD_TOKEN_FAMILIES:
+        if period_token in family:
+            return family
+    return [period_token]
+
+
+def period_positions(tokens, period_tokens):
+    """
+    Sorted positions of the sentence-end tokens in `tokens`, found in one vectorized pass.
+    """
+    return np.flatnonzero(np.isin(np.asarray(tokens), period_tokens))
+
+
+def snap_to_sentence_start(positions, insertion_point):
+    """
+    Moves `insertion_point` back to right after the last period before it, or to 0 when there is none.
+    :param positions: Sorted period positions, see `period_positions`.
+    """
+    i = bisect.bisect_left(positions, insertion_point)
+    return int(positions[i - 1]) + 1 if i else 0
+
+
+def tokenizer_fingerprint(enc):
+    """
+    Hash of what decides how a tokenizer splits text: its class, its vocabulary and the sentencepiece legacy mode.
+    """
+    if id(enc) not in _fingerprints:
+        vocab = sorted(enc.get_vocab().items(), key=lambda item: item[1])
+        payload = json.dumps([type(enc).__name__, getattr(enc, "legacy", None), vocab])
+        _fingerprints[id(enc)] = hashlib.sha1(payload.encode()).hexdigest()
+    return _fingerprints[id(enc)]
+
+
+def cached_token_ids(enc, text, cache_dir=TOKEN_CACHE_DIR):
+    """
+    Token ids of `text` (no special tokens) as an int32 array, memory-mapped from `cache_dir` when this tokenizer
+    already encoded this text, in this or any previous run. Processes loading the same file share its pages.
+    """
+    key = f"{tokenizer_fingerprint(enc)[:16]}_{hashlib.sha1(text.encode()).hexdigest()[:16]}"
+    path = os.path.join(cache_dir, f"{key}.npy")
+    if not os.path.exists(path):
+        token_ids = np.asarray(enc(text, add_special_tokens=False)["input_ids"], dtype=np.int32)
+        os.makedirs(cache_dir, exist_ok=True)
+        # write then rename, so concurrent workers never load a partial file
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            np.save(f, token_ids)
+        os.replace(tmp_path, path)
+    return np.load(path, mmap_mode="r")
+
+
+def read_haystack(haystack_dir, max_context_length):
+    """
+    Concatenates the haystack files, repeating the directory until the text has at least `max_context_length` words.
+    """
+    context = ""
+    while len(context.split()) < max_context_length:
+        for file in glob.glob(f"{haystack_dir}/*.txt"):
+            with open(file, 'r') as f:
+                context += f.read()
+    return context
+
+
+class HaystackCorpus:
+    """
+    A haystack directory tokenized once. Prompts are assembled by slicing the corpus ids and splicing pre-tokenized
+    needle / question ids, instead of trimming, decoding and re-tokenizing the whole text for every test.
+    """
+    def __init__(self, enc, haystack_dir, max_context_length, count_tokens=False, cache_dir=TOKEN_CACHE_DIR):
+        """
+        :param enc: The tokenizer of the model under test.
+        :param haystack_dir: The directory of text files used as haystack.
+        :param max_context_length: The longest context that will be built, in tokens.
+        :param count_tokens: Repeat the directory until it has `max_context_length` tokens instead of words. Default is False.
+        :param cache_dir: Where token ids are cached across runs, see `cached_token_ids`.
+        """
+        self.enc = enc
+        self.haystack_dir = haystack_dir
+        self._period_positions = {}
+        if count_tokens:
+            # size the repetition from one pass over the directory instead of re-tokenizing the growing text
+            single_pass = read_haystack(haystack_dir, 1)
+            repeats = -(-max_context_length // max(len(cached_token_ids(enc, single_pass, cache_dir)), 1))
+            self.token_ids = cached_token_ids(enc, single_pass * repeats, cache_dir)
+            while len(self.token_ids) < max_context_length:
+                repeats += 1
+                self.token_ids = cached_token_ids(enc, single_pass * repeats, cache_dir)
+        else:
+            self.token_ids = cached_token_ids(enc, read_haystack(haystack_dir, max_context_length), cache_dir)
+
+    def continuation_ids(self, text, anchor="."):
+        """
+        Token ids of `text` as it is tokenized right after `anchor`, so sentencepiece tokenizers do not add the
+        word-start prefix a standalone encode would put in front of it.
+        """
+        anchor_ids = self.enc(anchor, add_special_tokens=False)["input_ids"]
+        ids = self.enc(anchor + text, add_special_tokens=False)["input_ids"]
+        if ids[:len(anchor_ids)] != anchor_ids:
+            ids = self.enc(text, add_special_tokens=False)["input_ids"]
+        else:
+            ids = ids[len(anchor_ids):]
+        return np.asarray(ids, dtype=np.int32)
+
+    def splice_is_stable(self, left_ids, right_ids, window=16):
+        """
+        Checks that decoding `left_ids + right_ids` and encoding the text again keeps the boundary between the two,
+        i.e. that splicing at token level gives the same ids as tokenizing the spliced text. Only `window` tokens on
+        each side are re-encoded.
+        """
+        left = [int(i) for i in left_ids[-window:]]
+        right = [int(i) for i in right_ids[:window]]
+        if not left or not right:
+            return True
+        left_text = self.enc.decode(left)
+        base = self.enc(left_text, add_special_tokens=False)["input_ids"]
+        joint = self.enc(self.enc.decode(left + right), add_special_tokens=False)["input_ids"]
+        return joint == base + right
+
+    def period_positions(self, period_tokens):
+        """
+        Sorted positions of `period_tokens` in the corpus, computed once per family. Valid for every prefix of the
+        corpus, so a trimmed haystack only looks at the positions before its insertion point.
+        """
+        key = tuple(period_tokens)
+        if key not in self._period_positions:
+            self._period_positions[key] = period_positions(self.token_ids, period_tokens)
+        return self._period_positions[key]
+
+    def insert_needle(self, needle_ids, context_length, depth_percent, period_tokens):
+        """
+        Token level version of trimming the haystack and inserting the needle at the last sentence break before
+        `depth_percent` of the context.
+        :param needle_ids: The needle ids, see `continuation_ids`.
+        :param context_length: Number of haystack tokens to keep, the needle comes on top of it.
+        :param depth_percent: Where to insert the needle, in percent of the haystack.
+        :param period_tokens: Token ids that end a sentence.
+        :return: (context ids, insertion point of the needle)
+        """
+        tokens_context = self.token_ids[:context_length]
+        if depth_percent == 100:
+            insertion_point = len(tokens_context)
+        else:
+            insertion_point = int(len(tokens_context) * (depth_percent / 100))
+            insertion_point = snap_to_sentence_start(self.period_positions(period_tokens), insertion_point)
+        context_ids = np.concatenate([tokens_context[:insertion_point], needle_ids, tokens_context[insertion_point:]])
+        return context_ids, insertion_point
@@ -0,0 +1,384 @@
+"""
+Binary store for retrieval head scores.
+
+A store `head_score/<model>` is made of three files:
+    <model>.scores        raw (samples, layers, heads) array, one record appended per successful detection
+    <model>.meta.jsonl    one line of metadata per record (context length, depth, needle id)
+    <model>.summary.npz   dtype and the `HeadScoreAccumulator` of all samples, rewritten (it is tiny) on every append
+                          after the other two, its count is the number of committed samples
+
+so adding a sample never rewrites the samples already stored, and per-head means / rankings are read from the
+summary without touching the samples. Samples and metadata lines past the summary count, left by a run interrupted in
+the middle of an append, are dropped by the next append.
+
+The one-line JSON format `{"layer-head": [score, ...]}` can be imported and exported, and the stores written by the
+workers of a sharded detection (`--shard i/n`) merged into the store of the model and its json:
+    python head_score_store.py export head_score/llama-2-7b-80k
+    python head_score_store.py import head_score/llama-2-7b-80k.json
+    python head_score_store.py merge head_score/llama-2-7b-80k head_score/llama-2-7b-80k.shard-*
+"""
+import argparse
+import json
+import os
+
+import numpy as np
+
+
+class HeadScoreAccumulator:
+    """
+    Running per-head statistics of the retrieval scores: count, sum and sum of squares as dense (layers, heads)
+    arrays, plus an optional fixed-bin histogram of each head used as a quantile sketch. One detection is folded in
+    with one vectorized update, memory does not grow with the number of detections, and two accumulators merge by
+    adding their arrays.
+    """
+    def __init__(self, layer_num, head_num, quantile_bins=0, max_score=1.0):
+        """
+        :param layer_num: Number of layers.
+        :param head_num: Number of attention heads per layer.
+        :param quantile_bins: Number of histogram bins over [0, max_score] kept per head for `quantile`, 0 disables the sketch. Default is 0.
+        :param max_score: Upper edge of the histogram, higher scores are counted in the last bin. Default is 1.0.
+        """
+        self.layer_num, self.head_num = layer_num, head_num
+        self.max_score = max_score
+        self.count = 0
+        self.sum = np.zeros((layer_num, head_num), dtype=np.float64)
+        self.sumsq = np.zeros((layer_num, head_num), dtype=np.float64)
+        self.histogram = np.zeros((layer_num, head_num, quantile_bins), dtype=np.int64) if quantile_bins else None
+
+    @property
+    def quantile_bins(self):
+        return 0 if self.histogram is None else self.histogram.shape[-1]
+
+    def update(self, retrieval_score):
+        """
+        Folds in the (layers, heads) scores of one detection, or a (samples, layers, heads) batch of them.
+        """
+        scores = np.asarray(retrieval_score, dtype=np.float64).reshape(-1, self.layer_num, self.head_num)
+        self.count += scores.shape[0]
+        self.sum += scores.sum(axis=0)
+        self.sumsq += np.square(scores).sum(axis=0)
+        if self.histogram is not None:
+            bins = self.histogram.shape[-1]
+            bin_idx = np.clip((scores / self.max_score * bins).astype(np.int64), 0, bins - 1)
+            # flat (layer, head, bin) index of every score, counted in one pass
+            flat_idx = np.arange(self.layer_num * self.head_num).reshape(self.layer_num, self.head_num) * bins + bin_idx
+            self.histogram += np.bincount(flat_idx.ravel(), minlength=self.histogram.size).reshape(self.histogram.shape)
+
+    def merge(self, other):
+        """
+        Adds the statistics of `other` (same shape and sketch) to this accumulator, in place.
+        """
+        if (other.layer_num, other.head_num) != (self.layer_num, self.head_num):
+            raise ValueError(f"Cannot merge {other.layer_num}x{other.head_num} head scores into {self.layer_num}x{self.head_num}.")
+        self.count += other.count
+        self.sum += other.sum
+        self.sumsq += other.sumsq
+        if self.histogram is not None:
+            if other.histogram is None or other.histogram.shape != self.histogram.shape or other.max_score != self.max_score:
+                raise ValueError("Cannot merge accumulators with different quantile sketches.")
+            self.histogram += other.histogram
+        return self
+
+    def mean(self):
+        """
+        (layers, heads) mean score.
+        """
+        return self.sum / max(self.count, 1)
+
+    def std(self):
+        """
+        (layers, heads) population standard deviation of the scores.
+        """
+        mean = self.mean()
+        return np.sqrt(np.maximum(self.sumsq / max(self.count, 1) - np.square(mean), 0))
+
+    def quantile(self, q):
+        """
+        (layers, heads) approximate `q` quantile of the scores, interpolated inside the histogram bins.
+        """
+        if self.histogram is None:
+            raise ValueError("No quantile sketch, build the accumulator with quantile_bins > 0.")
+        bins = self.histogram.shape[-1]
+        cumulative = np.cumsum(self.histogram, axis=-1)
+        target = q * self.count
+        # first bin whose cumulative count reaches the target, then linear interpolation inside it
+        bin_idx = np.minimum((cumulative < target).sum(axis=-1), bins - 1)
+        in_bin = np.take_along_axis(self.histogram, bin_idx[..., None], axis=-1)[..., 0]
+        below = np.take_along_axis(cumulative, bin_idx[..., None], axis=-1)[..., 0] - in_bin
+        fraction = np.clip((target - below) / np.maximum(in_bin, 1), 0, 1)
+        return (bin_idx + fraction) * self.max_score / bins
+
+    def top_heads(self, k=None):
+        """
+        [[layer, head], ...] ordered by decreasing mean score, the first `k` only when given.
+        """
+        order = np.argsort(-self.mean(), axis=None, kind="stable")[:k]
+        return [[int(i) // self.head_num, int(i) % self.head_num] for i in order]
+
+    def state_dict(self):
+        state = {"layer_num": self.layer_num, "head_num": self.head_num, "max_score": self.max_score,
+                 "count": self.count, "sum": self.sum, "sumsq": self.sumsq}
+        if self.histogram is not None:
+            state["histogram"] = self.histogram
+        return state
+
+    @classmethod
+    def from_state_dict(cls, state):
+        histogram = state["histogram"] if "histogram" in state else None
+        accumulator = cls(int(state["layer_num"]), int(state["head_num"]), 0, float(state["max_score"]))
+        accumulator.count = int(state["count"])
+        accumulator.sum = np.array(state["sum"], dtype=np.float64)
+        accumulator.sumsq = np.array(state["sumsq"], dtype=np.float64)
+        accumulator.histogram = None if histogram is None else np.array(histogram, dtype=np.int64)
+        return accumulator
+
+
+class HeadScoreStore:
+    def __init__(self, path, layer_num=None, head_num=None, dtype="float16", quantile_bins=0):
+        """
+        :param path: Path of the store without extension, e.g. head_score/llama-2-7b-80k.
+        :param layer_num: Number of layers, only needed to create a new store.
+        :param head_num: Number of attention heads per layer, only needed to create a new store.
+        :param dtype: Storage dtype of the samples of a new store. Default is float16.
+        :param quantile_bins: Histogram bins of the quantile sketch of a new store, see `HeadScoreAccumulator`. Default is 0.
+        """
+        self.path = path
+        self.scores_path = f"{path}.scores"
+        self.meta_path = f"{path}.meta.jsonl"
+        self.summary_path = f"{path}.summary.npz"
+        if os.path.exists(self.summary_path):
+            summary = dict(np.load(self.summary_path))
+            self.dtype = np.dtype(str(summary.pop("dtype")))
+            if "sumsq" not in summary:
+                # summary written before the sum of squares was tracked, rebuild it from the samples
+                samples = np.memmap(self.scores_path, dtype=self.dtype, mode="r").reshape(-1, int(summary["layer_num"]), int(summary["head_num"]))[:int(summary["count"])]
+                summary["sumsq"] = np.square(samples.astype(np.float64)).sum(axis=0)
+                summary["max_score"] = 1.0
+            self.stats = HeadScoreAccumulator.from_state_dict(summary)
+        else:
+            if layer_num is None or head_num is None:
+                raise ValueError(f"No head score store at {path}, layer_num and head_num are needed to create one.")
+            self.dtype = np.dtype(dtype)
+            self.stats = HeadScoreAccumulator(layer_num, head_num, quantile_bins)
+        self.layer_num, self.head_num = self.stats.layer_num, self.stats.head_num
+
+    def _truncate(self):
+        """
+        Drops the samples and metadata lines past the summary count before appending. The summary is written last, so
+        those are the leftovers of a run interrupted between the writes, and the new samples would otherwise land
+        after them and be paired with the wrong metadata. Readers never truncate, as they may race a live append.
+        """
+        count = self.count
+        nbytes = count * self.layer_num * self.head_num * self.dtype.itemsize
+        if os.path.exists(self.scores_path) and os.path.getsize(self.scores_path) > nbytes:
+            print(f"{self.scores_path}: dropping {os.path.getsize(self.scores_path) - nbytes} bytes past the {count} summarized samples")
+            os.truncate(self.scores_path, nbytes)
+        if os.path.exists(self.meta_path):
+            with open(self.meta_path, "rb") as f:
+                lines = f.readlines()
+            if len(lines) > count:
+                with open(self.meta_path, "wb") as f:
+                    f.writelines(lines[:count])
+
+    @property
+    def count(self):
+        return self.stats.count
+
+    @staticmethod
+    def exists(path):
+        return os.path.exists(f"{path}.summary.npz")
+
+    def append(self, retrieval_score, context_length=None, depth_percent=None, needle_id=None):
+        """
+        Appends one sample.
+        :param retrieval_score: (layers, heads) scores of one successful detection.
+        """
+        self.extend([retrieval_score], [{"context_length": context_length, "depth_percent": depth_percent, "needle_id": needle_id}])
+
+    def extend(self, scores, metadata=None):
+        """
+        Appends a batch of samples with one write per file.
+        :param scores: (samples, layers, heads) scores.
+        :param metadata: One dict per sample, samples without metadata get empty fields.
+        """
+        records = np.asarray(scores, dtype=np.float64).reshape(-1, self.layer_num, self.head_num)
+        if metadata is None:
+            metadata = [{"context_length": None, "depth_percent": None, "needle_id": None}] * len(records)
+        self._truncate()
+        with open(self.scores_path, "ab") as f:
+            f.write(records.astype(self.dtype).tobytes())
+        with open(self.meta_path, "a") as f:
+            f.write("".join(json.dumps(meta) + "\n" for meta in metadata))
+        self.stats.update(records)
+        self.write_summary()
+
+    def merge(self, other):
+        """
+        Appends the samples of `other`, e.g. the store of one shard of a sweep, and merges its accumulator. Partial
+        stores merge in any order and grouping to the same statistics.
+        """
+        self._truncate()
+        self.stats.merge(other.stats)
+        with open(self.scores_path, "ab") as f:
+            f.write(np.asarray(other.scores(), dtype=self.dtype).tobytes())
+        with open(self.meta_path, "a") as f:
+            f.write("".join(json.dumps(meta) + "\n" for meta in other.metadata()))
+        self.write_summary()
+
+    def write_summary(self):
+        os.makedirs(os.path.dirname(self.summary_path) or ".", exist_ok=True)
+        tmp_path = f"{self.summary_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            np.savez(f, dtype=self.dtype.name, **self.stats.state_dict())
+        os.replace(tmp_path, self.summary_path)
+
+    def scores(self):
+        """
+        Memory-mapped (samples, layers, heads) array of every stored sample.
+        """
+        if self.count == 0:
+            return np.zeros((0, self.layer_num, self.head_num), dtype=self.dtype)
+        return np.memmap(self.scores_path, dtype=self.dtype, mode="r", shape=(self.count, self.layer_num, self.head_num))
+
+    def metadata(self):
+        if not os.path.exists(self.meta_path):
+            return []
+        with open(self.meta_path) as f:
+            # lines past the summary count are not committed
+            return [json.loads(line) for _, line in zip(range(self.count), f)]
+
+    def mean(self):
+        """
+        (layers, heads) mean score over all samples.
+        """
+        return self.stats.mean()
+
+    def top_heads(self, k=None):
+        """
+        [[layer, head], ...] ordered by decreasing mean score, the first `k` only when given.
+        """
+        return self.stats.top_heads(k)
+
+    def to_json_dict(self):
+        scores = self.scores()
+        return {f"{l}-{h}": scores[:, l, h].astype(float).tolist() for l in range(self.layer_num) for h in range(self.head_num)}
+
+    def export_json(self, json_path=None):
+        json_path = json_path or f"{self.path}.json"
+        with open(json_path, "w") as f:
+            json.dump(self.to_json_dict(), f)
+        return json_path
+
+    @classmethod
+    def import_json(cls, json_path, path=None, dtype="float16", quantile_bins=0):
+        """
+        Creates a store from a `{"layer-head": [score, ...]}` file, samples get no metadata.
+        """
+        with open(json_path) as f:
+            head_counter = json.loads(f.readline())
+        heads = [[int(x) for x in key.split("-")] for key in head_counter]
+        layer_num = max(l for l, _ in heads) + 1
+        head_num = max(h for _, h in heads) + 1
+        store = cls(path or os.path.splitext(json_path)[0], layer_num, head_num, dtype, quantile_bins)
+        if store.count:
+            raise ValueError(f"{store.path} already holds {store.count} samples.")
+        records = np.zeros((max(len(v) for v in head_counter.values()), layer_num, head_num))
+        for (l, h), values in zip(heads, head_counter.values()):
+            records[:len(values), l, h] = values
+        store.extend(records)
+        return store
+
+
+def store_path(path):
+    """
+    Store path of any of its files, so shell globs over the store files can be passed as store paths.
+    """
+    for suffix in [".scores", ".meta.jsonl", ".summary.npz"]:
+        if path.endswith(suffix):
+            return path[:-len(suffix)]
+    return path
+
+
+def remove_store(path):
+    """
+    Deletes the files of the store `path`, summary first so a store left half deleted is never opened again.
+    """
+    for suffix in [".summary.npz", ".scores", ".meta.jsonl"]:
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+
+
+def merge_stores(path, part_paths, remove_parts=False):
+    """
+    Merges the stores `part_paths` into the store `path`, created from `path`.json or like the first part when it
+    does not exist yet, and exports the result as `path`.json.
+    :param remove_parts: Delete every part right after it is merged. `path`.merging.json then records the part being
+        merged and the sample count before it, so a merge interrupted before the part is deleted is finished by the
+        next one instead of merging the part twice. Default is False.
+    """
+    journal_path = f"{path}.merging.json"
+    if os.path.exists(journal_path):
+        with open(journal_path) as f:
+            journal = json.load(f)
+        if HeadScoreStore.exists(path) and HeadScoreStore(path).count > journal["count"]:
+            # the part was committed, only its deletion was interrupted
+            print(f"{journal['part']} was already merged, removing it")
+            remove_store(journal["part"])
+        os.remove(journal_path)
+
+    parts = [HeadScoreStore(p) for p in dict.fromkeys(store_path(p) for p in part_paths) if HeadScoreStore.exists(p)]
+    if HeadScoreStore.exists(path):
+        store = HeadScoreStore(path)
+    elif not parts:
+        raise ValueError(f"no store to merge into {path}")
+    elif os.path.exists(f"{path}.json"):
+        store = HeadScoreStore.import_json(f"{path}.json", path, parts[0].dtype.name, parts[0].stats.quantile_bins)
+    else:
+        store = HeadScoreStore(path, parts[0].layer_num, parts[0].head_num, parts[0].dtype.name, parts[0].stats.quantile_bins)
+    for part in parts:
+        if remove_parts:
+            tmp_path = f"{journal_path}.{os.getpid()}.tmp"
+            with open(tmp_path, "w") as f:
+                json.dump({"part": part.path, "count": store.count}, f)
+            os.replace(tmp_path, journal_path)
+        store.merge(part)
+        print(f"merged {part.count} samples from {part.path}")
+        if remove_parts:
+            remove_store(part.path)
+            os.remove(journal_path)
+    store.export_json()
+    return store
+
+
+def load_head_ranking(model_name, k=None):
+    """
+    Heads of a model ordered by decreasing mean retrieval score, from the binary store when there is one and from
+    head_score/<model>.json otherwise.
+    """
+    path = f"head_score/{model_name}"
+    if HeadScoreStore.exists(path):
+        return HeadScoreStore(path).top_heads(k)
+    with open(f"{path}.json", "r") as file:
+        head_counter = json.loads(file.readline())
+    head_score = [(key, np.mean(values)) for key, values in head_counter.items()]
+    head_score = sorted(head_score, key=lambda x: x[1], reverse=True)
+    return [[int(x) for x in key.split("-")] for key, _ in head_score][:k]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('command', choices=["import", "export", "merge"], help='import a head_score json into a store, export a store as json, or merge shard stores into a store')
+    parser.add_argument('path', type=str, help='json file to import, or store path (without extension) to export / merge into')
+    parser.add_argument('parts', type=str, nargs='*', help='stores to merge')
+    parser.add_argument('--output', type=str, default=None, help='store path for import, json file for export')
+    parser.add_argument('--dtype', type=str, default="float16", help='storage dtype of imported samples')
+    args = parser.parse_args()
+
+    if args.command == "import":
+        store = HeadScoreStore.import_json(args.path, args.output, args.dtype)
+        print(f"imported {store.count} samples into {store.path}")
+    elif args.command == "merge":
+        store = merge_stores(args.path, args.parts)
+        print(f"{store.count} samples in {store.path}, top retrieval heads: {store.top_heads(20)}")
+    else:
+        print("written %s" % HeadScoreStore(args.path).export_json(args.output))
@@ -8,6 +8,7 @@ import numpy as np
 import argparse
 from rouge_score import rouge_scorer
 import torch
+from haystack_corpus import HaystackCorpus
 
 needle = "\nThe best thing to do in San Francisco is eat a sandwich and sit in Dolores Park on a sunny day.\n"
 haystack_dir = "PaulGrahamEssays"
@@ -63,19 +64,13 @@ def generate_context(context_length):
         return tokenizer.decode(tokens[:context_length])
 
 
-    # Load up tiktoken so we navigate tokens more easily
-
-    # Get your Paul Graham files loaded into a string
+    # Get your Paul Graham files tokenized, the ids are cached on disk across runs
     global context
-    while get_context_length_in_tokens(context) < max_context_length:
-        for file in glob.glob(f"{haystack_dir}/*.txt"):
-            with open(file, 'r') as f:
-                context += f.read()
+    corpus = HaystackCorpus(tokenizer, haystack_dir, max_context_length, count_tokens=True)
 
     # Truncate the Paul Graham essays to the context length you desire
-    tokens = tokenizer.encode(context)
-    if len(tokens) > context_length:
-        context = decode_tokens(tokens, context_length)
+    tokens = tokenizer.build_inputs_with_special_tokens(corpus.token_ids[:context_length].tolist())
+    context = decode_tokens(tokens, context_length)
 
 generate_context(context_length=max_context_length)
 
@@ -0,0 +1,264 @@
+"""
+Client of the Megatron text generation server used by needle_in_a_haystack_megatron.py.
+
+One `requests.Session` keeps a pool of `concurrency` persistent connections to the server, failed requests (connection
+errors, 5xx) are retried with exponential backoff, and every request is timed. `generate_many` keeps `concurrency`
+generate requests in flight.
+
+`FakeMegatronServer` answers the same API with a whitespace tokenizer and a canned answer, so the client and the
+harness can be exercised without a GPU:
+    python megatron_client.py serve --port 5000            # then run the harness with --url localhost:5000
+    python megatron_client.py bench --fake --concurrency 8 # time concurrent generate requests
+"""
+import argparse
+import json
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+from requests.adapters import HTTPAdapter
+
+
+def get_url(base_url, request_type):
+    base_url = base_url.strip()
+    if request_type == "generate":
+        return f"http://{base_url}/api"
+    elif request_type == "tokenize":
+        return f"http://{base_url}/api/tokenize"
+    elif request_type == "detokenize":
+        return f"http://{base_url}/api/detokenize"
+    elif request_type == "modify_window_size":
+        return f"http://{base_url}/api/modify_window_size"
+    else:
+        raise ValueError("Invalid request type. Must be 'generate', 'tokenize', or 'detokenize', or 'modify_window_size'.")
+
+
+class MegatronClient:
+    def __init__(self, base_url, concurrency=1, retries=3, backoff=1.0, timeout=None):
+        """
+        :param base_url: host:port of the server, without "http://".
+        :param concurrency: Number of pooled connections, and of generate requests `generate_many` keeps in flight. Default is 1.
+        :param retries: Number of times a failed request is sent again. Default is 3.
+        :param backoff: Seconds to wait before the first retry, doubled for each next one. Default is 1.0.
+        :param timeout: Seconds to wait for a response, None waits as long as the server takes. Default is None.
+        """
+        self.base_url = base_url
+        self.concurrency = concurrency
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max(concurrency, 1))
+        self.session.mount("http://", adapter)
+        self.session.headers.update({'Content-Type': 'application/json'})
+        self.timings = defaultdict(list)
+        self._timings_lock = threading.Lock()
+
+    def request(self, request_type, data):
+        """
+        PUTs `data` to the `request_type` endpoint and returns the decoded json response.
+        """
+        url = get_url(self.base_url, request_type)
+        # timed over all the attempts, backoff included, as seen by the caller
+        start_time = time.time()
+        for attempt in range(self.retries + 1):
+            try:
+                response = self.session.put(url, data=json.dumps(data), timeout=self.timeout)
+                if response.status_code < 500:
+                    break
+                error = f"Error {response.status_code}: {response.text}"
+            except (requests.ConnectionError, requests.Timeout) as e:
+                response, error = None, repr(e)
+            if attempt == self.retries:
+                raise ValueError(f"{request_type} failed after {attempt + 1} attempts, {error}")
+            print(f"{request_type} attempt {attempt + 1} failed ({error}), retrying in {self.backoff * 2 ** attempt:.1f}s")
+            time.sleep(self.backoff * 2 ** attempt)
+        with self._timings_lock:
+            self.timings[request_type].append(time.time() - start_time)
+        if response.status_code != 200:
+            raise ValueError(f"Error {response.status_code}: {response.text}")
+        return response.json()
+
+    def generate(self, prompt, tokens_to_generate):
+        data = {"prompts": [prompt], "tokens_to_generate": tokens_to_generate, "add_BOS": False, "random_seed": 0, "top_k": 1}
+        response = self.request("generate", data)
+        try:
+            return response['text'][0]
+        except (KeyError, IndexError):
+            print(data)
+            print(response)
+            raise ValueError("Error in response")
+
+    def generate_many(self, prompts, tokens_to_generate):
+        """
+        Generates for every prompt with `concurrency` requests in flight, results in the order of `prompts`.
+        """
+        with ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+            return list(pool.map(lambda prompt: self.generate(prompt, tokens_to_generate), prompts))
+
+    def tokenize(self, text):
+        return self.request("tokenize", {"texts": [text], "add_BOS": False})['token_ids'][0]
+
+    def detokenize(self, tokens):
+        return self.request("detokenize", {"tokens": [tokens]})['texts'][0]
+
+    def modify_window_size(self, window_size):
+        self.request("modify_window_size", {"window_size": window_size})
+
+    def timing_summary(self):
+        """
+        Count, mean and max seconds of the requests of each type.
+        """
+        with self._timings_lock:
+            return {request_type: {"count": len(t), "mean": sum(t) / len(t), "max": max(t)}
+                    for request_type, t in self.timings.items() if t}
+
+
+TOKENIZER_PROBE = ("The best thing to do in San Francisco is eat a sandwich and sit in Dolores Park on a sunny day.\n"
+                   "  Indentation, numbers 1234567 3.14, punctuation ... !? \"quotes\" (brackets) and unicode: café, naïve, 東京.\n\n"
+                   "What is the best thing to do in San Francisco?\nAnswer:")
+
+
+class LocalTokenizer:
+    """
+    The Hugging Face tokenizer the server was launched with, loaded in this process so prompts are tokenized and
+    detokenized locally instead of sending the whole haystack over HTTP. Same interface as `MegatronClient`.
+    """
+    def __init__(self, tokenizer_path):
+        from transformers import AutoTokenizer
+
+        self.tokenizer = AutoTokenizer.from_pretrained(tokenizer_path)
+
+    def tokenize(self, text):
+        return self.tokenizer(text, add_special_tokens=False)["input_ids"]
+
+    def detokenize(self, tokens):
+        return self.tokenizer.decode(tokens)
+
+    def verify(self, client, probe=TOKENIZER_PROBE):
+        """
+        Checks once that the server tokenizes and detokenizes `probe` exactly like this tokenizer does, raises
+        ValueError otherwise.
+        """
+        server_ids, local_ids = client.tokenize(probe), self.tokenize(probe)
+        if server_ids != local_ids:
+            raise ValueError(f"Local tokenizer does not match the server: {local_ids[:16]}... vs {server_ids[:16]}...")
+        if client.detokenize(server_ids) != self.detokenize(local_ids):
+            raise ValueError("Local tokenizer does not detokenize like the server.")
+        return self
+
+
+class FakeMegatronServer:
+    """
+    In-process stand-in for the Megatron server: tokens are whitespace separated words (ids index a growing vocab),
+    generation echoes the prompt followed by `answer`.
+    """
+    def __init__(self, port=0, answer=" eat a sandwich and sit in Dolores Park on a sunny day.", latency=0.0, fail_every=0):
+        """
+        :param port: Port to listen on, 0 picks a free one (see `base_url`).
+        :param answer: Text appended to the prompt by generate requests.
+        :param latency: Seconds every generate request takes.
+        :param fail_every: Answer every n-th request with a 503 to exercise retries, 0 never fails.
+        """
+        self.answer = answer
+        self.latency = latency
+        self.fail_every = fail_every
+        self.vocab, self.words = {}, []
+        self.window_size = None
+        self.request_count = 0
+        self.lock = threading.Lock()
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_PUT(self):
+                data = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+                status, body = server.handle(self.path, data)
+                payload = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(("localhost", port), Handler)
+        self.thread = None
+
+    @property
+    def base_url(self):
+        return f"localhost:{self.httpd.server_address[1]}"
+
+    def token_ids(self, text):
+        with self.lock:
+            for word in text.split():
+                if word not in self.vocab:
+                    self.vocab[word] = len(self.words)
+                    self.words.append(word)
+            return [self.vocab[word] for word in text.split()]
+
+    def handle(self, path, data):
+        with self.lock:
+            self.request_count += 1
+            if self.fail_every and self.request_count % self.fail_every == 0:
+                return 503, {"message": "fake overload"}
+        if path == "/api":
+            time.sleep(self.latency)
+            return 200, {"text": [prompt + self.answer for prompt in data["prompts"]]}
+        elif path == "/api/tokenize":
+            return 200, {"token_ids": [self.token_ids(text) for text in data["texts"]]}
+        elif path == "/api/detokenize":
+            return 200, {"texts": [" ".join(self.words[i] for i in tokens) for tokens in data["tokens"]]}
+        elif path == "/api/modify_window_size":
+            self.window_size = data["window_size"]
+            return 200, {}
+        return 404, {"message": f"unknown endpoint {path}"}
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('command', choices=["serve", "bench"], help='run a fake server, or time concurrent generate requests')
+    parser.add_argument('--url', type=str, default="localhost:5000", help='server to benchmark')
+    parser.add_argument('--port', type=int, default=5000, help='port of the fake server')
+    parser.add_argument('--fake', action='store_true', help='benchmark against an in-process fake server')
+    parser.add_argument('--latency', type=float, default=0.2, help='seconds per generate request of the fake server')
+    parser.add_argument('--fail_every', type=int, default=0, help='the fake server answers every n-th request with a 503')
+    parser.add_argument('--concurrency', type=int, default=4, help='generate requests in flight')
+    parser.add_argument('--requests', type=int, default=32, help='number of generate requests of the benchmark')
+    args = parser.parse_args()
+
+    if args.command == "serve":
+        server = FakeMegatronServer(args.port, latency=args.latency, fail_every=args.fail_every)
+        print(f"fake Megatron server at {server.base_url}")
+        server.httpd.serve_forever()
+    else:
+        server = FakeMegatronServer(latency=args.latency, fail_every=args.fail_every).start() if args.fake else None
+        client = MegatronClient(server.base_url if server else args.url, concurrency=args.concurrency, backoff=0.1)
+        prompts = [f"prompt {i}:" for i in range(args.requests)]
+        start_time = time.time()
+        outputs = client.generate_many(prompts, tokens_to_generate=50)
+        elapsed = time.time() - start_time
+        assert all(output.startswith(prompt) for prompt, output in zip(prompts, outputs))
+        print(f"{args.requests} generate requests, {args.concurrency} in flight: {elapsed:.2f}s, {args.requests / elapsed:.1f} requests/s")
+        print(client.timing_summary())
+        if server:
+            server.stop()
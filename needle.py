@@ -47,6 +47,11 @@ from source.modeling_qwen2 import Qwen2ForCausalLM
 from source.modeling_mixtral import MixtralForCausalLM
 from source.modeling_mistral import MistralForCausalLM
 from source.modeling_phi3 import Phi3ForCausalLM
+from source.cache_utils import RetrievalHeadKVCache, SparseKVCache, StaticSlabCache
+from haystack_corpus import HaystackCorpus, period_positions, period_token_family, snap_to_sentence_start
+from head_score_store import load_head_ranking
+from sweep_scheduler import SweepQueue, run_worker, sweep_tasks
+from results_store import ResultsStore
 
 import numpy as np
 import argparse
@@ -61,6 +66,14 @@ import time
 import torch
 
 
+def faiss_attn_model_class(model_version):
+    for name, model_class in [("Qwen", Qwen2ForCausalLM), ("Mixtral", MixtralForCausalLM),
+                              ("Mistral", MistralForCausalLM), ("Phi3", Phi3ForCausalLM)]:
+        if name in model_version:
+            return model_class
+    return LlamaForCausalLM
+
+
 def reset_rope(model, model_max_train_len, scaling_factor):
     for l in model.model.layers:
         l.self_attn.rotary_emb.scaling_factor = scaling_factor
@@ -90,6 +103,15 @@ class LLMNeedleHaystackTester:
                  document_depth_percent_interval_type="linear",
                  model_provider="OpenAI",
                  mask_topk=0,
+                 kv_topk=0,
+                 kv_sink_size=4,
+                 kv_window_size=256,
+                 sparse_topk=0,
+                 sparse_heads=0,
+                 sparse_window_size=128,
+                 sparse_index="ivf",
+                 sparse_nprobe=8,
+                 sparse_track_recall=False,
                  anthropic_api_key=None,
                  model_name='',
                  model_name_suffix=None,
@@ -123,12 +145,22 @@ class LLMNeedleHaystackTester:
         :param model_name: The name of the model. Default is 'gpt-4-1106-preview'.
         :param seconds_to_sleep_between_completions: The number of seconds to sleep between completions. Default is None.
         :param print_ongoing_status: Whether or not to print the ongoing status. Default is True.
+        :param kv_topk: Keep the full KV cache only for the kv heads of the top k retrieval heads of head_score/<model>, and kv_sink_size leading plus kv_window_size recent positions for the other heads. 0 keeps the full cache for every head. Not supported past the sliding window of sliding window models (e.g. Mistral-7B-v0.1). Default is 0.
+        :param kv_sink_size: Leading positions kept for the non retrieval heads when kv_topk > 0. Default is 4.
+        :param kv_window_size: Recent positions kept for the non retrieval heads when kv_topk > 0. Default is 256.
+        :param sparse_topk: Decode with attn_mode="sparse": the sparse heads attend only to the sparse_topk prompt keys retrieved by an index built after prefill on the device of the cache (no GPU required), plus sparse_window_size recent positions. Llama models only. 0 decodes densely. Default is 0.
+        :param sparse_heads: Number of top retrieval heads of head_score/<model> attending sparsely, 0 for every head. Default is 0.
+        :param sparse_window_size: Recent positions the sparse heads attend to besides the retrieved keys. Default is 128.
+        :param sparse_index: "ivf" or "flat" (exact search). Default is "ivf".
+        :param sparse_nprobe: Lists scanned per query by the ivf index. Default is 8.
+        :param sparse_track_recall: Record the recall of the index against exact top-k search and the dense attention mass on the attended positions. Scores every prompt key at every decode step, so it costs more than dense attention. Default is False.
         """
         if not needle or not haystack_dir or not retrieval_question:
             raise ValueError("Needle, haystack, and retrieval_question must be provided.")
 
         self.needle = needle
         self.haystack_dir = haystack_dir
+        self.corpus = None
         self.retrieval_question = retrieval_question
         self.results_version = results_version
         self.num_concurrent_requests = num_concurrent_requests
@@ -139,8 +171,22 @@ class LLMNeedleHaystackTester:
         self.print_ongoing_status = print_ongoing_status
         self.model_provider = model_provider
         self.testing_results = []
+        self.results_store = {}
         self.head_counter = defaultdict(list)
         self.mask_topk = mask_topk
+        self.kv_topk = kv_topk
+        self.kv_sink_size = kv_sink_size
+        self.kv_window_size = kv_window_size
+        self.sparse_topk = sparse_topk
+        self.sparse_heads = sparse_heads
+        self.sparse_window_size = sparse_window_size
+        self.sparse_index = sparse_index
+        self.sparse_nprobe = sparse_nprobe
+        self.sparse_track_recall = sparse_track_recall
+        if self.kv_topk and self.sparse_topk:
+            raise ValueError("kv_topk and sparse_topk need different caches, set only one of them.")
+        # attn_mode is only understood by the faiss_attn models
+        self.forward_kwargs = {"attn_mode": "sparse"} if self.sparse_topk else {}
         if "CUDA_VISIBLE_DEVICES" in os.environ:
             self.multi_gpus = len(os.environ["CUDA_VISIBLE_DEVICES"]) > 1
         else:
@@ -191,32 +237,37 @@ class LLMNeedleHaystackTester:
             self.layer_num, self.head_num = config.num_hidden_layers, config.num_attention_heads
             print(f"layer number: {self.layer_num}, head number {self.head_num}")
             self.model_version += "_" + self.model_provider
+            self.num_key_value_groups = config.num_attention_heads // getattr(config, "num_key_value_heads", config.num_attention_heads)
+            # the retrieval head kv cache and the sparse attn_mode need the faiss_attn attention forwards
+            model_class = faiss_attn_model_class(self.model_version) if self.kv_topk or self.sparse_topk else AutoModelForCausalLM
+            if self.sparse_topk and model_class is not LlamaForCausalLM:
+                raise ValueError("attn_mode 'sparse' is implemented for Llama models only.")
             if "Qwen" in self.model_version:
-                self.model_to_test = AutoModelForCausalLM.from_pretrained(
+                self.model_to_test = model_class.from_pretrained(
                     model_name, torch_dtype="auto", device_map='auto', use_flash_attention_2="flash_attention_2"
                 )
             elif "Mixtral" in self.model_version:
-                self.model_to_test = AutoModelForCausalLM.from_pretrained(
+                self.model_to_test = model_class.from_pretrained(
                     model_name, torch_dtype="auto", device_map='auto', use_flash_attention_2="flash_attention_2",
                     trust_remote_code=True,
                 )
             elif "Mistral" in self.model_version:
-                self.model_to_test = AutoModelForCausalLM.from_pretrained(
+                self.model_to_test = model_class.from_pretrained(
                     model_name, torch_dtype=torch.bfloat16, device_map='auto',
                     use_flash_attention_2="flash_attention_2", trust_remote_code=True,
                 )
             elif "Phi3" in self.model_version:
-                self.model_to_test = AutoModelForCausalLM.from_pretrained(
+                self.model_to_test = model_class.from_pretrained(
                     model_name, torch_dtype=torch.bfloat16, device_map='auto', use_flash_attention_2="flash_attention_2",
                     trust_remote_code=True,
                 )
             else:
                 # self.model_to_test = LlamaForCausalLM.from_pretrained(model_name,
                 #     use_flash_attention_2="flash_attention_2", torch_dtype=torch.bfloat16,device_map='auto').eval()
-                self.model_to_test = AutoModelForCausalLM.from_pretrained(model_name,
-                                                                          attn_implementation="flash_attention_2",
-                                                                          torch_dtype=torch.bfloat16,
-                                                                          device_map='auto').eval()
+                self.model_to_test = model_class.from_pretrained(model_name,
+                                                                 attn_implementation="flash_attention_2",
+                                                                 torch_dtype=torch.bfloat16,
+                                                                 device_map='auto').eval()
             if 'llama-2-7b-80k' in self.model_version:
                 scaling_factor = 10
                 reset_rope(self.model_to_test, model_max_train_len=81920, scaling_factor=scaling_factor)
@@ -238,17 +289,19 @@ class LLMNeedleHaystackTester:
         if self.mask_topk != 0:
             if model_name == 'Mistral-7B-Instruct-v0.2':
                 model_name = "Mistral-7B-v0.2-hf"
-            with open(f"head_score/{model_name}.json", "r") as file:
-                stable_block_list = json.loads(file.readline())
-            stable_block_list = [(l[0], np.mean(l[1])) for l in stable_block_list.items()]
-            stable_block_list = sorted(stable_block_list, key=lambda x: x[1], reverse=True)
-            self.block_list = [[int(ll) for ll in l[0].split("-")] for l in stable_block_list][:100]
+            self.block_list = load_head_ranking(model_name, 100)
             if self.mask_topk > 0:
                 print(f"masking out top {self.mask_topk} retrieval heads")
             else:
                 print(f"masking out random {-self.mask_topk}  heads")
         else:
             self.block_list = []
+        if self.kv_topk:
+            self.retrieval_heads = load_head_ranking(model_name, self.kv_topk)
+            print(f"full kv cache for the top {self.kv_topk} retrieval heads, {self.kv_sink_size} sink and {self.kv_window_size} recent positions for the others")
+        if self.sparse_topk:
+            self.sparse_head_list = load_head_ranking(model_name, self.sparse_heads) if self.sparse_heads else None
+            print(f"{self.sparse_heads or 'all'} heads attend to their top {self.sparse_topk} keys ({self.sparse_index} index) and the last {self.sparse_window_size} positions")
 
     def logistic(self, x, L=100, x0=50, k=.1):
         if x == 0:
@@ -267,6 +320,7 @@ class LLMNeedleHaystackTester:
         for context_length in self.context_lengths:
             if context_length < args.s_len or context_length > args.e_len: continue
             for depth_percent in self.document_depth_percents:
+                if not args.rerun and self.result_exists(context_length, depth_percent): continue
                 task = self.bound_evaluate_and_log(context_length, depth_percent)
 
     def generate_prompt(self, context):
@@ -300,7 +354,7 @@ class LLMNeedleHaystackTester:
         for step_i in range(decode_len):
             inp = inp.view(1, 1)
             outputs = self.model_to_test(input_ids=inp, past_key_values=past_kv, use_cache=True, \
-                                         output_attentions=False)
+                                         output_attentions=False, **self.forward_kwargs)
             past_kv = outputs.past_key_values
             inp = outputs.logits[0, -1].argmax()
             step_token = self.enc.convert_ids_to_tokens(inp.item())
@@ -335,19 +389,33 @@ class LLMNeedleHaystackTester:
                 results.append((l, h))
         return results
 
+    def get_save_name(self):
+        """
+        Results directory name of the run, one per mask config.
+        """
+        if self.mask_topk > 0:
+            save_name = f"{self.model_version}_block_top{self.mask_topk}"
+        elif self.mask_topk == 0:
+            save_name = self.model_version
+        else:
+            save_name = f"{self.model_version}_block_random{-self.mask_topk}"
+        if self.kv_topk:
+            save_name += f"_kv_top{self.kv_topk}"
+        if self.sparse_topk:
+            save_name += f"_sparse_top{self.sparse_topk}"
+        return save_name
+
     def evaluate_and_log(self, context_length, depth_percent):
         # Checks to see if you've already checked a length/percent/version.
         # This helps if the program stop running and you want to restart later
         # Go generate the required length context and place your needle statement in
         if self.mask_topk > 0:
             block_list = self.block_list[:self.mask_topk]
-            save_name = f"{self.model_version}_block_top{self.mask_topk}"
         elif self.mask_topk == 0:
             block_list = None
-            save_name = self.model_version
         else:
             block_list = self.construct_random_head(-self.mask_topk)
-            save_name = f"{self.model_version}_block_random{-self.mask_topk}"
+        save_name = self.get_save_name()
         context = self.generate_context(context_length, depth_percent)
         question = f"Based on the content of the book, Question: {self.retrieval_question}\nAnswer:"
         if self.model_version in ["Mistral-7B-Instruct-v0.2", "Qwen1.5-14B-Chat"]:
@@ -371,8 +439,20 @@ class LLMNeedleHaystackTester:
 
         self.needle_start, self.needle_end = self.find_needle_idx(self.real_needle)
         with torch.no_grad():
-            q_outputs = self.model_to_test(input_ids=input_ids[:, :-1], use_cache=True, return_dict=True)
-            output, retrieval_score = self.decode(q_outputs, input_ids[:, -1], 50)
+            decode_len = 50
+            if self.kv_topk:
+                past_kv = RetrievalHeadKVCache(self.retrieval_heads, self.num_key_value_groups,
+                                               self.kv_sink_size, self.kv_window_size, decode_len)
+            elif self.sparse_topk:
+                index_kwargs = {"nprobe": self.sparse_nprobe} if self.sparse_index == "ivf" else {}
+                past_kv = SparseKVCache(input_ids.shape[1] + decode_len, self.sparse_head_list, self.sparse_topk,
+                                        self.sparse_window_size, self.sparse_index, index_kwargs, track_recall=self.sparse_track_recall)
+            else:
+                # reserve the whole prompt + answer once, decode steps then write into the cache in place
+                past_kv = StaticSlabCache(input_ids.shape[1] + decode_len)
+            q_outputs = self.model_to_test(input_ids=input_ids[:, :-1], past_key_values=past_kv, use_cache=True, return_dict=True,
+                                           **self.forward_kwargs)
+            output, retrieval_score = self.decode(q_outputs, input_ids[:, -1], decode_len)
             response = self.enc.decode(output, skip_special_tokens=True).strip()
 
         test_end_time = time.time()
@@ -390,6 +470,14 @@ class LLMNeedleHaystackTester:
             'test_duration_seconds': test_elapsed_time,
             'test_timestamp_utc': datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S%z')
         }
+        if self.kv_topk:
+            results['kv_cache_bytes'] = past_kv.memory_bytes()
+            results['dense_kv_cache_bytes'] = past_kv.dense_memory_bytes()
+        if self.sparse_track_recall and self.sparse_topk:
+            # recall of the index against exact top-k search, and dense attention mass on the attended positions
+            recall = past_kv.recall_summary()
+            results['sparse_recall'] = recall['recall']
+            results['sparse_attention_mass'] = recall['attention_mass']
 
         self.testing_results.append(results)
 
@@ -399,51 +487,40 @@ class LLMNeedleHaystackTester:
             print(f"Context: {context_length} tokens")
             print(f"Depth: {depth_percent}%")
             print(f"Score: {score}")
+            if self.kv_topk:
+                print(f"KV cache: {results['kv_cache_bytes'] / 2 ** 20:.1f} MiB, {results['dense_kv_cache_bytes'] / results['kv_cache_bytes']:.1f}x smaller than dense")
+            if self.sparse_track_recall and self.sparse_topk:
+                print(f"Sparse recall@{self.sparse_topk}: {results['sparse_recall']}, attention mass: {results['sparse_attention_mass']}")
             print(f"Response: {response}\n")
 
-        context_file_location = f'{self.model_version.replace(".", "_")}_len_{context_length}_depth_{int(depth_percent * 100)}'
-
         if self.save_results:
-            # Save the context to file for retesting
-            if not os.path.exists(f'results/graph/{save_name}'):
-                os.makedirs(f'results/graph/{save_name}')
+            # Append the result to the results file of the run
+            results_store = self.get_results_store(save_name)
+            print("Writing at %s" % results_store.path)
+            results_store.append(results)
 
-            # Save the result to file for retesting
-            p = f'results/graph/{save_name}/{context_file_location}_results.json'
-            print("Writing at %s" % p)
-            with open(p, 'w') as f:
-                json.dump(results, f)
+    def get_results_store(self, save_name):
+        if save_name not in self.results_store:
+            self.results_store[save_name] = ResultsStore(f'results/graph/{save_name}')
+        return self.results_store[save_name]
 
     def result_exists(self, context_length, depth_percent):
         """
-        Checks to see if a result has already been evaluated or not
+        Checks to see if a result has already been evaluated or not, with a lookup in the results store of the run
         """
-
-        results_dir = 'results/' + self.model_version
-        print("Searching existing results at %s" % results_dir)
-        if not os.path.exists(results_dir):
-            return False
-        for filename in os.listdir(results_dir):
-            if filename.endswith('.json'):
-                with open(os.path.join(results_dir, filename), 'r') as f:
-                    result = json.load(f)
-                    context_length_met = result['context_length'] == context_length
-                    depth_percent_met = result['depth_percent'] == depth_percent
-                    version_met = result.get('version', 1) == self.results_version
-                    model_met = result['model'] == self.model_name
-                    # import ipdb; ipdb.set_trace()
-                    if context_length_met and depth_percent_met and version_met and model_met:
-                        return True
-        return False
+        point = {'model': self.model_to_test_description, 'version': self.results_version,
+                 'context_length': context_length, 'depth_percent': depth_percent, 'needle': self.needle}
+        return point in self.get_results_store(self.get_save_name())
 
     def generate_context(self, context_length, depth_percent):
         # Load up tiktoken so we navigate tokens more easily
 
-        # Get your Paul Graham files loaded into a string
-        context = self.read_context_files()
+        # Get your Paul Graham files tokenized, the ids are cached on disk across runs
+        corpus = self.get_corpus()
 
         # Truncate the Paul Graham essays to the context length you desire
-        context = self.encode_and_trim(context, context_length)
+        tokens = self.enc.build_inputs_with_special_tokens(corpus.token_ids[:context_length].tolist())
+        context = self.decode_tokens(tokens, context_length)
 
         # Insert your random statement according to your depth percent
         context = self.insert_needle(context, depth_percent, context_length)
@@ -478,31 +555,16 @@ class LLMNeedleHaystackTester:
             insertion_point = int(len(tokens_context) * (depth_percent / 100))
             # import ipdb; ipdb.set_trace()
 
-            # tokens_new_context represents the tokens before the needle
-            tokens_new_context = tokens_context[:insertion_point]
-
             # We want to make sure that we place our needle at a sentence break so we first see what token a '.' is
-            if (self.model_provider in ["LLaMA", "LongLLaMA"]):
-                if self.encode_text_to_tokens('.')[0] in [29889, 869]:
-                    period_tokens = [29889, 869]
-                else:
-                    period_tokens = [88946, 13]
-            elif (self.model_provider == "Mistral"):
-                period_tokens = [842, 28723]
-            elif (self.model_provider == "GLM"):
-                period_tokens = [918, 30930]
-            else:
-                period_tokens = self.encode_text_to_tokens('.')
+            period_tokens = period_token_family(self.enc('.', add_special_tokens=False)["input_ids"][-1])
 
-            # Then we iteration backwards until we find the first period
-            while tokens_new_context and tokens_new_context[-1] not in period_tokens:
-                insertion_point -= 1
-                tokens_new_context = tokens_context[:insertion_point]
+            # Then we snap back to right after the last period, a bisect over the sorted period positions
+            insertion_point = snap_to_sentence_start(period_positions(tokens_context, period_tokens), insertion_point)
 
             print("insertion at %d" % insertion_point)
             # Once we get there, then add in your needle, and stick the rest of your context in on the other end.
             # Now we have a needle in a haystack
-            tokens_new_context += tokens_needle + tokens_context[insertion_point:]
+            tokens_new_context = tokens_context[:insertion_point] + tokens_needle + tokens_context[insertion_point:]
 
         # Convert back to a string and return it
         new_context = self.decode_tokens(tokens_new_context)
@@ -519,6 +581,11 @@ class LLMNeedleHaystackTester:
 
             raise ValueError("model_provider must be either 'OpenAI' or 'Anthropic'")
 
+    def get_corpus(self):
+        if self.corpus is None:
+            self.corpus = HaystackCorpus(self.enc, self.haystack_dir, max(self.context_lengths), count_tokens=True)
+        return self.corpus
+
     def read_context_files(self):
         context = ""
         max_context_length = max(self.context_lengths)
@@ -571,7 +638,23 @@ class LLMNeedleHaystackTester:
         if self.print_ongoing_status:
             self.print_start_test_summary()
         # asyncio.run(self.run_test())
-        self.run_test(args)
+        if args.queue:
+            self.run_queue(args)
+        else:
+            self.run_test(args)
+
+    def run_queue(self, args):
+        """
+        Works through the shared sweep queue `args.queue`, most expensive grid point first, instead of the ascending
+        grid of run_test. See sweep_scheduler.py.
+        """
+        queue = SweepQueue(args.queue)
+        queue.add(sweep_tasks(self.context_lengths, self.document_depth_percents, args.s_len, args.e_len, mask_topk=self.mask_topk))
+
+        def evaluate(task):
+            if args.rerun or not self.result_exists(task["context_length"], task["depth_percent"]):
+                self.evaluate_and_log(task["context_length"], task["depth_percent"])
+        run_worker(queue, evaluate, accept=lambda task: task["mask_topk"] == self.mask_topk)
 
 
 if __name__ == "__main__":
@@ -586,6 +669,17 @@ if __name__ == "__main__":
     parser.add_argument('--api_key', type=str, default="", help='OpenAI API Key')
     parser.add_argument('--mask_topk', type=int, default=0,
                         help='mask topk heads, input a negative value to mask random heads')
+    parser.add_argument('--kv_topk', type=int, default=0, help='keep the full kv cache only for the top k retrieval heads, sinks and a recent window for the others')
+    parser.add_argument('--kv_sink_size', type=int, default=4, help='leading positions kept for the non retrieval heads with --kv_topk')
+    parser.add_argument('--kv_window_size', type=int, default=256, help='recent positions kept for the non retrieval heads with --kv_topk')
+    parser.add_argument('--sparse_topk', type=int, default=0, help='decode with attn_mode "sparse", heads attend to their top k keys retrieved by an index over the prompt keys (Llama only)')
+    parser.add_argument('--sparse_heads', type=int, default=0, help='number of top retrieval heads attending sparsely with --sparse_topk, 0 for every head')
+    parser.add_argument('--sparse_window_size', type=int, default=128, help='recent positions the sparse heads attend to besides the retrieved keys')
+    parser.add_argument('--sparse_index', type=str, default="ivf", choices=["ivf", "flat"], help='index of the prompt keys, flat is exact search')
+    parser.add_argument('--sparse_nprobe', type=int, default=8, help='lists scanned per query by the ivf index')
+    parser.add_argument('--sparse_track_recall', action='store_true', help='record the index recall and attention mass of --sparse_topk, scores every prompt key at every step')
+    parser.add_argument('--rerun', action='store_true', help='evaluate grid points that already have a result instead of skipping them')
+    parser.add_argument('--queue', type=str, default=None, help='work through this shared sweep queue directory, longest contexts first (see sweep_scheduler.py)')
     # parser = add_args(parser)
     args = parser.parse_args()
 
@@ -601,6 +695,15 @@ if __name__ == "__main__":
                                  save_contexts=True,
                                  save_results=True,
                                  mask_topk=args.mask_topk,
+                                 kv_topk=args.kv_topk,
+                                 kv_sink_size=args.kv_sink_size,
+                                 kv_window_size=args.kv_window_size,
+                                 sparse_topk=args.sparse_topk,
+                                 sparse_heads=args.sparse_heads,
+                                 sparse_window_size=args.sparse_window_size,
+                                 sparse_index=args.sparse_index,
+                                 sparse_nprobe=args.sparse_nprobe,
+                                 sparse_track_recall=args.sparse_track_recall,
                                  context_lengths_min=args.s_len,
                                  context_lengths_max=args.e_len,
                                  )
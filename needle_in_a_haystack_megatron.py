@@ -37,14 +37,15 @@ python -u needle_in_haystack.py --s_len 0 --e_len 128000\
 import os
 import glob
 import json
-from functools import partial
-
 from transformers import AutoTokenizer, AutoConfig, AutoModelForCausalLM
 import sys
 import random
 
 
 import numpy as np
+from haystack_corpus import period_positions, period_token_family, read_haystack, snap_to_sentence_start
+from sweep_scheduler import SweepQueue, run_worker, sweep_tasks
+from results_store import ResultsStore
 import argparse
 from rouge_score import rouge_scorer
 
@@ -54,81 +55,9 @@ from datetime import datetime, timezone
 from collections import defaultdict
 import time
 import torch
-import requests
-
-def megatron_client_generate(url, prompt, tokens_to_generate):
-    headers = {'Content-Type': 'application/json'}
-
-    data = {"prompts": [prompt], "tokens_to_generate": tokens_to_generate, "add_BOS": False, "random_seed": 0, "top_k": 1}
-    response = requests.put(url, data=json.dumps(data), headers=headers)
-
-    if response.status_code != 200:
-        print(data)
-        raise ValueError(f"Error {response.status_code}: {response.json()}")
-    else:
-        try:
-            return response.json()['text'][0]
-        except:
-            print(data)
-            print(response.json())
-            raise ValueError("Error in response")
-
-def megatron_client_tokenize(url, text):
-    headers = {'Content-Type': 'application/json'}
-    data = {"texts": [text],  "add_BOS": False}
-    # print("data", data)
-    response = requests.put(url, data=json.dumps(data), headers=headers)
-
-    if response.status_code != 200:
-        raise ValueError(f"Error {response.status_code}: {response.json()}")
-    else:
-        # print(response.json())
-        return response.json()['token_ids'][0]
-
-def megatron_client_detokenize(url, tokens):
-    headers = {'Content-Type': 'application/json'}
-
-    data = {"tokens": [tokens]}
-    response = requests.put(url, data=json.dumps(data), headers=headers)
-
-    if response.status_code != 200:
-        raise ValueError(f"Error {response.status_code}: {response.json()}")
-    else:
-        return response.json()['texts'][0]
-
-def megatron_client_modify_window_size(url, window_size):
-    headers = {'Content-Type': 'application/json'}
-
-    data = {"window_size": window_size}
-    response = requests.put(url, data=json.dumps(data), headers=headers)
-
-    if response.status_code != 200:
-        raise ValueError(f"Error {response.status_code}: {response.json()}")
-    else:
-        return
-
-def get_url(base_url, request_type):
-    base_url = base_url.strip()
-    print("base_url", base_url)
-    print("request_type", request_type)
-    if request_type == "generate":
-        return f"http://{base_url}/api"
-    elif request_type == "tokenize":
-        # print("http:")
-        # print("http://")
-        # print("http://" + base_url )
-        # print(repr(base_url))
-        # print("http://" + base_url + "/api/tokenize")
-
-        # print(f"http://{base_url}/api/tokenize")
-        # print("END")
-        return f"http://{base_url}/api/tokenize"
-    elif request_type == "detokenize":
-        return f"http://{base_url}/api/detokenize"
-    elif request_type == "modify_window_size":
-        return f"http://{base_url}/api/modify_window_size"
-    else:
-        raise ValueError("Invalid request type. Must be 'generate', 'tokenize', or 'detokenize', or 'modify_window_size'.")
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from megatron_client import LocalTokenizer, MegatronClient
 
 def reset_rope(model, model_max_train_len, scaling_factor):
     for l in model.model.layers:
@@ -170,7 +99,8 @@ class LLMNeedleHaystackTester:
                  seconds_to_sleep_between_completions = None,
                  print_ongoing_status = True,
                  device = "auto",
-                 window_size = None):
+                 window_size = None,
+                 local_tokenizer = None):
         """
         :param needle: The needle to be found in the haystack. Default is None.
         :param haystack_dir: The directory of text files to use as background context (or a haystack) in which the needle is to be found. Default is Paul Graham Essays.
@@ -196,6 +126,7 @@ class LLMNeedleHaystackTester:
         :param seconds_to_sleep_between_completions: The number of seconds to sleep between completions. Default is None.
         :param print_ongoing_status: Whether or not to print the ongoing status. Default is True.
         :param window_size: The window size for the model. Default is None. Must be one integer.
+        :param local_tokenizer: Path of the Hugging Face tokenizer the server runs with, to tokenize locally instead of through the server. Checked once against the server. Default is None.
         """
         if not needle or not haystack_dir or not retrieval_question:
             raise ValueError("Needle, haystack, and retrieval_question must be provided.")
@@ -214,6 +145,8 @@ class LLMNeedleHaystackTester:
         if model_provider != 'Megatron':
             raise ValueError("Model provider must be Megatron")
         self.testing_results = []
+        self.results_store = {}
+        self.results_lock = threading.Lock()
         self.head_counter = defaultdict(list)
         self.mask_topk = mask_topk
         self.service_url = service_url
@@ -258,19 +191,18 @@ class LLMNeedleHaystackTester:
             raise ValueError("document_depth_percent_interval_type must be either None, 'linear' or 'sigmoid'. If you'd like your own distribution give a list of ints in via document_depth_percent_intervals")
         self.device = device
         self.model_name = model_name
-        class WebTokenizer:
-            def __init__(self, url):
-                self.url = url
-
-            def tokenize(self, text):
-                return megatron_client_tokenize(get_url(self.url, "tokenize"), text)
-
-            def detokenize(self, tokens):
-                return megatron_client_detokenize(get_url(self.url, "detokenize"), tokens)
-        self.enc = WebTokenizer(self.service_url)
+        # one pooled client for tokenization and generation, with a connection per concurrent request
+        self.client = MegatronClient(self.service_url, concurrency=num_concurrent_requests)
+        if local_tokenizer is not None:
+            # keep the haystack off the wire, the server is then only used for generation
+            self.enc = LocalTokenizer(local_tokenizer).verify(self.client)
+            print("Tokenizing locally with %s, matches the server" % local_tokenizer)
+        else:
+            self.enc = self.client
+        self.haystack, self.haystack_tokens = None, None
 
         self.model_version += "_" + self.model_provider
-        self.model_to_test = partial(megatron_client_generate, get_url(self.service_url, "generate"))
+        self.model_to_test = self.client.generate
 
         self.model_to_test_description = model_name
 
@@ -283,7 +215,7 @@ class LLMNeedleHaystackTester:
         if window_size is not None:
             self.window_size = [int(window_size), 0]
         print("Setting window size to", window_size)
-        megatron_client_modify_window_size(get_url(self.service_url, "modify_window_size"), self.window_size)
+        self.client.modify_window_size(self.window_size)
 
     def logistic(self, x, L=100, x0=50, k=.1):
         if x == 0:
@@ -302,7 +234,12 @@ class LLMNeedleHaystackTester:
         for context_length in self.context_lengths:
             if context_length < args.s_len or context_length > args.e_len: continue
             for depth_percent in self.document_depth_percents:
-                task = self.bound_evaluate_and_log(context_length, depth_percent)
+                if not args.rerun and self.result_exists(context_length, depth_percent): continue
+                tasks.append((context_length, depth_percent))
+        # the grid points only wait on the server, keep num_concurrent_requests of them in flight
+        with ThreadPoolExecutor(max_workers=self.num_concurrent_requests) as pool:
+            for _ in pool.map(lambda task: self.bound_evaluate_and_log(*task), tasks):
+                pass
 
     def generate_anthropic_prompt(self, context):
         # Generate the prompt for the Anthropic model
@@ -359,19 +296,28 @@ class LLMNeedleHaystackTester:
                 results.append((l, h))
         return results
 
+    def get_save_name(self):
+        """
+        Results directory name of the run, one per mask config.
+        """
+        if self.mask_topk > 0:
+            return f"{self.model_version}_block_top{self.mask_topk}"
+        elif self.mask_topk == 0:
+            return self.model_version
+        else:
+            return f"{self.model_version}_block_random{-self.mask_topk}"
+
     def evaluate_and_log(self, context_length, depth_percent):
         # Checks to see if you've already checked a length/percent/version.
         # This helps if the program stop running and you want to restart later
         # Go generate the required length context and place your needle statement in
         if self.mask_topk > 0:
             block_list = self.block_list[:self.mask_topk]
-            save_name = f"{self.model_version}_block_top{self.mask_topk}"
         elif self.mask_topk == 0:
             block_list = None
-            save_name = self.model_version
         else:
             block_list = self.construct_random_head(-self.mask_topk)
-            save_name = f"{self.model_version}_block_random{-self.mask_topk}"
+        save_name = self.get_save_name()
         context = self.generate_context(context_length, depth_percent)
         question = f"Based on the content of the book, Question: {self.retrieval_question}\nAnswer:"
         input_context = context + question
@@ -422,40 +368,27 @@ class LLMNeedleHaystackTester:
             print(f"Score: {score}")
             print(f"Response: {response}\n")
 
-        context_file_location = f'{self.model_version.replace(".", "_")}_len_{context_length}_depth_{int(depth_percent * 100)}'
-
         if self.save_results:
-            # Save the context to file for retesting
-            if not os.path.exists(f'results/graph/{save_name}'):
-                os.makedirs(f'results/graph/{save_name}')
+            # Append the result to the results file of the run, one writer at a time
+            with self.results_lock:
+                results_store = self.get_results_store(save_name)
+                print("Writing at %s" % results_store.path)
+                results_store.append(results)
 
-            # Save the result to file for retesting
-            p = f'results/graph/{save_name}/{context_file_location}_results.json'
-            print("Writing at %s" % p)
-            with open(p, 'w') as f:
-                json.dump(results, f)
+    def get_results_store(self, save_name):
+        if save_name not in self.results_store:
+            self.results_store[save_name] = ResultsStore(f'results/graph/{save_name}')
+        return self.results_store[save_name]
 
     def result_exists(self, context_length, depth_percent):
         """
-        Checks to see if a result has already been evaluated or not
+        Checks to see if a result has already been evaluated or not, with a lookup in the results store of the run.
+        Called from the queue worker threads, so the store is created and read under results_lock.
         """
-
-        results_dir = 'results/' + self.model_version
-        print("Searching existing results at %s" % results_dir)
-        if not os.path.exists(results_dir):
-            return False
-        for filename in os.listdir(results_dir):
-            if filename.endswith('.json'):
-                with open(os.path.join(results_dir, filename), 'r') as f:
-                    result = json.load(f)
-                    context_length_met = result['context_length'] == context_length
-                    depth_percent_met = result['depth_percent'] == depth_percent
-                    version_met = result.get('version', 1) == self.results_version
-                    model_met = result['model'] == self.model_name
-                    # import ipdb; ipdb.set_trace()
-                    if context_length_met and depth_percent_met and version_met and model_met:
-                        return True
-        return False
+        point = {'model': self.model_to_test_description, 'version': self.results_version,
+                 'context_length': context_length, 'depth_percent': depth_percent, 'needle': self.needle}
+        with self.results_lock:
+            return point in self.get_results_store(self.get_save_name())
 
     def generate_context(self, context_length, depth_percent):
         # Load up tiktoken so we navigate tokens more easily
@@ -492,9 +425,6 @@ class LLMNeedleHaystackTester:
             insertion_point = int(len(tokens_context) * (depth_percent / 100))
             # import ipdb; ipdb.set_trace()
 
-            # tokens_new_context represents the tokens before the needle
-            tokens_new_context = tokens_context[:insertion_point]
-
             # We want to make sure that we place our needle at a sentence break so we first see what token a '.' is
 
 
@@ -515,26 +445,15 @@ class LLMNeedleHaystackTester:
                 period_tokens = get_period_tokens()
             else:
                 period_token = get_token_memoization(self.enc, '.')[-1]
-                if period_token in [29889, 869]:
-                    period_tokens = [29889, 869]
-                elif period_token in [88946, 13]:
-                    period_tokens = [88946, 13]
-                elif period_token in [842, 28723]:
-                    period_tokens = [842, 28723]
-                elif period_token in [918, 30930]:
-                    period_tokens = [918, 30930]
-                else:
-                    period_tokens = [period_token]
-
-            # Then we iteration backwards until we find the first period
-            while tokens_new_context and tokens_new_context[-1] not in period_tokens:
-                insertion_point -= 1
-                tokens_new_context = tokens_context[:insertion_point]
+                period_tokens = period_token_family(period_token)
+
+            # Then we snap back to right after the last period, a bisect over the sorted period positions
+            insertion_point = snap_to_sentence_start(period_positions(tokens_context, period_tokens), insertion_point)
 
             print("insertion at %d" % insertion_point)
             # Once we get there, then add in your needle, and stick the rest of your context in on the other end.
             # Now we have a needle in a haystack
-            tokens_new_context += tokens_needle + tokens_context[insertion_point:]
+            tokens_new_context = tokens_context[:insertion_point] + tokens_needle + tokens_context[insertion_point:]
 
         # Convert back to a string and return it
         new_context = self.decode_tokens(tokens_new_context)
@@ -544,16 +463,21 @@ class LLMNeedleHaystackTester:
         return len(self.encode_text_to_tokens(context))
 
     def read_context_files(self):
-        context = ""
-        max_context_length = max(self.context_lengths)
-
-        while self.get_context_length_in_tokens(context) < max_context_length:
-            for file in glob.glob(f"{self.haystack_dir}/*.txt"):
-                with open(file, 'r') as f:
-                    context += f.read()
-        return context
+        # Built once per run: repeat the directory until it has max_context_length tokens, sized from one pass
+        if self.haystack is None:
+            max_context_length = max(self.context_lengths)
+            single_pass = read_haystack(self.haystack_dir, 1)
+            repeats = -(-max_context_length // max(self.get_context_length_in_tokens(single_pass), 1))
+            self.haystack_tokens = self.encode_text_to_tokens(single_pass * repeats)
+            while len(self.haystack_tokens) < max_context_length:
+                repeats += 1
+                self.haystack_tokens = self.encode_text_to_tokens(single_pass * repeats)
+            self.haystack = single_pass * repeats
+        return self.haystack
 
     def get_tokens_from_context(self, context):
+        if context is self.haystack:
+            return self.haystack_tokens
         return self.encode_text_to_tokens(context)
 
     def decode_tokens(self, tokens, context_length=None):
@@ -583,7 +507,32 @@ class LLMNeedleHaystackTester:
         if self.print_ongoing_status:
             self.print_start_test_summary()
         #asyncio.run(self.run_test())
-        self.run_test(args)
+        # build the haystack once, before grid points run concurrently
+        self.read_context_files()
+        if args.queue:
+            self.run_queue(args)
+        else:
+            self.run_test(args)
+        print("request timings (s): %s" % self.client.timing_summary())
+
+    def run_queue(self, args):
+        """
+        Works through the shared sweep queue `args.queue`, most expensive grid point first, instead of the ascending
+        grid of run_test. See sweep_scheduler.py. `num_concurrent_requests` worker loops share the queue, so as many
+        grid points are in flight as in run_test.
+        """
+        queue = SweepQueue(args.queue)
+        queue.add(sweep_tasks(self.context_lengths, self.document_depth_percents, args.s_len, args.e_len, mask_topk=self.mask_topk))
+
+        def evaluate(task):
+            if args.rerun or not self.result_exists(task["context_length"], task["depth_percent"]):
+                self.evaluate_and_log(task["context_length"], task["depth_percent"])
+        # claims are atomic renames, so the loops of one process share the queue like separate workers
+        with ThreadPoolExecutor(max_workers=self.num_concurrent_requests) as pool:
+            loops = [pool.submit(run_worker, queue, evaluate, lambda task: task["mask_topk"] == self.mask_topk)
+                     for _ in range(self.num_concurrent_requests)]
+            for loop in loops:
+                loop.result()
 
 
 token_dict = {}
@@ -609,6 +558,10 @@ if __name__ == "__main__":
     parser.add_argument('--device', type=str, default="auto", help="device")
     parser.add_argument('--url', type=str, default="localhost:5000", help="service url")
     parser.add_argument('--window-size', type=str, default=None, help="model window size")
+    parser.add_argument('--local_tokenizer', type=str, default=None, help="path of the tokenizer the server runs with, tokenize locally instead of through the server")
+    parser.add_argument('--num_concurrent_requests', type=int, default=1, help="generate requests kept in flight against the server")
+    parser.add_argument('--rerun', action='store_true', help='evaluate grid points that already have a result instead of skipping them')
+    parser.add_argument('--queue', type=str, default=None, help='work through this shared sweep queue directory, longest contexts first (see sweep_scheduler.py)')
     # parser = add_args(parser)
     args = parser.parse_args()
 
@@ -630,6 +583,8 @@ if __name__ == "__main__":
                                 context_lengths_num_intervals=args.num_intervals,
                                 device=args.device,
                                 service_url=args.url,
+                                num_concurrent_requests=args.num_concurrent_requests,
+                                local_tokenizer=args.local_tokenizer,
                                 window_size=args.window_size
       )
 
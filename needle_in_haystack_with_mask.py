@@ -47,6 +47,12 @@ from source.modeling_qwen2 import Qwen2ForCausalLM
 from source.modeling_mixtral import MixtralForCausalLM
 from source.modeling_mistral import MistralForCausalLM
 from source.modeling_phi3 import Phi3ForCausalLM
+from source.cache_utils import StaticSlabCache
+from source.attention_utils import prune_attention_heads
+from haystack_corpus import HaystackCorpus, period_positions, period_token_family, snap_to_sentence_start
+from head_score_store import load_head_ranking
+from sweep_scheduler import SweepQueue, run_worker, sweep_tasks
+from results_store import ResultsStore
 
 import numpy as np
 import argparse
@@ -90,6 +96,7 @@ class LLMNeedleHaystackTester:
                  document_depth_percent_interval_type="linear",
                  model_provider="OpenAI",
                  mask_topk=0,
+                 prune=False,
                  anthropic_api_key=None,
                  model_name='',
                  model_name_suffix=None,
@@ -124,12 +131,14 @@ class LLMNeedleHaystackTester:
         :param model_name: The name of the model. Default is 'gpt-4-1106-preview'.
         :param seconds_to_sleep_between_completions: The number of seconds to sleep between completions. Default is None.
         :param print_ongoing_status: Whether or not to print the ongoing status. Default is True.
+        :param prune: Remove the masked heads from the attention layers once, instead of masking them at every forward. Random heads are then drawn once for the whole run. Default is False.
         """
         if not needle or not haystack_dir or not retrieval_question:
             raise ValueError("Needle, haystack, and retrieval_question must be provided.")
 
         self.needle = needle
         self.haystack_dir = haystack_dir
+        self.corpus = None
         self.retrieval_question = retrieval_question
         self.results_version = results_version
         self.num_concurrent_requests = num_concurrent_requests
@@ -140,8 +149,10 @@ class LLMNeedleHaystackTester:
         self.print_ongoing_status = print_ongoing_status
         self.model_provider = model_provider
         self.testing_results = []
+        self.results_store = {}
         self.head_counter = defaultdict(list)
         self.mask_topk = mask_topk
+        self.prune = prune
         if "CUDA_VISIBLE_DEVICES" in os.environ:
             self.multi_gpus = len(os.environ["CUDA_VISIBLE_DEVICES"]) > 1
         else:
@@ -206,13 +217,17 @@ class LLMNeedleHaystackTester:
                     model_name, torch_dtype="auto", device_map='auto', use_flash_attention_2="flash_attention_2",
                     trust_remote_code=True,
                 )
+            elif "Mistral" in self.model_version:
+                self.model_to_test = MistralForCausalLM.from_pretrained(
+                    model_name, torch_dtype="auto", device_map='auto', use_flash_attention_2="flash_attention_2",
+                    trust_remote_code=True,
+                )
             else:
-                # self.model_to_test = LlamaForCausalLM.from_pretrained(model_name,
-                #     use_flash_attention_2="flash_attention_2", torch_dtype=torch.bfloat16,device_map='auto').eval()
-                self.model_to_test = AutoModelForCausalLM.from_pretrained(model_name,
-                                                                          attn_implementation="flash_attention_2",
-                                                                          torch_dtype=torch.bfloat16,
-                                                                          device_map='auto').eval()
+                # the faiss_attn model, the transformers one ignores block_list
+                self.model_to_test = LlamaForCausalLM.from_pretrained(model_name,
+                                                                      attn_implementation="flash_attention_2",
+                                                                      torch_dtype=torch.bfloat16,
+                                                                      device_map='auto').eval()
                 if sliding_window is not None:
                     for decode_layer in self.model_to_test.model.layers:
                         decode_layer.self_attn.sliding_window = sliding_window
@@ -239,15 +254,15 @@ class LLMNeedleHaystackTester:
         if self.mask_topk != 0:
             if model_name == 'Mistral-7B-Instruct-v0.2':
                 model_name = "Mistral-7B-v0.2-hf"
-            with open(f"head_score/{model_name}.json", "r") as file:
-                stable_block_list = json.loads(file.readline())
-            stable_block_list = [(l[0], np.mean(l[1])) for l in stable_block_list.items()]
-            stable_block_list = sorted(stable_block_list, key=lambda x: x[1], reverse=True)
-            self.block_list = [[int(ll) for ll in l[0].split("-")] for l in stable_block_list][:100]
+            self.block_list = load_head_ranking(model_name, 100)
             if self.mask_topk > 0:
                 print(f"masking out top {self.mask_topk} retrieval heads")
             else:
                 print(f"masking out random {-self.mask_topk}  heads")
+            if self.prune:
+                pruned_heads = self.get_block_list()
+                removed = prune_attention_heads(self.model_to_test.model, pruned_heads)
+                print(f"pruned {len(pruned_heads)} heads, {removed} query heads removed from the compute")
         else:
             self.block_list = []
 
@@ -268,6 +283,7 @@ class LLMNeedleHaystackTester:
         for context_length in self.context_lengths:
             if context_length < args.s_len or context_length > args.e_len: continue
             for depth_percent in self.document_depth_percents:
+                if not args.rerun and self.result_exists(context_length, depth_percent): continue
                 task = self.bound_evaluate_and_log(context_length, depth_percent)
 
     def generate_prompt(self, context):
@@ -295,13 +311,13 @@ class LLMNeedleHaystackTester:
             for head_idx in range(32):
                 self.head_counter[f"{layer_idx}-{head_idx}"].append(retrieval_score[layer_idx][head_idx][0])
 
-    def decode(self, q_outputs, inp, decode_len):
+    def decode(self, q_outputs, inp, decode_len, block_list=None):
         output, retrieval_score = [], [[[0, ''] for _ in range(32)] for _ in range(32)]
         past_kv = q_outputs.past_key_values
         for step_i in range(decode_len):
             inp = inp.view(1, 1)
             outputs = self.model_to_test(input_ids=inp, past_key_values=past_kv, use_cache=True, \
-                                         output_attentions=False)
+                                         output_attentions=False, block_list=block_list)
             past_kv = outputs.past_key_values
             inp = outputs.logits[0, -1].argmax()
             step_token = self.enc.convert_ids_to_tokens(inp.item())
@@ -336,19 +352,36 @@ class LLMNeedleHaystackTester:
                 results.append((l, h))
         return results
 
+    def get_block_list(self):
+        """
+        Heads to mask: the top retrieval heads, or random heads drawn anew at every call.
+        """
+        if self.mask_topk > 0:
+            return self.block_list[:self.mask_topk]
+        elif self.mask_topk == 0:
+            return None
+        else:
+            return self.construct_random_head(-self.mask_topk)
+
+    def get_save_name(self):
+        """
+        Results directory name of the run, one per mask config.
+        """
+        mode = "prune" if self.prune else "block"
+        if self.mask_topk > 0:
+            return f"{self.model_version}_{mode}_top{self.mask_topk}"
+        elif self.mask_topk == 0:
+            return self.model_version
+        else:
+            return f"{self.model_version}_{mode}_random{-self.mask_topk}"
+
     def evaluate_and_log(self, context_length, depth_percent):
         # Checks to see if you've already checked a length/percent/version.
         # This helps if the program stop running and you want to restart later
         # Go generate the required length context and place your needle statement in
-        if self.mask_topk > 0:
-            block_list = self.block_list[:self.mask_topk]
-            save_name = f"{self.model_version}_block_top{self.mask_topk}"
-        elif self.mask_topk == 0:
-            block_list = None
-            save_name = self.model_version
-        else:
-            block_list = self.construct_random_head(-self.mask_topk)
-            save_name = f"{self.model_version}_block_random{-self.mask_topk}"
+        # pruned heads are already gone from the model
+        block_list = None if self.prune else self.get_block_list()
+        save_name = self.get_save_name()
         context = self.generate_context(context_length, depth_percent)
         question = f"Based on the content of the book, Question: {self.retrieval_question}\nAnswer:"
         if self.model_version in ["Mistral-7B-Instruct-v0.2", "Qwen1.5-14B-Chat"]:
@@ -372,8 +405,12 @@ class LLMNeedleHaystackTester:
 
         self.needle_start, self.needle_end = self.find_needle_idx(self.real_needle)
         with torch.no_grad():
-            q_outputs = self.model_to_test(input_ids=input_ids[:, :-1], use_cache=True, return_dict=True)
-            output, retrieval_score = self.decode(q_outputs, input_ids[:, -1], 50)
+            decode_len = 50
+            # reserve the whole prompt + answer once, decode steps then write into the cache in place
+            past_kv = StaticSlabCache(input_ids.shape[1] + decode_len)
+            q_outputs = self.model_to_test(input_ids=input_ids[:, :-1], past_key_values=past_kv, use_cache=True, return_dict=True,
+                                           block_list=block_list)
+            output, retrieval_score = self.decode(q_outputs, input_ids[:, -1], decode_len, block_list)
             response = self.enc.decode(output, skip_special_tokens=True).strip()
 
         test_end_time = time.time()
@@ -402,49 +439,34 @@ class LLMNeedleHaystackTester:
             print(f"Score: {score}")
             print(f"Response: {response}\n")
 
-        context_file_location = f'{self.model_version.replace(".", "_")}_len_{context_length}_depth_{int(depth_percent * 100)}'
-
         if self.save_results:
-            # Save the context to file for retesting
-            if not os.path.exists(f'results/graph/{save_name}'):
-                os.makedirs(f'results/graph/{save_name}')
+            # Append the result to the results file of the run
+            results_store = self.get_results_store(save_name)
+            print("Writing at %s" % results_store.path)
+            results_store.append(results)
 
-            # Save the result to file for retesting
-            p = f'results/graph/{save_name}/{context_file_location}_results.json'
-            print("Writing at %s" % p)
-            with open(p, 'w') as f:
-                json.dump(results, f)
+    def get_results_store(self, save_name):
+        if save_name not in self.results_store:
+            self.results_store[save_name] = ResultsStore(f'results/graph/{save_name}')
+        return self.results_store[save_name]
 
     def result_exists(self, context_length, depth_percent):
         """
-        Checks to see if a result has already been evaluated or not
+        Checks to see if a result has already been evaluated or not, with a lookup in the results store of the run
         """
-
-        results_dir = 'results/' + self.model_version
-        print("Searching existing results at %s" % results_dir)
-        if not os.path.exists(results_dir):
-            return False
-        for filename in os.listdir(results_dir):
-            if filename.endswith('.json'):
-                with open(os.path.join(results_dir, filename), 'r') as f:
-                    result = json.load(f)
-                    context_length_met = result['context_length'] == context_length
-                    depth_percent_met = result['depth_percent'] == depth_percent
-                    version_met = result.get('version', 1) == self.results_version
-                    model_met = result['model'] == self.model_name
-                    # import ipdb; ipdb.set_trace()
-                    if context_length_met and depth_percent_met and version_met and model_met:
-                        return True
-        return False
+        point = {'model': self.model_to_test_description, 'version': self.results_version,
+                 'context_length': context_length, 'depth_percent': depth_percent, 'needle': self.needle}
+        return point in self.get_results_store(self.get_save_name())
 
     def generate_context(self, context_length, depth_percent):
         # Load up tiktoken so we navigate tokens more easily
 
-        # Get your Paul Graham files loaded into a string
-        context = self.read_context_files()
+        # Get your Paul Graham files tokenized, the ids are cached on disk across runs
+        corpus = self.get_corpus()
 
         # Truncate the Paul Graham essays to the context length you desire
-        context = self.encode_and_trim(context, context_length)
+        tokens = self.enc.build_inputs_with_special_tokens(corpus.token_ids[:context_length].tolist())
+        context = self.decode_tokens(tokens, context_length)
 
         # Insert your random statement according to your depth percent
         context = self.insert_needle(context, depth_percent, context_length)
@@ -479,31 +501,16 @@ class LLMNeedleHaystackTester:
             insertion_point = int(len(tokens_context) * (depth_percent / 100))
             # import ipdb; ipdb.set_trace()
 
-            # tokens_new_context represents the tokens before the needle
-            tokens_new_context = tokens_context[:insertion_point]
-
             # We want to make sure that we place our needle at a sentence break so we first see what token a '.' is
-            if (self.model_provider in ["LLaMA", "LongLLaMA"]):
-                if self.encode_text_to_tokens('.')[0] in [29889, 869]:
-                    period_tokens = [29889, 869]
-                else:
-                    period_tokens = [88946, 13]
-            elif (self.model_provider == "Mistral"):
-                period_tokens = [842, 28723]
-            elif (self.model_provider == "GLM"):
-                period_tokens = [918, 30930]
-            else:
-                period_tokens = self.encode_text_to_tokens('.')
+            period_tokens = period_token_family(self.enc('.', add_special_tokens=False)["input_ids"][-1])
 
-            # Then we iteration backwards until we find the first period
-            while tokens_new_context and tokens_new_context[-1] not in period_tokens:
-                insertion_point -= 1
-                tokens_new_context = tokens_context[:insertion_point]
+            # Then we snap back to right after the last period, a bisect over the sorted period positions
+            insertion_point = snap_to_sentence_start(period_positions(tokens_context, period_tokens), insertion_point)
 
             print("insertion at %d" % insertion_point)
             # Once we get there, then add in your needle, and stick the rest of your context in on the other end.
             # Now we have a needle in a haystack
-            tokens_new_context += tokens_needle + tokens_context[insertion_point:]
+            tokens_new_context = tokens_context[:insertion_point] + tokens_needle + tokens_context[insertion_point:]
 
         # Convert back to a string and return it
         new_context = self.decode_tokens(tokens_new_context)
@@ -520,6 +527,11 @@ class LLMNeedleHaystackTester:
 
             raise ValueError("model_provider must be either 'OpenAI' or 'Anthropic'")
 
+    def get_corpus(self):
+        if self.corpus is None:
+            self.corpus = HaystackCorpus(self.enc, self.haystack_dir, max(self.context_lengths), count_tokens=True)
+        return self.corpus
+
     def read_context_files(self):
         context = ""
         max_context_length = max(self.context_lengths)
@@ -572,7 +584,23 @@ class LLMNeedleHaystackTester:
         if self.print_ongoing_status:
             self.print_start_test_summary()
         #asyncio.run(self.run_test())
-        self.run_test(args)
+        if args.queue:
+            self.run_queue(args)
+        else:
+            self.run_test(args)
+
+    def run_queue(self, args):
+        """
+        Works through the shared sweep queue `args.queue`, most expensive grid point first, instead of the ascending
+        grid of run_test. See sweep_scheduler.py.
+        """
+        queue = SweepQueue(args.queue)
+        queue.add(sweep_tasks(self.context_lengths, self.document_depth_percents, args.s_len, args.e_len, mask_topk=self.mask_topk))
+
+        def evaluate(task):
+            if args.rerun or not self.result_exists(task["context_length"], task["depth_percent"]):
+                self.evaluate_and_log(task["context_length"], task["depth_percent"])
+        run_worker(queue, evaluate, accept=lambda task: task["mask_topk"] == self.mask_topk)
 
 
 if __name__ == "__main__":
@@ -586,8 +614,11 @@ if __name__ == "__main__":
     parser.add_argument('--model_provider', type=str, default="LLaMA", help='which model to use')
     parser.add_argument('--api_key', type=str, default="", help='OpenAI API Key')
     parser.add_argument('--mask_topk', type=int, default=0, help='mask topk heads, input a negative value to mask random heads')
+    parser.add_argument('--prune', action='store_true', help='remove the masked heads from the model instead of masking them, results go to <model>_prune_top<k>')
     parser.add_argument('--num_intervals', type=int, default=40, help='number of intervals of the test')
     parser.add_argument('--device', type=str, default="auto", help="device")
+    parser.add_argument('--rerun', action='store_true', help='evaluate grid points that already have a result instead of skipping them')
+    parser.add_argument('--queue', type=str, default=None, help='work through this shared sweep queue directory, longest contexts first (see sweep_scheduler.py)')
     # parser = add_args(parser)
     args = parser.parse_args()
 
@@ -603,6 +634,7 @@ if __name__ == "__main__":
                                  save_contexts=True,
                                  save_results=True,
                                  mask_topk=args.mask_topk,
+                                 prune=args.prune,
                                 context_lengths_min=args.s_len,
                                 context_lengths_max=args.e_len,
                                 context_lengths_num_intervals=args.num_intervals,
@@ -0,0 +1,196 @@
+"""
+Consolidated results of the needle runs.
+
+A run is a results directory results/graph/<save_name>, one per model and mask config (`<model>`,
+`<model>_block_top<k>` or `<model>_block_random<k>`, `prune` instead of `block` for pruned heads, and `_kv_top<k>`
+or `_sparse_top<k>` appended for the retrieval head kv cache and the sparse attn_mode). Its grid points are appended
+as json lines to results/graph/<save_name>/results.jsonl instead of one json file each, so a sweep writes one file
+and reading a run opens one file. Runs are selected by directory name, so filtering by model / mask config never reads the rows of
+the other runs:
+    from results_store import load_results
+    df = load_results(model="llama-2-7b-80k", mask="top30")
+
+Directories written with one json file per grid point are read as they are, opening a run never writes to it. The
+per point files only missing from results.jsonl are read along with it, so new points can be appended to such a run
+before it is converted with
+    python results_store.py convert [results/graph/<save_name> ...]
+and `export` writes the per point files back for tools that still read them.
+"""
+import argparse
+import glob
+import json
+import os
+import re
+
+
+RESULTS_ROOT = "results/graph"
+RESULTS_FILE = "results.jsonl"
+KEY_COLUMNS = ["model", "version", "context_length", "depth_percent", "needle"]
+
+
+def result_key(result):
+    """
+    Identity of a grid point: model, results version, context length, depth and needle. The mask config is the run
+    the result belongs to.
+    """
+    return (result["model"], result.get("version", 1), int(result["context_length"]),
+            round(float(result["depth_percent"]), 3), result.get("needle"))
+
+
+def parse_save_name(save_name):
+    """
+    (model version, mask config) of a run directory name, the mask config is e.g. "top30", "random30",
+    "prune_top30", "kv_top100", "sparse_top64" or None.
+    """
+    match = re.match(r"^(.*)_(block|prune|kv|sparse)_(top\d+|random\d+)$", save_name)
+    if not match:
+        return save_name, None
+    return match.group(1), match.group(3) if match.group(2) == "block" else f"{match.group(2)}_{match.group(3)}"
+
+
+class ResultsStore:
+    def __init__(self, results_dir):
+        """
+        :param results_dir: The results directory of a run, e.g. results/graph/llama-2-7b-80k_block_top30. Nothing
+            is written until `append` or `convert`.
+        """
+        self.results_dir = results_dir
+        self.path = os.path.join(results_dir, RESULTS_FILE)
+        self.keys = {result_key(row) for row in self.rows()}
+
+    def per_point_files(self):
+        return sorted(glob.glob(os.path.join(self.results_dir, "*_results.json")))
+
+    def _jsonl_rows(self):
+        if not os.path.exists(self.path):
+            return
+        with open(self.path) as f:
+            for line in f:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    # line torn by a crash while appending, the point is simply redone
+                    continue
+
+    def _per_point_rows(self, known_keys):
+        """
+        Rows of the per point files whose grid point is not in `known_keys`.
+        """
+        for file in self.per_point_files():
+            with open(file) as f:
+                row = json.load(f)
+            if result_key(row) not in known_keys:
+                yield row
+
+    def rows(self, **filters):
+        """
+        Rows of the run in write order, the per point files missing from results.jsonl first, only those whose
+        columns equal the given `filters` values.
+        """
+        rows = self._jsonl_rows()
+        if self.per_point_files():
+            rows = list(rows)
+            rows = list(self._per_point_rows({result_key(row) for row in rows})) + rows
+        for row in rows:
+            if all(row.get(column) == value for column, value in filters.items()):
+                yield row
+
+    def append(self, result):
+        """
+        Appends the result dict of one grid point. A point evaluated again (--rerun) gets a new row, readers keep
+        the last one.
+        """
+        os.makedirs(self.results_dir, exist_ok=True)
+        with open(self.path, "ab+") as f:
+            line = json.dumps(result) + "\n"
+            f.seek(0, os.SEEK_END)
+            if f.tell() > 0:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b"\n":
+                    # end the line torn by a crash, or this row would be glued to it and skipped with it
+                    line = "\n" + line
+            f.write(line.encode())
+        self.keys.add(result_key(result))
+
+    def convert(self):
+        """
+        Appends the rows of the per point files missing from results.jsonl. Run it while no sweep writes the run.
+        :return: Number of rows converted.
+        """
+        rows = list(self._per_point_rows({result_key(row) for row in self._jsonl_rows()}))
+        for row in rows:
+            self.append(row)
+        return len(rows)
+
+    def __contains__(self, result):
+        return result_key(result) in self.keys
+
+    def __len__(self):
+        return len(self.keys)
+
+    def export_json(self):
+        """
+        Writes the rows back as one `<model>_len_<length>_depth_<depth>_results.json` file per grid point.
+        """
+        for row in self.rows():
+            context_file_location = f'{row["model"].split("/")[-1].replace(".", "_")}_len_{row["context_length"]}_depth_{int(row["depth_percent"] * 100)}'
+            with open(os.path.join(self.results_dir, f"{context_file_location}_results.json"), "w") as f:
+                json.dump(row, f)
+
+
+def list_runs(root=RESULTS_ROOT, model=None, mask=None):
+    """
+    Run directories under `root`, only those of `model` (model version) and `mask` (mask config, "none" for the
+    unmasked run) when given.
+    """
+    runs = []
+    for results_dir in sorted(glob.glob(os.path.join(root, "*", ""))):
+        model_version, mask_config = parse_save_name(os.path.basename(os.path.normpath(results_dir)))
+        if model is not None and model_version != model:
+            continue
+        if mask is not None and (mask_config or "none") != mask:
+            continue
+        runs.append(os.path.normpath(results_dir))
+    return runs
+
+
+def load_results(root=RESULTS_ROOT, model=None, mask=None, columns=None, **filters):
+    """
+    Rows of the selected runs as one pandas DataFrame, with `save_name` and `mask` columns added and only the last
+    row of a grid point evaluated more than once.
+    :param columns: Columns to keep, all when None.
+    :param filters: Column values the rows must have, e.g. context_length=1000.
+    """
+    import pandas as pd
+
+    frames = []
+    for results_dir in list_runs(root, model, mask):
+        rows = list(ResultsStore(results_dir).rows(**filters))
+        if not rows:
+            continue
+        frame = pd.DataFrame(rows)
+        frame = frame.drop_duplicates([c for c in KEY_COLUMNS if c in frame.columns], keep="last")
+        save_name = os.path.basename(results_dir)
+        frame["save_name"] = save_name
+        frame["mask"] = parse_save_name(save_name)[1] or "none"
+        frames.append(frame if columns is None else frame[[c for c in columns if c in frame.columns]])
+    return pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(columns=columns)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('command', choices=["convert", "export"], help='convert per point json files into results.jsonl, or write them back from it')
+    parser.add_argument('results_dirs', type=str, nargs='*', help=f'run directories, all the runs under {RESULTS_ROOT} when omitted')
+    parser.add_argument('--remove', action='store_true', help='with convert, delete the per point json files once converted')
+    args = parser.parse_args()
+
+    for results_dir in args.results_dirs or list_runs():
+        store = ResultsStore(results_dir)
+        if args.command == "export":
+            store.export_json()
+        else:
+            print(f"{results_dir}: {store.convert()} rows converted")
+            if args.remove:
+                for file in store.per_point_files():
+                    os.remove(file)
+        print(f"{results_dir}: {len(store)} grid points")
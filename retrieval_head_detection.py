@@ -35,8 +35,8 @@ python -u needle_in_haystack.py --s_len 0 --e_len 128000\
 
 #import tiktoken
 import os 
-import glob
 import json
+import glob
 from transformers import AutoTokenizer, AutoModel, AutoModelForCausalLM, AutoConfig
 import sys
 sys.path.append("./faiss_attn/")
@@ -45,16 +45,30 @@ from source.modeling_qwen2 import Qwen2ForCausalLM
 from source.modeling_mixtral import MixtralForCausalLM
 from source.modeling_mistral import MistralForCausalLM
 from source.modeling_phi3 import Phi3ForCausalLM
+from source.cache_utils import PrefixKVCache, StaticSlabCache
 import numpy as np
 import argparse
 from rouge_score import rouge_scorer
 from datetime import datetime, timezone
-from collections import defaultdict
 import time
 import torch
+from haystack_corpus import HaystackCorpus, period_positions, period_token_family, read_haystack, snap_to_sentence_start
+from head_score_store import HeadScoreAccumulator, HeadScoreStore, merge_stores
+from sweep_scheduler import SweepQueue, run_worker, sweep_tasks
+from results_store import ResultsStore
 
 
 
+def parse_shard(shard):
+    """
+    Parses the `i/n` of --shard into (i, n).
+    """
+    shard_idx, shard_num = [int(x) for x in shard.split("/")]
+    if not 0 <= shard_idx < shard_num:
+        raise argparse.ArgumentTypeError(f"shard index must be in [0, {shard_num}), got {shard}")
+    return shard_idx, shard_num
+
+
 def reset_rope(model, model_max_train_len, scaling_factor):
     for l in model.model.layers:
         l.self_attn.rotary_emb.scaling_factor = scaling_factor
@@ -88,7 +102,9 @@ class LLMNeedleHaystackTester:
                 save_contexts = True,
                 final_context_length_buffer = 200,
                 seconds_to_sleep_between_completions = None,
-                print_ongoing_status = True):
+                print_ongoing_status = True,
+                prefix_cache_interval = 0,
+                quantile_bins = 0):
         """        
         :param needle: The needle to be found in the haystack. Default is None.
         :param haystack_dir: The directory of text files to use as background context (or a haystack) in which the needle is to be found. Default is Paul Graham Essays.
@@ -113,6 +129,8 @@ class LLMNeedleHaystackTester:
         :param model_name: The name of the model. Default is 'gpt-4-1106-preview'.
         :param seconds_to_sleep_between_completions: The number of seconds to sleep between completions. Default is None.
         :param print_ongoing_status: Whether or not to print the ongoing status. Default is True.
+        :param prefix_cache_interval: Keep the kv cache between evaluations and resume prefill after the shared prompt prefix, checkpointed every this many tokens. Default is 0 (disabled).
+        :param quantile_bins: Histogram bins per head kept to estimate score quantiles, see HeadScoreAccumulator. Default is 0 (disabled).
         """
         if not needle or not haystack_dir or not retrieval_question:
             raise ValueError("Needle, haystack, and retrieval_question must be provided.")
@@ -130,7 +148,10 @@ class LLMNeedleHaystackTester:
         self.print_ongoing_status = print_ongoing_status
         self.model_provider = model_provider
         self.testing_results = []
-        self.head_counter = defaultdict(list)
+        self.results_store = {}
+        self.quantile_bins = quantile_bins
+        self.corpus = {}
+        self.prefix_cache = PrefixKVCache(prefix_cache_interval) if prefix_cache_interval > 0 else None
         if("/" in model_name):
             self.model_version = model_name.split("/")[-1]
         else: self.model_version = model_name
@@ -165,6 +186,7 @@ class LLMNeedleHaystackTester:
         config = AutoConfig.from_pretrained(model_name)
         self.layer_num, self.head_num = config.num_hidden_layers, config.num_attention_heads
         print(f"layer number: {self.layer_num}, head number {self.head_num}")
+        self.head_scores = HeadScoreAccumulator(self.layer_num, self.head_num, quantile_bins)
         if "Qwen" in self.model_version:
             self.model_to_test = Qwen2ForCausalLM.from_pretrained(
                     model_name,torch_dtype="auto",device_map='auto',use_flash_attention_2="flash_attention_2"
@@ -213,56 +235,142 @@ class LLMNeedleHaystackTester:
         # Run through each iteration of context_lengths and depths
         tasks = []
          
-        for context_length in self.context_lengths:
+        for length_idx, context_length in enumerate(self.context_lengths):
             if context_length < args.s_len or context_length > args.e_len: continue
-            for depth_percent in self.document_depth_percents:
+            depths = [depth_percent for depth_idx, depth_percent in enumerate(self.document_depth_percents)
+                      if self.in_shard(length_idx, depth_idx) and (args.rerun or not self.result_exists(context_length, depth_percent))]
+            if args.depth_batch_size > 1:
+                for i in range(0, len(depths), args.depth_batch_size):
+                    self.evaluate_and_log_batch(context_length, depths[i:i + args.depth_batch_size])
+                continue
+            for depth_percent in depths:
                 task = self.bound_evaluate_and_log(context_length, depth_percent)
 
-    def retrieval_calculate(self, attention_maxtrix,retrieval_score, inp, step_token,topk=1):
-        for layer_idx in range(self.layer_num):
-            for head_idx in range(self.head_num):
-                values, idx = attention_maxtrix[layer_idx][0][head_idx][-1].topk(topk)
-                for v, i in zip(values, idx):
-                    if  self.needle_start <= i < self.needle_end and inp.item()==self.prompt_ids[i].item():
-                        retrieval_score[layer_idx][head_idx][0] += 1/(self.needle_end - self.needle_start)
-                        retrieval_score[layer_idx][head_idx][1] += step_token
-                        break
-    def retrieval_head_accumulate(self, retrieval_score):
-        for layer_idx in range(self.layer_num):
-            for head_idx in range(self.head_num):
-                self.head_counter[f"{layer_idx}-{head_idx}"].append(retrieval_score[layer_idx][head_idx][0])
-
-    def decode(self, q_outputs, inp, decode_len, block_list=None):
-        output, retrieval_score = [], [[[0, ''] for _ in range(self.head_num)] for _ in range(self.layer_num)]
+    def in_shard(self, length_idx, depth_idx):
+        """
+        Whether the grid point (current needle, length, depth) belongs to this worker. Points are dealt round robin
+        over the whole needle x length x depth grid, so every shard gets a similar mix of short and long contexts.
+        """
+        shard_idx, shard_num = self.shard
+        point_idx = (self.needle_id * len(self.context_lengths) + length_idx) * len(self.document_depth_percents) + depth_idx
+        return point_idx % shard_num == shard_idx
+
+    def retrieval_calculate(self, topk_indices, retrieval_score, inp):
+        # Score every head in one batched op instead of a python loop with a device sync per head:
+        # stack the per-layer top-k key positions of the last query row into (layers, heads, topk)
+        # and check needle-span membership and token match with a single masked comparison.
+        if self.needle_end <= self.needle_start:
+            return
+        device = retrieval_score.device
+        idx = torch.stack([layer_topk[0].to(device) for layer_topk in topk_indices])
+        in_needle = (idx >= self.needle_start) & (idx < self.needle_end)
+        # decoded tokens extend the kv cache past the prompt, clamp so the gather stays in range
+        token_match = self.prompt_ids[idx.clamp(max=len(self.prompt_ids) - 1)] == inp.to(device)
+        hit = (in_needle & token_match).any(dim=-1)
+        retrieval_score += hit.to(retrieval_score.dtype) / (self.needle_end - self.needle_start)
+
+    def retrieval_head_accumulate(self, retrieval_score, context_length, depth_percent):
+        retrieval_score = retrieval_score.float().cpu().numpy()
+        self.head_scores.update(retrieval_score)
+        self.head_score_store.append(retrieval_score, int(context_length), float(depth_percent), self.needle_id)
+
+    def decode(self, q_outputs, inp, decode_len, block_list=None, topk=1):
+        output = []
+        retrieval_score = torch.zeros(self.layer_num, self.head_num, device=self.prompt_ids.device)
         past_kv = q_outputs.past_key_values
+        # decode stays on the flash path, the attention layers only probe the top-k key positions for scoring
         for step_i in range(decode_len):
             inp = inp.view(1, 1)
-            outputs = self.model_to_test(input_ids=inp, past_key_values=past_kv, use_cache=True, output_attentions=True, attn_mode="torch" )
+            outputs = self.model_to_test(input_ids=inp, past_key_values=past_kv, use_cache=True, output_attentions=True, attn_mode="flash", attention_topk=topk)
             past_kv = outputs.past_key_values
             inp = outputs.logits[0, -1].argmax()
             step_token = self.enc.convert_ids_to_tokens(inp.item())
             output.append(inp.item())
-            self.retrieval_calculate(outputs.attentions, retrieval_score, inp, step_token)
+            self.retrieval_calculate(outputs.attentions, retrieval_score, inp)
             if step_token=='<0x0A>' or inp.item()==144: break
         return output, retrieval_score 
 
-    def find_needle_idx(self, needle):
+    def retrieval_calculate_batch(self, topk_indices, retrieval_score, inp, prompt_ids, needle_start, needle_end, active):
+        """
+        Batched `retrieval_calculate`, row b of the batch updates retrieval_score[b].
+        :param topk_indices: per layer (bsz, heads, topk) key positions of the last query row
+        :param retrieval_score: (bsz, layers, heads)
+        :param prompt_ids: (bsz, prompt_len) left padded prompts
+        :param needle_start: (bsz,) needle start in padded positions, -1 when the needle was not found
+        :param needle_end: (bsz,) needle end in padded positions
+        :param active: (bsz,) rows that are still decoding
+        """
+        device = retrieval_score.device
+        idx = torch.stack([layer_topk.to(device) for layer_topk in topk_indices], dim=1)
+        start, end = needle_start.view(-1, 1, 1, 1), needle_end.view(-1, 1, 1, 1)
+        in_needle = (idx >= start) & (idx < end)
+        # decoded tokens extend the kv cache past the prompt, clamp so the gather stays in range
+        attended = prompt_ids.gather(1, idx.clamp(max=prompt_ids.shape[1] - 1).flatten(1)).view_as(idx)
+        hit = (in_needle & (attended == inp.view(-1, 1, 1, 1))).any(dim=-1) & active.view(-1, 1, 1)
+        span_len = (needle_end - needle_start).clamp(min=1).view(-1, 1, 1)
+        retrieval_score += hit.to(retrieval_score.dtype) / span_len
+
+    def decode_batch(self, q_outputs, inp, attention_mask, decode_len, prompt_ids, needle_start, needle_end, topk=1):
+        """
+        Greedy decode of a left padded batch, each row stops on its own newline and keeps its own retrieval score.
+        """
+        bsz = inp.shape[0]
+        device = prompt_ids.device
+        output = [[] for _ in range(bsz)]
+        retrieval_score = torch.zeros(bsz, self.layer_num, self.head_num, device=device)
+        active = torch.ones(bsz, dtype=torch.bool, device=device)
+        past_kv = q_outputs.past_key_values
+        for step_i in range(decode_len):
+            attention_mask = torch.cat([attention_mask, attention_mask.new_ones(bsz, 1)], dim=-1)
+            position_ids = attention_mask.long().sum(-1, keepdim=True) - 1
+            outputs = self.model_to_test(input_ids=inp.view(bsz, 1), attention_mask=attention_mask, position_ids=position_ids,
+                                         past_key_values=past_kv, use_cache=True, output_attentions=True, attn_mode="flash", attention_topk=topk)
+            past_kv = outputs.past_key_values
+            inp = outputs.logits[:, -1].argmax(-1)
+            step_ids = inp.to(device)
+            self.retrieval_calculate_batch(outputs.attentions, retrieval_score, step_ids, prompt_ids, needle_start, needle_end, active)
+            for row, (token_id, row_active) in enumerate(zip(step_ids.tolist(), active.tolist())):
+                if not row_active: continue
+                output[row].append(token_id)
+                if self.enc.convert_ids_to_tokens(token_id)=='<0x0A>' or token_id==144: active[row] = False
+            if not active.any(): break
+        return output, retrieval_score
+
+    def find_needle_idx(self, needle, prompt_ids=None, search_range=None):
+        """
+        Locates `needle` in the prompt: the first window of its token length holding more than 90% of its distinct
+        tokens, the same span as the original per window set intersection.
+        :param prompt_ids: Prompt token ids, default is self.prompt_ids.
+        :param search_range: (start, end) of the prompt known to contain the needle, e.g. where it was inserted. Only the windows
+            around it are scanned.
+        :return: (start, end) of the span, (-1, -1) when the needle is not found.
+        """
+        if prompt_ids is None:
+            prompt_ids = self.prompt_ids
         needle_ids = self.enc(needle, add_special_tokens=False)["input_ids"]
         print( self.enc.decode(needle_ids, skip_special_tokens=False))
         span_len = len(needle_ids)
-        for i in range(len(self.prompt_ids)):            
-            token_span = self.prompt_ids[i : i + span_len]
-            span_ids = set(token_span.tolist())
-            overlap = float(len(span_ids.intersection(set(needle_ids)))) / len(set(needle_ids))
-            if(overlap > 0.9):
-                return i, i + span_len
+        offset = 0
+        if search_range is not None:
+            offset = max(search_range[0] - span_len, 0)
+            prompt_ids = prompt_ids[offset : search_range[1] + span_len]
+        prompt_ids = torch.as_tensor(prompt_ids).cpu()
+        if len(prompt_ids) == 0:
+            return -1, -1
+        # occurrences of every distinct needle token in every window, from one cumulative sum per token
+        distinct_ids = torch.tensor(sorted(set(needle_ids)), dtype=prompt_ids.dtype)
+        is_token = (prompt_ids[None, :] == distinct_ids[:, None]).long()
+        cumsum = torch.cat([torch.zeros(len(distinct_ids), 1, dtype=torch.long), is_token.cumsum(1)], dim=1)
+        starts = torch.arange(len(prompt_ids))
+        counts = cumsum[:, (starts + span_len).clamp(max=len(prompt_ids))] - cumsum[:, starts]
+        overlap = (counts > 0).sum(0).double() / len(distinct_ids)
+        found = torch.nonzero(overlap > 0.9)
+        if len(found):
+            i = int(found[0])
+            return offset + i, offset + i + span_len
         return -1, -1
 
-    def evaluate_and_log(self, context_length, depth_percent):
-        # Checks to see if you've already checked a length/percent/version.
-        # This helps if the program stop running and you want to restart later
-        # Go generate the required length context and place your needle statement in
-        context = self.generate_context(context_length, depth_percent)
+    def build_input_ids(self, context):
         question = f"Based on the content of the book, Question: {self.retrieval_question}\nAnswer:"
         '''
         if self.model_version=="Qwen1.5-14B-Chat":
@@ -278,28 +386,85 @@ class LLMNeedleHaystackTester:
         else:
             input_context = context + question
             input_ids = self.enc(input_context , return_tensors="pt")['input_ids']
-        
+        return input_ids
+
+    def evaluate_and_log(self, context_length, depth_percent):
+        # Checks to see if you've already checked a length/percent/version.
+        # This helps if the program stop running and you want to restart later
+        # Go generate the required length context and place your needle statement in
+        input_ids, context, inserted_span = self.generate_prompt(context_length, depth_percent)
+
         # Prepare your message to send to the model you're going to evaluate
         test_start_time = time.time()
         self.prompt_ids = input_ids[0, :]
         if not self.multi_gpus:
             input_ids = input_ids.to(self.model_to_test.device)
-        self.needle_start, self.needle_end = self.find_needle_idx(self.real_needle)
+        self.needle_start, self.needle_end = self.find_needle_idx(self.real_needle, search_range=inserted_span)
+        # keep the prompt ids next to the scores so the per-step token match needs no host round trip
+        self.prompt_ids = self.prompt_ids.to(self.model_to_test.device)
         with torch.no_grad():
-            q_outputs = self.model_to_test(input_ids=input_ids[:,:-1], use_cache=True, return_dict=True)
-            output, retrieval_score  = self.decode(q_outputs, input_ids[:,-1], 50)
+            decode_len = 50
+            # reserve the whole prompt + answer once, decode steps then write into the cache in place
+            if self.prefix_cache is not None:
+                past_kv, reused = self.prefix_cache.resume(input_ids[0, :-1].tolist(), input_ids.shape[1] + decode_len)
+                print("reusing %d cached prefix tokens" % reused)
+            else:
+                past_kv, reused = StaticSlabCache(input_ids.shape[1] + decode_len), 0
+            q_outputs = self.model_to_test(input_ids=input_ids[:,reused:-1], past_key_values=past_kv, use_cache=True, return_dict=True)
+            output, retrieval_score  = self.decode(q_outputs, input_ids[:,-1], decode_len)
             response = self.enc.decode(output,skip_special_tokens=True).strip()
 
         test_end_time = time.time()
         test_elapsed_time = test_end_time - test_start_time
-        
+        self.log_result(context_length, depth_percent, context, response, retrieval_score, test_elapsed_time)
+
+    def evaluate_and_log_batch(self, context_length, depth_percents):
+        # All depths of one context length share the prefill and the decode loop: prompts are left padded
+        # into one batch, needle spans are shifted by the padding of their row.
+        prompts = [self.generate_prompt(context_length, depth_percent) for depth_percent in depth_percents]
+        contexts = [context for _, context, _ in prompts]
+        rows = [input_ids[0] for input_ids, _, _ in prompts]
+        spans = [self.find_needle_idx(self.real_needle, row, inserted_span) for row, (_, _, inserted_span) in zip(rows, prompts)]
+
+        test_start_time = time.time()
+        max_len = max(len(row) for row in rows)
+        pad_id = self.enc.pad_token_id if self.enc.pad_token_id is not None else 0
+        input_ids = torch.full((len(rows), max_len), pad_id, dtype=rows[0].dtype)
+        attention_mask = torch.zeros(len(rows), max_len, dtype=torch.long)
+        needle_start, needle_end = [], []
+        for b, (row, (start, end)) in enumerate(zip(rows, spans)):
+            pad = max_len - len(row)
+            input_ids[b, pad:] = row
+            attention_mask[b, pad:] = 1
+            needle_start.append(start + pad if start >= 0 else -1)
+            needle_end.append(end + pad if start >= 0 else -1)
+        prompt_ids = input_ids.to(self.model_to_test.device)
+        needle_start = torch.tensor(needle_start, device=prompt_ids.device)
+        needle_end = torch.tensor(needle_end, device=prompt_ids.device)
+        if not self.multi_gpus:
+            input_ids = input_ids.to(self.model_to_test.device)
+            attention_mask = attention_mask.to(self.model_to_test.device)
+        position_ids = (attention_mask.cumsum(-1) - 1).clamp(min=0)
+        with torch.no_grad():
+            decode_len = 50
+            past_kv = StaticSlabCache(max_len + decode_len)
+            q_outputs = self.model_to_test(input_ids=input_ids[:,:-1], attention_mask=attention_mask[:,:-1], position_ids=position_ids[:,:-1],
+                                           past_key_values=past_kv, use_cache=True, return_dict=True)
+            outputs, retrieval_scores = self.decode_batch(q_outputs, input_ids[:,-1], attention_mask[:,:-1], decode_len,
+                                                          prompt_ids, needle_start, needle_end)
+
+        # the batch shares one wall clock, report each row its share
+        test_elapsed_time = (time.time() - test_start_time) / len(rows)
+        for depth_percent, context, output, retrieval_score in zip(depth_percents, contexts, outputs, retrieval_scores):
+            response = self.enc.decode(output,skip_special_tokens=True).strip()
+            self.log_result(context_length, depth_percent, context, response, retrieval_score, test_elapsed_time)
+
+    def log_result(self, context_length, depth_percent, context, response, retrieval_score, test_elapsed_time):
         score = scorer.score(self.real_needle, response)['rouge1'].recall*100
         ## if recall > 50, we determine this retrieval succeed and update the retrieval score
         if score > 50:
-            self.retrieval_head_accumulate(retrieval_score)
-            head_score = [(i[0], np.mean(i[1])) for i in self.head_counter.items()]
-            head_score = sorted(head_score, key=lambda x:x[1], reverse=True)
-            print([[i[0]] for i in head_score][:20])
+            self.retrieval_head_accumulate(retrieval_score, context_length, depth_percent)
+            print(self.head_scores.top_heads(20))
 
         results = {
             'model' : self.model_to_test_description,
@@ -339,37 +504,54 @@ class LLMNeedleHaystackTester:
                 f.write(context)
             
         if self.save_results:
-            # Save the context to file for retesting
-            if not os.path.exists(f'results/graph/{self.model_version}'):
-                os.makedirs(f'results/graph/{self.model_version}')
-            
-            # Save the result to file for retesting
-            p = f'results/graph/{self.model_version}/{context_file_location}_results.json'
-            print("Writing at %s" % p)
-            with open(p, 'w') as f:
-                json.dump(results, f)
+            # Append the result to the results file of the run
+            results_store = self.get_results_store(self.model_version)
+            print("Writing at %s" % results_store.path)
+            results_store.append(results)
+
+    def get_results_store(self, save_name):
+        if save_name not in self.results_store:
+            self.results_store[save_name] = ResultsStore(f'results/graph/{save_name}')
+        return self.results_store[save_name]
 
     def result_exists(self, context_length, depth_percent):
         """
-        Checks to see if a result has already been evaluated or not
+        Checks to see if a result has already been evaluated or not, with a lookup in the results store of the run
         """
+        point = {'model': self.model_to_test_description, 'version': self.results_version,
+                 'context_length': context_length, 'depth_percent': depth_percent, 'needle': self.needle}
+        return point in self.get_results_store(self.model_version)
 
-        results_dir = 'results/' + self.model_version
-        print("Searching existing results at %s" % results_dir)
-        if not os.path.exists(results_dir):
-            return False
-        for filename in os.listdir(results_dir):
-            if filename.endswith('.json'):
-                with open(os.path.join(results_dir, filename), 'r') as f:
-                    result = json.load(f)
-                    context_length_met = result['context_length'] == context_length
-                    depth_percent_met = result['depth_percent'] == depth_percent
-                    version_met = result.get('version', 1) == self.results_version
-                    model_met = result['model'] == self.model_name
-                    # import ipdb; ipdb.set_trace()
-                    if context_length_met and depth_percent_met and version_met and model_met:
-                        return True
-        return False
+    def generate_prompt(self, context_length, depth_percent):
+        """
+        Builds the prompt ids from the haystack tokenized once per directory, splicing the needle and the question ids.
+        Falls back to tokenizing the prompt text when the model uses a chat template or when the tokenizer would
+        not keep one of the splice boundaries on re-encode.
+        :return: (input_ids, context text, (start, end) of the inserted needle in input_ids or None when unknown)
+        """
+        if self.haystack_dir not in self.corpus:
+            self.corpus[self.haystack_dir] = HaystackCorpus(self.enc, self.haystack_dir, max(self.context_lengths))
+        corpus = self.corpus[self.haystack_dir]
+        needle_ids = corpus.continuation_ids(self.needle)
+        question_ids = corpus.continuation_ids(f"Based on the content of the book, Question: {self.retrieval_question}\nAnswer:")
+        haystack_length = context_length - self.final_context_length_buffer - len(needle_ids)
+        context_ids, insertion_point = corpus.insert_needle(needle_ids, haystack_length, depth_percent, self.get_period_tokens())
+        print("insertion at %d" % insertion_point)
+        context = self.decode_tokens(context_ids.tolist())
+
+        needle_end = insertion_point + len(needle_ids)
+        stable = corpus.splice_is_stable(context_ids[:insertion_point], context_ids[insertion_point:]) \
+            and corpus.splice_is_stable(context_ids[:needle_end], context_ids[needle_end:]) \
+            and corpus.splice_is_stable(context_ids, question_ids)
+        if self.model_version in ["Mistral-7B-Instruct-v0.2", "Qwen1.5-14B-Chat"] or not stable:
+            return self.build_input_ids(context), context, None
+        input_ids = self.enc.build_inputs_with_special_tokens(context_ids.tolist() + question_ids.tolist())
+        # special tokens only wrap the content, so the needle moves by the leading ones
+        lead = len(input_ids) - len(context_ids) - len(question_ids)
+        inserted_span = (lead + insertion_point, lead + needle_end)
+        if input_ids[inserted_span[0]:inserted_span[1]] != needle_ids.tolist():
+            inserted_span = None
+        return torch.tensor([input_ids]), context, inserted_span
 
     def generate_context(self, context_length, depth_percent):
         # Load up tiktoken so we navigate tokens more easily
@@ -394,6 +576,10 @@ class LLMNeedleHaystackTester:
         else:
             raise ValueError("model_provider must be either 'OpenAI' or 'Anthropic'")
     
+    def get_period_tokens(self):
+        # the sentence-end family follows the tokenizer of the model under test
+        return period_token_family(self.enc('.', add_special_tokens=False)["input_ids"][-1])
+
     def insert_needle(self, context, depth_percent, context_length):
         tokens_needle = self.encode_text_to_tokens(self.needle)
         tokens_context = self.encode_text_to_tokens(context)
@@ -413,24 +599,16 @@ class LLMNeedleHaystackTester:
             insertion_point = int(len(tokens_context) * (depth_percent / 100))
             # import ipdb; ipdb.set_trace()
 
-            # tokens_new_context represents the tokens before the needle
-            tokens_new_context = tokens_context[:insertion_point]
-
             # We want to make sure that we place our needle at a sentence break so we first see what token a '.' is
-            if(self.model_provider in ["LLaMA", "LongLLaMA"]): period_tokens = [29889, 869]
-            elif(self.model_provider == "Mistral"): period_tokens = [842, 28723]
-            elif(self.model_provider == "GLM"): period_tokens = [918, 30930]
-            else: period_tokens = self.encode_text_to_tokens('.')
+            period_tokens = self.get_period_tokens()
             
-            # Then we iteration backwards until we find the first period
-            while tokens_new_context and tokens_new_context[-1] not in period_tokens:
-                insertion_point -= 1
-                tokens_new_context = tokens_context[:insertion_point]
+            # Then we snap back to right after the last period, a bisect over the sorted period positions
+            insertion_point = snap_to_sentence_start(period_positions(tokens_context, period_tokens), insertion_point)
 
             print("insertion at %d" % insertion_point)
             # Once we get there, then add in your needle, and stick the rest of your context in on the other end.
             # Now we have a needle in a haystack
-            tokens_new_context += tokens_needle + tokens_context[insertion_point:]
+            tokens_new_context = tokens_context[:insertion_point] + tokens_needle + tokens_context[insertion_point:]
 
         # Convert back to a string and return it
         new_context = self.decode_tokens(tokens_new_context)
@@ -448,14 +626,7 @@ class LLMNeedleHaystackTester:
             raise ValueError("model_provider must be either 'OpenAI' or 'Anthropic'")
 
     def read_context_files(self):
-        context = ""
-        max_context_length = max(self.context_lengths)
-
-        while len(context.split()) < max_context_length:
-            for file in glob.glob(f"{self.haystack_dir}/*.txt"):
-                with open(file, 'r') as f:
-                    context += f.read()
-        return context
+        return read_haystack(self.haystack_dir, max(self.context_lengths))
 
     def get_tokens_from_context(self, context):
         if self.model_provider in ["OpenAI", "LLaMA", "Mistral", "GLM"]:
@@ -493,22 +664,84 @@ class LLMNeedleHaystackTester:
         print (f"- Needle: {self.needle.strip()}")
         print ("\n\n")
 
+    def open_head_score_store(self, worker_id=None):
+        """
+        Opens head_score/<model_version>, the binary store every successful detection is appended to. A store is
+        created from head_score/<model_version>.json when only the json exists, so earlier scores keep counting.
+        A shard of a sweep writes its own partial store, see `merge_stores` in head_score_store.py, and so does every
+        worker of a queue (`worker_id`), merged by `run_queue` once the queue is drained.
+        """
+        path = f"head_score/{self.model_version}"
+        if worker_id is not None:
+            return HeadScoreStore(f"{path}.worker-{worker_id}", self.layer_num, self.head_num, quantile_bins=self.quantile_bins)
+        shard_idx, shard_num = self.shard
+        if shard_num > 1:
+            return HeadScoreStore(f"{path}.shard-{shard_idx}-of-{shard_num}", self.layer_num, self.head_num, quantile_bins=self.quantile_bins)
+        if not HeadScoreStore.exists(path) and os.path.exists(f"{path}.json"):
+            return HeadScoreStore.import_json(f"{path}.json", path, quantile_bins=self.quantile_bins)
+        return HeadScoreStore(path, self.layer_num, self.head_num, quantile_bins=self.quantile_bins)
+
+    def set_needle(self, ni):
+        self.needle_id = ni
+        self.needle = self.needle_list[ni]
+        self.haystack_dir = self.haystack_dir_list[ni]
+        self.real_needle  = self.real_ansers_list[ni]
+        self.retrieval_question = self.retrieval_question_list[ni]
+
+    def run_queue(self, args):
+        """
+        Works through the shared sweep queue `args.queue`, most expensive grid point first, see sweep_scheduler.py.
+        Scores go to a store of this worker, the worker that finds the queue drained merges the stores of all the
+        workers into head_score/<model_version>.
+        """
+        queue = SweepQueue(args.queue)
+        self.head_score_store = self.open_head_score_store(queue.worker_id)
+        queue.add(sweep_tasks(self.context_lengths, self.document_depth_percents, args.s_len, args.e_len, range(len(self.needle_list))))
+
+        def evaluate(task):
+            self.set_needle(task["needle_id"])
+            if args.rerun or not self.result_exists(task["context_length"], task["depth_percent"]):
+                self.evaluate_and_log(task["context_length"], task["depth_percent"])
+        run_worker(queue, evaluate)
+        self.merge_worker_stores(queue)
+
+    def merge_worker_stores(self, queue):
+        """
+        Merges the worker stores of `queue` into head_score/<model_version> and deletes them, when no task is pending
+        or running. A lock in the queue directory keeps two workers finishing together from merging twice, and every
+        part is deleted as soon as it is merged (see `merge_stores`), so a merge interrupted by a crash is resumed by
+        the next drained worker without counting a part twice.
+        """
+        status = queue.status()
+        if status["pending"] or status["running"]:
+            print(f"queue not drained yet ({status}), the last worker merges the head scores")
+            return
+        lock_name = f"merge-{self.model_version}"
+        if not queue.lock(lock_name):
+            print("another worker is merging the head scores")
+            return
+        try:
+            path = f"head_score/{self.model_version}"
+            parts = sorted(glob.glob(f"{path}.worker-*.summary.npz"))
+            if parts or os.path.exists(f"{path}.merging.json"):
+                self.head_score_store = merge_stores(path, parts, remove_parts=True)
+        finally:
+            queue.unlock(lock_name)
+
     def start_test(self, args):
-        for ni in range(len(self.needle_list)):
-            self.needle = self.needle_list[ni]
-            self.haystack_dir = self.haystack_dir_list[ni]
-            self.real_needle  = self.real_ansers_list[ni]
-            self.retrieval_question = self.retrieval_question_list[ni]
-            if self.print_ongoing_status:
-                self.print_start_test_summary()
-            self.run_test(args)
-        if os.path.exists(f"head_score/{self.model_version}.json"):
-            with open(f"./head_score/{self.model_version}.json", "r") as file:
-                head_counter = json.loads(file.readline())
-            for k,v in head_counter.items():
-                self.head_counter[k] += v
-        with open(f"head_score/{self.model_version}.json", 'w') as f:
-            json.dump(self.head_counter, f)
+        self.shard = args.shard
+        if args.queue:
+            if self.shard[1] > 1:
+                raise ValueError("--queue already splits the grid between the workers, do not combine it with --shard.")
+            self.run_queue(args)
+        else:
+            self.head_score_store = self.open_head_score_store()
+            for ni in range(len(self.needle_list)):
+                self.set_needle(ni)
+                if self.print_ongoing_status:
+                    self.print_start_test_summary()
+                self.run_test(args)
+        print(f"{self.head_score_store.count} samples in {self.head_score_store.path}, top retrieval heads: {self.head_score_store.top_heads(20)}")
 
 
 if __name__ == "__main__":
@@ -520,6 +753,12 @@ if __name__ == "__main__":
     parser.add_argument('--model_name', type=str, default=None, help='name of model')
     parser.add_argument('--model_name_suffix', type=str, default=None, help='name of model')
     parser.add_argument('--model_provider', type=str, default="LLaMA", help='which model to use')
+    parser.add_argument('--prefix_cache_interval', type=int, default=0, help='reuse the kv cache of the prompt prefix shared with the previous evaluation, checkpointed every N tokens (0 disables)')
+    parser.add_argument('--rerun', action='store_true', help='evaluate grid points that already have a result instead of skipping them')
+    parser.add_argument('--queue', type=str, default=None, help='work through this shared sweep queue directory, longest contexts first (see sweep_scheduler.py)')
+    parser.add_argument('--shard', type=parse_shard, default=(0, 1), help='i/n: evaluate the i-th of n disjoint parts of the needle x length x depth grid, each part writes head_score/<model>.shard-i-of-n')
+    parser.add_argument('--quantile_bins', type=int, default=0, help='histogram bins per head kept to estimate retrieval score quantiles (0 disables)')
+    parser.add_argument('--depth_batch_size', type=int, default=1, help='number of needle depths of one context length evaluated as one padded batch')
     args = parser.parse_args()
    
     model_name = args.model_path
@@ -532,6 +771,8 @@ if __name__ == "__main__":
                                  save_results=True,
                                  context_lengths_min=args.s_len,
                                  context_lengths_max=args.e_len,
+                                 prefix_cache_interval=args.prefix_cache_interval,
+                                 quantile_bins=args.quantile_bins,
                                  )
 
     ht.start_test(args)
@@ -0,0 +1,253 @@
+"""
+File based work queue for needle sweeps.
+
+The (needle, context length, depth, mask config) grid of a sweep is materialized as one small json file per task in
+a queue directory:
+    <queue>/pending/   tasks waiting for a worker
+    <queue>/running/   tasks claimed by a worker
+    <queue>/done/      completed tasks
+    <queue>/failed/    tasks whose evaluation raised
+
+Every state change is an atomic rename, so any number of worker processes (one model each, e.g. one per GPU) can share
+a queue: a task is claimed by exactly one of them, and a crash never leaves a half written task behind. Task file
+names start with the estimated cost (prefill ~ length^2), workers claim the most expensive pending task first, so the
+long contexts are spread over the pool early and the short ones fill the gaps at the end.
+
+Workers are the needle harnesses started with `--queue <dir>`, each adds the grid points of its own arguments to the
+queue (points already pending, running, done or failed are skipped) and then works through it:
+    CUDA_VISIBLE_DEVICES=0 python needle_in_haystack_with_mask.py --queue sweeps/llama --mask_topk 50 ... &
+    CUDA_VISIBLE_DEVICES=1 python needle_in_haystack_with_mask.py --queue sweeps/llama --mask_topk 50 ... &
+Restarting the same command after an interruption resumes the sweep, tasks left running by a dead worker are put
+back with:
+    python sweep_scheduler.py requeue sweeps/llama
+"""
+import argparse
+import json
+import os
+import socket
+import time
+import traceback
+
+
+QUEUE_STATES = ["pending", "running", "done", "failed"]
+
+
+def estimate_cost(context_length):
+    """
+    Relative cost of one grid point, dominated by the quadratic prefill.
+    """
+    return int(context_length) ** 2
+
+
+def make_task(context_length, depth_percent, needle_id=0, mask_topk=0):
+    return {"needle_id": int(needle_id), "context_length": int(context_length), "depth_percent": float(depth_percent),
+            "mask_topk": int(mask_topk), "cost": estimate_cost(context_length)}
+
+
+def task_name(task):
+    # cost first, so sorting names sorts tasks by cost
+    return (f"{task['cost']:024d}_needle{task['needle_id']}_len{task['context_length']}"
+            f"_depth{int(task['depth_percent'] * 100)}_mask{task['mask_topk']}.json")
+
+
+class SweepQueue:
+    def __init__(self, queue_dir):
+        """
+        :param queue_dir: Directory of the queue, created if needed.
+        """
+        self.queue_dir = queue_dir
+        for state in QUEUE_STATES:
+            os.makedirs(os.path.join(queue_dir, state), exist_ok=True)
+        self.worker_id = f"{socket.gethostname()}-{os.getpid()}"
+
+    def path(self, state, name):
+        return os.path.join(self.queue_dir, state, name)
+
+    def _write(self, path, content):
+        """
+        Writes `content` to a new file at `path`, returns False when it already exists.
+        """
+        tmp_path = f"{path}.{self.worker_id}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(content, f)
+        try:
+            # link fails if the file exists, unlike rename, so two workers adding the same task keep one copy
+            os.link(tmp_path, path)
+            return True
+        except FileExistsError:
+            return False
+        finally:
+            os.remove(tmp_path)
+
+    def add(self, tasks):
+        """
+        Adds the tasks not yet known to the queue, in any state. Returns the number of tasks added.
+        """
+        added = 0
+        for task in tasks:
+            name = task_name(task)
+            # states are checked in the order a task goes through them, so a task moving on is never missed
+            if any(os.path.exists(self.path(state, name)) for state in QUEUE_STATES):
+                continue
+            added += self._write(self.path("pending", name), task)
+        return added
+
+    def claim(self, accept=None):
+        """
+        Moves the most expensive pending task accepted by `accept` (all when None) to running and returns it, or
+        returns None when there is none left.
+        """
+        for name in sorted(os.listdir(os.path.join(self.queue_dir, "pending")), reverse=True):
+            if not name.endswith(".json"):
+                continue
+            try:
+                with open(self.path("pending", name)) as f:
+                    task = json.load(f)
+                if accept is not None and not accept(task):
+                    continue
+                os.rename(self.path("pending", name), self.path("running", name))
+            except FileNotFoundError:
+                # claimed by another worker in the meantime
+                continue
+            task["worker"] = self.worker_id
+            task["start_time"] = time.time()
+            return task
+        return None
+
+    def complete(self, task, result=None):
+        """
+        Records `task` as done, with the optional json serializable `result`.
+        """
+        name = task_name(task)
+        task = dict(task, end_time=time.time(), result=result)
+        self._write(self.path("done", name), task)
+        os.remove(self.path("running", name))
+
+    def fail(self, task, error):
+        name = task_name(task)
+        self._write(self.path("failed", name), dict(task, end_time=time.time(), error=error))
+        os.remove(self.path("running", name))
+
+    def requeue(self, states=("running",)):
+        """
+        Moves the tasks in `states` back to pending, e.g. the running tasks of workers that died.
+        """
+        moved = 0
+        for state in states:
+            for name in os.listdir(os.path.join(self.queue_dir, state)):
+                if name.endswith(".json"):
+                    os.rename(self.path(state, name), self.path("pending", name))
+                    moved += 1
+        return moved
+
+    def lock(self, name):
+        """
+        Takes the lock `<queue>/<name>.lock`, a file naming the worker, host and pid holding it. A lock left behind by
+        a dead process of this host is stale and taken over, one held from another host is only freed by `unlock` or
+        by deleting the file.
+        :return: True when this worker now holds the lock.
+        """
+        path = os.path.join(self.queue_dir, f"{name}.lock")
+        holder = {"worker": self.worker_id, "host": socket.gethostname(), "pid": os.getpid()}
+        for _ in range(2):
+            if self._write(path, holder):
+                return True
+            try:
+                with open(path) as f:
+                    current = json.load(f)
+            except FileNotFoundError:
+                # released in the meantime
+                continue
+            except ValueError:
+                # empty lock of an older version, which did not record its holder
+                current = {}
+            if current and (current.get("host") != holder["host"] or process_alive(current.get("pid"))):
+                print(f"{path} is held by {current.get('worker')}")
+                return False
+            # rename the stale lock away first, so only one worker takes it over
+            stale_path = f"{path}.{self.worker_id}.stale"
+            try:
+                os.rename(path, stale_path)
+            except FileNotFoundError:
+                continue
+            try:
+                with open(stale_path) as f:
+                    moved = json.load(f)
+            except ValueError:
+                moved = {}
+            if moved != current:
+                # another worker took the lock over in the meantime, give it back
+                os.rename(stale_path, path)
+                print(f"{path} is held by {moved.get('worker')}")
+                return False
+            print(f"taking over the stale lock {path} of {current.get('worker', 'an older version')}")
+            os.remove(stale_path)
+        return False
+
+    def unlock(self, name):
+        os.remove(os.path.join(self.queue_dir, f"{name}.lock"))
+
+    def status(self):
+        return {state: sum(name.endswith(".json") for name in os.listdir(os.path.join(self.queue_dir, state)))
+                for state in QUEUE_STATES}
+
+
+def process_alive(pid):
+    """
+    Whether a process `pid` runs on this host.
+    """
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # runs under another user
+        return True
+    return True
+
+
+def run_worker(queue, evaluate, accept=None):
+    """
+    Claims tasks from `queue` until none is left and runs `evaluate(task)` on each of them. A task whose evaluation
+    raises is moved to failed and the worker goes on with the next one.
+    :return: Number of tasks completed by this worker.
+    """
+    completed = 0
+    while True:
+        task = queue.claim(accept)
+        if task is None:
+            break
+        print(f"[{queue.worker_id}] length {task['context_length']}, depth {task['depth_percent']}%, needle {task['needle_id']}, mask {task['mask_topk']}")
+        try:
+            result = evaluate(task)
+        except Exception:
+            traceback.print_exc()
+            queue.fail(task, traceback.format_exc())
+            continue
+        queue.complete(task, result)
+        completed += 1
+    print(f"[{queue.worker_id}] no task left, {completed} completed, queue status {queue.status()}")
+    return completed
+
+
+def sweep_tasks(context_lengths, depth_percents, s_len, e_len, needle_ids=(0,), mask_topk=0):
+    """
+    Tasks of the grid a harness would run with these arguments.
+    """
+    return [make_task(context_length, depth_percent, needle_id, mask_topk)
+            for needle_id in needle_ids
+            for context_length in context_lengths if s_len <= context_length <= e_len
+            for depth_percent in depth_percents]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('command', choices=["status", "requeue"], help='print the task counts of the queue, or put running tasks back to pending')
+    parser.add_argument('queue', type=str, help='queue directory')
+    parser.add_argument('--failed', action='store_true', help='with requeue, also retry the failed tasks')
+    args = parser.parse_args()
+
+    queue = SweepQueue(args.queue)
+    if args.command == "requeue":
+        print(f"requeued {queue.requeue(['running', 'failed'] if args.failed else ['running'])} tasks")
+    print(queue.status())
@@ -1,12 +1,15 @@
-
+import matplotlib
+# render to files only, also in the worker processes of the batch mode
+matplotlib.use("Agg")
 import pandas as pd
 import seaborn as sns
 import matplotlib.pyplot as plt
 from matplotlib.colors import LinearSegmentedColormap
-import pandas as pd
-import json
-import glob
+import argparse
+import os
 import sys
+from concurrent.futures import ProcessPoolExecutor
+from results_store import ResultsStore
 
 # FOLDER_PATH = "results/mask_0.2_0.2_rescale_True/"
 MODEL_NAME = ""
@@ -14,62 +17,52 @@ MODEL_NAME = ""
 # "LLaMA 2 7B continue-trained on 5B tokens 80K length Per-source length upsampled data"
 PRETRAINED_LEN=300000
 
-def main(folder_path):
-    # Path to the directory containing JSON results
-
+def folder_model_name(folder_path):
     if("/" in folder_path):
-        model_name = folder_path.split("/")[-2]
-    else: model_name = MODEL_NAME
-    print("model_name = %s" % model_name)
-
-    # Using glob to find all json files in the directory
-    json_files = glob.glob(f"{folder_path}*.json")
-    print(json_files)
-    # import ipdb; ipdb.set_trace()
-
-    # List to hold the data
-    data = []
-
-    # Iterating through each file and extract the 3 columns we need
-    for file in json_files:
-        with open(file, 'r') as f:
-            json_data = json.load(f)
-            # Extracting the required fields
-            document_depth = json_data.get("depth_percent", None)
-            context_length = json_data.get("context_length", None)
-            score = json_data.get("score", None)
-            model_response = json_data.get("model_response", None).lower()
-            needle = json_data.get("needle", None).lower()
-            expected_answer = "eat a sandwich and sit in Dolores Park on a sunny day.".lower().split()
-            # score = len(set(model_response.split()).intersection(set(expected_answer))) / len(expected_answer)
-            # Appending to the list
-            data.append({
-                "Document Depth": document_depth,
-                "Context Length": context_length,
-                "Score": score
-            })
-
-    # Creating a DataFrame
-    df = pd.DataFrame(data)
-    print(df)
-    try:
-        locations = list(df["Context Length"].unique())
-    except Exception as e:
-        print(e)
-        # exit()
-    locations.sort()
+        return folder_path.split("/")[-2]
+    else: return MODEL_NAME
+
+def load_folders(folder_paths):
+    """
+    Reads the results of every folder into one DataFrame with a "Folder" column, one row per grid point.
+    """
+    frames = []
+    for folder_path in folder_paths:
+        # Read the results file of the run (per point json files are converted on first read)
+        rows = list(ResultsStore(folder_path).rows())
+        if not rows:
+            print("no results in %s" % folder_path)
+            continue
+        frame = pd.DataFrame(rows)
+        frame = frame.drop_duplicates([c for c in ["context_length", "depth_percent", "needle"] if c in frame.columns], keep="last")
+        frame["Folder"] = folder_path
+        frames.append(frame)
+    if not frames:
+        sys.exit("no results to plot")
+    df = pd.concat(frames, ignore_index=True)
+    return df.rename(columns={"depth_percent": "Document Depth", "context_length": "Context Length", "score": "Score"})[
+        ["Folder", "Document Depth", "Context Length", "Score"]]
+
+def pivot_tables(df):
+    """
+    Depth x length mean score table of every folder, from one groupby over all folders.
+    """
+    scores = df.groupby(["Folder", "Document Depth", "Context Length"])["Score"].mean().unstack("Context Length")
+    return {folder: table.droplevel("Folder").dropna(axis=0, how="all").dropna(axis=1, how="all") for folder, table in scores.groupby(level="Folder")}
+
+def summary_table(df):
+    """
+    Overall score, number of grid points and longest context of every folder.
+    """
+    return df.groupby("Folder").agg(**{"Overall Score": ("Score", "mean"), "Points": ("Score", "size"),
+                                       "Max Length": ("Context Length", "max")})
+
+def render_heatmap(model_name, pivot_table, save_path):
+    locations = sorted(pivot_table.columns)
     for li, l in enumerate(locations):
-        print(li, l)
         if(l > PRETRAINED_LEN): break
     pretrained_len = li
 
-    print(df.head())
-    print("Overall score %.3f" % df["Score"].mean())
-
-    pivot_table = pd.pivot_table(df, values='Score', index=['Document Depth', 'Context Length'], aggfunc='mean').reset_index() # This will aggregate
-    pivot_table = pivot_table.pivot(index="Document Depth", columns="Context Length", values="Score") # This will turn into a proper pivot
-    print(pivot_table.iloc[:5, :50])
-
     # Create a custom colormap. Go to https://coolors.co/ and pick cool colors
     cmap = LinearSegmentedColormap.from_list("custom_cmap", ["#F0496E", "#EBB839", "#0CD79F"])
 
@@ -85,12 +78,8 @@ def main(folder_path):
         linestyle='--'
     )
 
-
     # More aesthetics
-    model_name_ = model_name
-    print("model_name_ = %s" % model_name_)
-    title = f'Pressure Testing {model_name_} \nFact Retrieval Across Context Lengths ("Needle In A HayStack")'
-    print("Title = %s" % title)
+    title = f'Pressure Testing {model_name} \nFact Retrieval Across Context Lengths ("Needle In A HayStack")'
     plt.title(title)  # Adds a title
     plt.xlabel('Token Limit')  # X-axis label
     plt.ylabel('Depth Percent')  # Y-axis label
@@ -101,18 +90,47 @@ def main(folder_path):
     # Add a vertical line at the desired column index
     plt.axvline(x=pretrained_len + 0.8, color='white', linestyle='--', linewidth=4)
 
-    save_path = "img/%s.png" % model_name
     print("saving at %s" % save_path)
     plt.savefig(save_path, dpi=150)
-    # save_path = "img/%s.1.png" % model_name
-    # print("saving at %s" % save_path)
-    # plt.savefig(save_path, dpi=150)
-    # save_path = "img/%s.2.png" % model_name
-    # print("saving at %s" % save_path)
-    # plt.savefig(save_path, dpi=150)
+    plt.close(f)
+    return save_path
+
+def main(folder_path):
+    model_name = folder_model_name(folder_path)
+    print("model_name = %s" % model_name)
+    df = load_folders([folder_path])
+    print(df.head())
+    print("Overall score %.3f" % df["Score"].mean())
+    pivot_table = pivot_tables(df)[folder_path]
+    print(pivot_table.iloc[:5, :50])
+    render_heatmap(model_name, pivot_table, "img/%s.png" % model_name)
+
+def batch(folder_paths, workers=None, summary_path="img/summary.csv"):
+    """
+    Renders the heatmaps of all folders: one pass to load the results, one groupby for all the pivot tables and a
+    process pool for the figures. Also writes the overall score of every folder to `summary_path`.
+    """
+    df = load_folders(folder_paths)
+    tables = pivot_tables(df)
+    summary = summary_table(df)
+    print(summary.to_string())
+    os.makedirs(os.path.dirname(summary_path) or ".", exist_ok=True)
+    summary.to_csv(summary_path)
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        jobs = [pool.submit(render_heatmap, folder_model_name(folder), table, "img/%s.png" % folder_model_name(folder))
+                for folder, table in tables.items()]
+        for job in jobs:
+            job.result()
+    return summary
+
 if __name__ == "__main__":
-    if len(sys.argv) > 1:
-        folder_paths = sys.argv[1:]
+    parser = argparse.ArgumentParser()
+    parser.add_argument('folder_paths', type=str, nargs='*', help='results folders to plot, several folders are rendered in batch')
+    parser.add_argument('--workers', type=int, default=None, help='processes rendering the heatmaps in batch mode (default: one per cpu)')
+    parser.add_argument('--summary', type=str, default="img/summary.csv", help='where the batch mode writes the overall score of every folder')
+    args = parser.parse_args()
+    if args.folder_paths:
+        folder_paths = args.folder_paths
     else:
         folder_paths = [
         # "results/graph/lco_0_keep_1024_rescale_True_Mistral/",
@@ -152,6 +170,9 @@ if __name__ == "__main__":
         # "results/graph/lco_0.03_keep_120_rescale_True_substitute_io_False_substitute_linear_True_resized_False_lkr_0.1_linear_rescale_True_simple_delta_linear_merging_method_simple_delta_mlpk_True_True_True_Mistral/",
         "results/graph/_save_checkpoint_150_Mistral/"
         ]
-    for folder_path in folder_paths:
-        print(folder_path)
-        main(folder_path)
+    if len(folder_paths) > 1:
+        batch(folder_paths, args.workers, args.summary)
+    else:
+        for folder_path in folder_paths:
+            print(folder_path)
+            main(folder_path)